@@ -0,0 +1,32 @@
+"""Add indexes on the columns serial and expiration of the table challenge,
+so that the challenges of a token and the expired challenges can be found
+with an indexed query.
+
+Revision ID: 3d7f8b29cbb1
+Revises: e360c56bcf8c
+Create Date: 2016-10-16 16:45:03.117624
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3d7f8b29cbb1'
+down_revision = 'e360c56bcf8c'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    indexes = [i.get("name") for i in inspector.get_indexes('challenge')]
+    for column in ["serial", "expiration"]:
+        index = op.f('ix_challenge_{0!s}'.format(column))
+        if index in indexes:
+            print("Good. Index '{0!s}' already exists.".format(index))
+        else:
+            op.create_index(index, 'challenge', [column], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_challenge_expiration'), table_name='challenge')
+    op.drop_index(op.f('ix_challenge_serial'), table_name='challenge')
@@ -0,0 +1,47 @@
+"""Add table 'otpindex' with the keyed digests of the next OTP values of the
+event based tokens, so that the token of an OTP value can be found with an
+indexed query. The table is filled by "pi-manage otpindex update".
+
+Revision ID: a7e91b18a460
+Revises: 3d7f8b29cbb1
+Create Date: 2016-10-17 09:21:37.513802
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a7e91b18a460'
+down_revision = '3d7f8b29cbb1'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.exc import OperationalError, ProgrammingError, InternalError
+
+
+def upgrade():
+    try:
+        op.create_table('otpindex',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('digest', sa.Unicode(length=64), nullable=False),
+        sa.Column('token_id', sa.Integer(), nullable=False),
+        sa.Column('counter', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['token_id'], ['token.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token_id', 'counter', name='otix_2')
+        )
+        op.create_index(op.f('ix_otpindex_digest'), 'otpindex',
+                        ['digest'], unique=False)
+    except (OperationalError, ProgrammingError, InternalError) as exx:
+        # e.g. "table otpindex already exists" (SQLite, MySQL) or
+        # "relation "otpindex" already exists" (PostgreSQL)
+        if "already exists" in str(exx.orig).lower():
+            print("Good. Table 'otpindex' already exists.")
+        else:
+            print(exx)
+    except Exception as exx:
+        print ("Could not add table 'otpindex'")
+        print (exx)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_otpindex_digest'), table_name='otpindex')
+    op.drop_table('otpindex')
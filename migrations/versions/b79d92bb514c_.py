@@ -0,0 +1,68 @@
+"""Add table 'yubikeyprefix' to find a Yubikey by its prefix with an
+indexed query. The table is filled with the existing tokeninfo
+'yubikey.prefix'.
+
+Revision ID: b79d92bb514c
+Revises: 239995464c48
+Create Date: 2016-10-16 10:12:41.518234
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b79d92bb514c'
+down_revision = '239995464c48'
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.exc import OperationalError, ProgrammingError, InternalError
+
+
+def upgrade():
+    try:
+        op.create_table('yubikeyprefix',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('prefix', sa.Unicode(length=255), nullable=False),
+        sa.Column('token_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['token_id'], ['token.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('token_id')
+        )
+        op.create_index(op.f('ix_yubikeyprefix_prefix'), 'yubikeyprefix',
+                        ['prefix'], unique=False)
+    except (OperationalError, ProgrammingError, InternalError) as exx:
+        # e.g. "table yubikeyprefix already exists" (SQLite, MySQL) or
+        # "relation "yubikeyprefix" already exists" (PostgreSQL)
+        if "already exists" in str(exx.orig).lower():
+            print("Good. Table 'yubikeyprefix' already exists.")
+        else:
+            print(exx)
+        return
+    except Exception as exx:
+        print ("Could not add table 'yubikeyprefix'")
+        print (exx)
+        return
+
+    # Copy the existing prefixes of the Yubikeys
+    tokeninfo = sa.table('tokeninfo',
+                         sa.column('Key', sa.Unicode(length=255)),
+                         sa.column('Value', sa.UnicodeText()),
+                         sa.column('token_id', sa.Integer()))
+    yubikeyprefix = sa.table('yubikeyprefix',
+                             sa.column('prefix', sa.Unicode(length=255)),
+                             sa.column('token_id', sa.Integer()))
+    token = sa.table('token',
+                     sa.column('id', sa.Integer()),
+                     sa.column('tokentype', sa.Unicode(length=30)))
+    rows = op.get_bind().execute(
+        sa.select([tokeninfo.c.token_id, tokeninfo.c.Value]).where(
+            sa.and_(tokeninfo.c.Key == u"yubikey.prefix",
+                    tokeninfo.c.token_id == token.c.id,
+                    token.c.tokentype == u"yubikey"))).fetchall()
+    op.bulk_insert(yubikeyprefix,
+                   [{"token_id": token_id, "prefix": prefix}
+                    for token_id, prefix in rows if prefix])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_yubikeyprefix_prefix'), table_name='yubikeyprefix')
+    op.drop_table('yubikeyprefix')
@@ -0,0 +1,87 @@
+"""Add the composite index tiix_3 (Key, ValueHash, token_id) to the table
+tokeninfo, so that tokens can be filtered by tokeninfo with an indexed
+EXISTS subquery. The unique constraint tiix_2 (token_id, Key) is added, if
+the database does not have it, yet.
+
+The column Value is unbounded and can not be contained in a btree index.
+So the new column ValueHash with the SHA-256 digest of the value is indexed
+instead and filled for the existing tokeninfo.
+
+Revision ID: e360c56bcf8c
+Revises: b79d92bb514c
+Create Date: 2016-10-16 14:02:17.390112
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e360c56bcf8c'
+down_revision = 'b79d92bb514c'
+
+from alembic import op
+import hashlib
+import sqlalchemy as sa
+
+
+def _get_value_hash(value):
+    if value is None:
+        return None
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return unicode(hashlib.sha256(value).hexdigest())
+
+
+def upgrade():
+    # A failing statement would abort the transaction of the migration on
+    # PostgreSQL, so the existing columns, indexes and constraints are
+    # checked first.
+    inspector = sa.inspect(op.get_bind())
+    columns = [c.get("name") for c in inspector.get_columns('tokeninfo')]
+    indexes = dict((i.get("name"), i.get("column_names"))
+                   for i in inspector.get_indexes('tokeninfo'))
+    constraints = [c.get("name") for c in
+                   inspector.get_unique_constraints('tokeninfo')]
+
+    if "ValueHash" in columns:
+        print("Good. Column 'ValueHash' already exists.")
+    else:
+        op.add_column('tokeninfo', sa.Column('ValueHash',
+                                             sa.Unicode(length=64)))
+        # Fill the digests of the existing tokeninfo
+        tokeninfo = sa.table('tokeninfo',
+                             sa.column('id', sa.Integer()),
+                             sa.column('Value', sa.UnicodeText()),
+                             sa.column('ValueHash', sa.Unicode(length=64)))
+        rows = op.get_bind().execute(
+            sa.select([tokeninfo.c.id, tokeninfo.c.Value])).fetchall()
+        if rows:
+            op.get_bind().execute(
+                tokeninfo.update().where(
+                    tokeninfo.c.id == sa.bindparam("ti_id")).values(
+                    ValueHash=sa.bindparam("ti_hash")),
+                [{"ti_id": ti_id, "ti_hash": _get_value_hash(value)}
+                 for ti_id, value in rows])
+
+    if indexes.get("tiix_3") == ["Key", "ValueHash", "token_id"]:
+        print("Good. Index 'tiix_3' already exists.")
+    else:
+        if "tiix_3" in indexes:
+            # The former index contained the column Value
+            op.drop_index('tiix_3', table_name='tokeninfo')
+        op.create_index('tiix_3', 'tokeninfo',
+                        ['Key', 'ValueHash', 'token_id'], unique=False)
+
+    if "tiix_2" in indexes.keys() + constraints:
+        print("Good. Constraint 'tiix_2' already exists.")
+    else:
+        try:
+            op.create_unique_constraint('tiix_2', 'tokeninfo',
+                                        ['token_id', 'Key'])
+        except NotImplementedError as exx:
+            # SQLite can not add a constraint to an existing table
+            print ("Could not add constraint 'tiix_2'")
+            print (exx)
+
+
+def downgrade():
+    op.drop_index('tiix_3', table_name='tokeninfo')
+    op.drop_column('tokeninfo', 'ValueHash')
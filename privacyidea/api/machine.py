@@ -3,6 +3,7 @@
 # http://www.privacyidea.org
 # (c) cornelius kölbel, privacyidea.org
 #
+# 2016-10-17 Return the machine resolvers, that did not answer in time
 # 2014-12-08 Cornelius Kölbel, <cornelius@privacyidea.org>
 #            Complete rewrite during flask migration
 #            Try to provide REST API
@@ -31,7 +32,7 @@ from lib.utils import (getParam,
 from ..api.lib.prepolicy import prepolicy, check_base_action, mangle
 from ..lib.policy import ACTION
 
-from ..lib.machine import (get_machines, attach_token, detach_token,
+from ..lib.machine import (search_machines, attach_token, detach_token,
                            add_option, delete_option,
                            list_token_machines, list_machine_tokens,
                            get_auth_items)
@@ -59,6 +60,8 @@ def list_machines_api():
         or "id"
     
     :return: json result with "result": true and the machine list in "value".
+        The machine resolvers, that failed or did not answer in time, are
+        listed in "detail" as "incomplete_resolvers".
 
     **Example request**:
 
@@ -111,15 +114,16 @@ def list_machines_api():
 
     any = getParam(request.all_data, "any")
 
-    machines = get_machines(hostname=hostname, ip=ip, id=id, resolver=resolver,
-                            any=any)
+    machines, incomplete = search_machines(hostname=hostname, ip=ip, id=id,
+                                           resolver=resolver, any=any)
     # this returns a list of Machine Object. This is not JSON serialiable,
     # so we need to convert the Machine Object to dict
     machines = [mobject.get_dict() for mobject in machines]
     g.audit_object.log({'success': True,
                         'info': "hostname: {0!s}, ip: {1!s}".format(hostname, ip)})
     
-    return send_result(machines)
+    return send_result(machines,
+                       details={"incomplete_resolvers": incomplete})
 
 
 @machine_blueprint.route('/token', methods=['POST'])
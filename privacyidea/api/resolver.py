@@ -3,6 +3,7 @@
 # http://www.privacyidea.org
 # (c) cornelius kölbel, privacyidea.org
 #
+# 2016-10-17 Add the statistics of the SQL connection pools
 # 2014-12-08 Cornelius Kölbel, <cornelius@privacyidea.org>
 #            Complete rewrite during flask migration
 #            Try to provide REST API
@@ -41,6 +42,7 @@ from ..lib.log import log_with
 from ..lib.resolver import (get_resolver_list,
                             save_resolver,
                             delete_resolver, pretestresolver)
+from ..lib.resolvers.SQLIdResolver import get_engine_stats
 from flask import g
 import logging
 from ..api.lib.prepolicy import prepolicy, check_base_action
@@ -184,3 +186,21 @@ def test_resolver():
     success, desc = pretestresolver(rtype, param)
     return send_result(success, details={"description": desc})
 
+
+@log_with(log)
+@resolver_blueprint.route('/stats/sqlpools', methods=["GET"])
+def get_sql_pools():
+    """
+    Return the statistics of the SQL engines and their connection pools,
+    that are used by the SQL resolvers of this privacyIDEA process.
+
+    :return: a json list with one entry per engine containing the names of
+        the "resolvers", that share the engine, the database URL without the
+        password, the pool class, the number of
+        "connects", "checkouts" and "invalidated" connections and, if the
+        pool supports it, its "size", "checkedin", "checkedout" and
+        "overflow".
+    """
+    res = get_engine_stats()
+    g.audit_object.log({"success": True})
+    return send_result(res)
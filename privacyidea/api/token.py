@@ -3,6 +3,9 @@
 # http://www.privacyidea.org
 # (c) cornelius kölbel, privacyidea.org
 #
+# 2016-10-17 Find the serial of an OTP value with the OTP index
+# 2016-10-16 Import the token specific parameters like yubikey.prefix
+# 2016-10-16 Load the tokeninfo of all tokens for getserial in bulk
 # 2015-12-18 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #            Move the complete before and after logic
 # 2015-11-29 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -794,6 +797,12 @@ def loadtokens_api(filename=None):
         if hashlib and hashlib != "auto":
             init_param['hashlib'] = hashlib
 
+        # Token specific parameters like the yubikey.prefix are added to
+        # the tokeninfo
+        for key, value in TOKENS[serial].items():
+            if key.startswith(TOKENS[serial]['type'] + "."):
+                init_param[key] = value
+
         #if tokenrealm:
         #    self.Policy.checkPolicyPre('admin', 'loadtokens',
         #                   {'tokenrealm': tokenrealm })
@@ -921,10 +930,11 @@ def get_serial_by_otp_api(otp=None):
     if assigned_param:
         assigned = True
 
-    tokenobj_list = get_tokens(tokentype=ttype,
+    # The tokens are looked up in the OTP index and only the candidates are
+    # read from the database
+    serial = get_serial_by_otp(otp=otp, window=window, tokentype=ttype,
                                serial="*{0!s}*".format(serial_substr),
                                assigned=assigned)
-    serial = get_serial_by_otp(tokenobj_list, otp=otp, window=window)
 
     g.audit_object.log({"success": True,
                         "info": "get {0!s} by OTP".format(serial)})
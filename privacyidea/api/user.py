@@ -3,6 +3,7 @@
 # http://www.privacyidea.org
 # (c) cornelius kölbel, privacyidea.org
 #
+# 2016-10-17 Endpoints to flush the user cache and to read its statistics
 # 2014-12-08 Cornelius Kölbel, <cornelius@privacyidea.org>
 #            Complete rewrite during flask migration
 #            Try to provide REST API
@@ -29,6 +30,7 @@ from ..api.lib.prepolicy import prepolicy, check_base_action
 from ..lib.policy import ACTION
 from privacyidea.api.auth import admin_required, user_required
 from privacyidea.lib.user import create_user, get_user_from_param, User
+from privacyidea.lib.usercache import flush_user_cache, get_user_cache_stats
 
 from flask import (g)
 from ..lib.user import get_user_list
@@ -104,6 +106,88 @@ def get_users():
     return send_result(users)
 
 
+@user_blueprint.route('/cache', methods=['GET'])
+@admin_required
+def get_user_cache_api():
+    """
+    Return the settings and the hit and miss statistics of the user cache of
+    the privacyIDEA process, that handles the request.
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+       GET /user/cache HTTP/1.1
+       Host: example.com
+       Accept: application/json
+
+    **Example response**:
+
+    .. sourcecode:: http
+
+       HTTP/1.1 200 OK
+       Content-Type: application/json
+
+        {
+          "id": 1,
+          "jsonrpc": "2.0",
+          "result": {
+            "status": true,
+            "value": {
+              "ttl": 300,
+              "negative_ttl": 30,
+              "size": 10000,
+              "entries": 42,
+              "hits": 1234,
+              "negative_hits": 17,
+              "misses": 89
+            }
+          },
+          "version": "privacyIDEA unknown"
+        }
+    """
+    stats = get_user_cache_stats()
+    g.audit_object.log({"success": True})
+    return send_result(stats)
+
+
+@user_blueprint.route('/cache', methods=['DELETE'])
+@prepolicy(check_base_action, request, ACTION.RESOLVERWRITE)
+@admin_required
+def flush_user_cache_api():
+    """
+    Remove entries from the user cache. Without parameters the whole cache
+    is flushed. The process, that handles the request, removes the given
+    entries. All other processes remove all entries of the resolver or the
+    whole cache, when they notice the flush in the database.
+
+    :param resolver: Only remove the users of this resolver
+    :param user: Only remove this user of the resolver. Requires the
+        parameter resolver.
+    :return: The number of removed cache entries of this process
+
+    **Example request**:
+
+    .. sourcecode:: http
+
+       DELETE /user/cache?resolver=<resolvername>&user=<username> HTTP/1.1
+       Host: example.com
+       Accept: application/json
+
+    """
+    resolvername = getParam(request.all_data, "resolver")
+    username = getParam(request.all_data, "user")
+    if username:
+        resolvername = getParam(request.all_data, "resolver", optional=False)
+        removed = User(login=username, resolver=resolvername).flush_cache()
+    else:
+        removed = flush_user_cache(resolvername or None)
+    g.audit_object.log({"success": True,
+                        "info": "{0!s}/{1!s}".format(username,
+                                                     resolvername)})
+    return send_result(removed)
+
+
 @user_blueprint.route('/<resolvername>/<username>', methods=['DELETE'])
 @prepolicy(check_base_action, request, ACTION.DELETEUSER)
 @admin_required
@@ -120,6 +120,9 @@ def after_request(response):
     # completely so that we do not have an audit_object
     if "audit_object" in g:
         g.audit_object.finalize_log()
+    if "policy_object" in g:
+        log.debug("policy lookups: {0!s}".format(
+            g.policy_object.get_memo_stats()))
 
     # No caching!
     response.headers['Cache-Control'] = 'no-cache'
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+# 2016-10-16 Close the pooled resolver objects after each request
 # 2014-11-15 Cornelius Kölbel, info@privacyidea.org
 #            Initial creation
 #
@@ -26,6 +27,7 @@ import logging.config
 import sys
 from flask import Flask
 import privacyidea.api.before_after
+from privacyidea.lib.resolver import close_resolver_objects
 from privacyidea.api.validate import validate_blueprint
 from privacyidea.api.token import token_blueprint
 from privacyidea.api.system import system_blueprint
@@ -150,6 +152,7 @@ def create_app(config_name="development",
     app.register_blueprint(smtpserver_blueprint, url_prefix='/smtpserver')
     app.register_blueprint(recover_blueprint, url_prefix='/recover')
     app.register_blueprint(radiusserver_blueprint, url_prefix='/radiusserver')
+    app.teardown_request(close_resolver_objects)
     db.init_app(app)
     migrate = Migrate(app, db)
 
@@ -38,6 +38,8 @@ class TestingConfig(Config):
     # This is only for testing encrypted files
     PI_ENCFILE_ENC = "tests/testdata/enckey.enc"
     PI_LOGLEVEL = logging.DEBUG
+    # The tests delete the expired challenges themselves
+    PI_CHALLENGE_CLEANUP_INTERVAL = 0
 
 
 class ProductionConfig(Config):
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Only issue the OTP values, if the counter could be increased
+#  2016-10-17 Hash the OTP values in a process pool and keep the hashes of
+#             a counter range for the retries of the client
 #  2015-04-08 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add options ROUNDS to avoid timeouts during OTP hash calculation
 #  2015-04-03 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -23,12 +26,108 @@
 # You should have received a copy of the GNU Affero General Public
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+__doc__ = """The offline application returns the PBKDF2 hashes of the next OTP
+values of a HOTP token.
+
+The hashes can be calculated by a pool of PI_OFFLINE_HASH_PROCESSES processes
+of each privacyIDEA process. The hashes of the last counter range of a token are
+kept for PI_OFFLINE_HASH_CACHE_TTL seconds, so that a client, that repeats the
+request, gets the same hashes without calculating them again.
+
+This module is tested in tests/test_lib_applications.py
+"""
 from privacyidea.lib.applications import MachineApplicationBase
+import atexit
+import hashlib
 import logging
+import os
+import threading
 import passlib.hash
+from multiprocessing import Pool
+from flask import current_app, has_app_context
 from privacyidea.lib.token import get_tokens
+from privacyidea.lib.utils import LRUCache, to_utf8
 log = logging.getLogger(__name__)
 ROUNDS = 6549
+# The default number of processes, that calculate the hashes. With 0 the
+# hashes are calculated in the thread of the request.
+HASH_PROCESSES = 0
+# The default time in seconds, the hashes of a counter range are kept
+HASH_CACHE_TTL = 300
+HASH_CACHE_SIZE = 100
+
+_hash_cache = LRUCache(HASH_CACHE_SIZE)
+# The process id, the number of processes and the pool of this process
+_process_pool = (None, 0, None)
+_process_pool_lock = threading.Lock()
+
+
+def hash_otp(value, rounds=ROUNDS):
+    """
+    Return the salted PBKDF2 hash of an OTP value.
+    """
+    return passlib.hash.pbkdf2_sha512.encrypt(value, rounds=rounds,
+                                              salt_size=10)
+
+
+def _hash_otp(args):
+    # Pool.map passes one argument
+    return hash_otp(*args)
+
+
+def _get_process_pool(processes):
+    """
+    Return the process pool of this process. It is created again, if the
+    number of processes changed or if this process was forked.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        pid, size, pool = _process_pool
+        if pid != os.getpid() or size != processes:
+            if pid == os.getpid():
+                pool.terminate()
+            else:
+                atexit.register(stop_hash_processes)
+            pool = Pool(processes)
+            _process_pool = (os.getpid(), processes, pool)
+    return pool
+
+
+def stop_hash_processes():
+    """
+    Stop the process pool of this process.
+    """
+    global _process_pool
+    with _process_pool_lock:
+        pid, _size, pool = _process_pool
+        if pid == os.getpid():
+            pool.terminate()
+            pool.join()
+        _process_pool = (None, 0, None)
+
+
+def hash_otps(otps, rounds=ROUNDS):
+    """
+    Calculate the hashes of the OTP values. If PI_OFFLINE_HASH_PROCESSES is
+    set, the hashes are calculated by a pool of at most this number of
+    processes.
+
+    :param otps: dict with the OTP values
+    :param rounds: The rounds of PBKDF2
+    :return: dict with the same keys and the hashes of the OTP values
+    :rtype: dict
+    """
+    processes = HASH_PROCESSES
+    if has_app_context():
+        processes = int(current_app.config.get("PI_OFFLINE_HASH_PROCESSES",
+                                               HASH_PROCESSES))
+    keys = otps.keys()
+    args = [(otps[key], rounds) for key in keys]
+    if processes > 0 and len(args) > 1:
+        hashes = _get_process_pool(processes).map(_hash_otp, args)
+    else:
+        hashes = [_hash_otp(arg) for arg in args]
+    return dict(zip(keys, hashes))
 
 
 class MachineApplication(MachineApplicationBase):
@@ -81,22 +180,41 @@ class MachineApplication(MachineApplicationBase):
                 token_obj = toks[0]
                 if password:
                     _r, otppin, _otpval = token_obj.split_pin_pass(password)
-                (res, err, otp_dict) = token_obj.get_multi_otp(count=count)
-                otps = otp_dict.get("otp")
-                for key in otps.keys():
+                # The hashes of the last issued counter range are kept for
+                # the retries of the client. A retry gets the same hashes, as
+                # long as the token counter was not changed since then.
+                cache_key = (serial, count, rounds,
+                             hashlib.sha256(to_utf8(otppin)).hexdigest())
+                counter, otps = _hash_cache.get(cache_key, (None, None))
+                if counter != token_obj.token.count:
+                    (res, err, otp_dict) = token_obj.get_multi_otp(count=count)
                     # Return the hash of OTP PIN and OTP values
-                    otps[key] = passlib.hash.\
-                        pbkdf2_sha512.encrypt(otppin + otps.get(key),
-                                                rounds=rounds,
-                                                salt_size=10)
-                # We do not disable the token, so if all offline OTP values
-                # are used, the token can be used the authenticate online again.
-                # token_obj.enable(False)
-                # increase the counter by the consumed values and
-                # also store it in tokeninfo.
-                token_obj.inc_otp_counter(counter=count)
-                token_obj.add_tokeninfo(key="offline_counter",
-                                        value=count)
+                    otps = hash_otps(dict((key, otppin + otp) for key, otp in
+                                          otp_dict.get("otp").items()),
+                                     rounds=rounds)
+                    # We do not disable the token, so if all offline OTP
+                    # values are used, the token can be used the authenticate
+                    # online again.
+                    # token_obj.enable(False)
+                    # increase the counter by the consumed values and
+                    # also store it in tokeninfo.
+                    counter = token_obj.inc_otp_counter(
+                        counter=token_obj.token.count + count)
+                    if counter < 0:
+                        # A concurrent request issued these OTP values
+                        log.warning("The OTP values of token {0!r} were "
+                                    "issued by a concurrent "
+                                    "request.".format(serial))
+                        return ret
+                    token_obj.add_tokeninfo(key="offline_counter",
+                                            value=count)
+                    ttl = HASH_CACHE_TTL
+                    if has_app_context():
+                        ttl = float(current_app.config.get(
+                            "PI_OFFLINE_HASH_CACHE_TTL", HASH_CACHE_TTL))
+                    if ttl > 0:
+                        _hash_cache.set(cache_key, (counter, otps), ttl)
+                otps = dict(otps)
                 ret["response"] = otps
                 user_object = token_obj.user
                 if user_object:
@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 #
 #  privacyIDEA
+#  2016-10-17 Insert the batches of the audit writer with executemany and
+#             retry failed batches
+#  2016-10-16 Add the asynchronous audit writer
+#  2016-10-16 Share the engine and the connection pool between the audit
+#             objects of one process
 #  May 11, 2014 Cornelius Kölbel, info@privacyidea.org
 #  http://www.privacyidea.org
 #
@@ -29,9 +34,24 @@ The SQL Audit Module is configured like this:
 
     Optional:
     PI_AUDIT_SQL_URI = "sqlite://"
+    PI_AUDIT_POOL_SIZE = 20
+    PI_AUDIT_POOL_OVERFLOW = 10
+    PI_AUDIT_POOL_RECYCLE = 3600
+    PI_AUDIT_ASYNC = True
+    PI_AUDIT_ASYNC_QUEUE_SIZE = 1000
+    PI_AUDIT_ASYNC_BATCH_SIZE = 50
+    PI_AUDIT_ASYNC_INTERVAL = 1
 
 If the PI_AUDIT_SQL_URI is omitted the Audit data is written to the
 token database.
+
+The engine with its connection pool and the signing object are created only
+once per process and shared by all audit objects.
+
+If PI_AUDIT_ASYNC is set, the finalized audit entries are put into a queue
+and are signed and written to the database in batches by a background
+thread. If the queue is full, the entry is written synchronously. A failed
+batch is retried and then written entry by entry.
 """
 
 import logging
@@ -40,8 +60,14 @@ from privacyidea.lib.crypto import Sign
 from sqlalchemy import Table, MetaData, Column
 from sqlalchemy import Integer, String, DateTime, asc, desc, and_
 from sqlalchemy.orm import mapper
+import atexit
 import datetime
+import threading
+import time
 import traceback
+import Queue
+import uuid
+from sqlalchemy import bindparam, func
 from sqlalchemy.exc import OperationalError
 
 log = logging.getLogger(__name__)
@@ -118,6 +144,267 @@ mapper(LogEntry, logentry)
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 
+# The engines with their session factories and the sign objects are shared by
+# all Audit objects of a process.
+_engines = {}
+_sign_objects = {}
+_writers = {}
+_registry_lock = threading.Lock()
+
+# Map the config file entries to the arguments of create_engine
+POOL_OPTIONS = [("PI_AUDIT_POOL_SIZE", "pool_size"),
+                ("PI_AUDIT_POOL_OVERFLOW", "max_overflow"),
+                ("PI_AUDIT_POOL_RECYCLE", "pool_recycle")]
+
+
+def get_pool_options(config):
+    """
+    Return the connection pool arguments for create_engine from the config
+    file entries. Only the options, that are set in the config, are returned,
+    since e.g. SQLite does not accept a pool size.
+
+    :param config: The config entries from the file config
+    :return: dict
+    """
+    options = {}
+    for config_key, option in POOL_OPTIONS:
+        value = config.get(config_key)
+        if value is not None:
+            options[option] = int(value)
+    return options
+
+
+def _engine_key(connect_string, pool_options):
+    return connect_string, tuple(sorted(pool_options.items()))
+
+
+def get_engine(connect_string, pool_options=None):
+    """
+    Return the engine and the session factory for the connect string.
+    The engine is created and the audit table is created in the database
+    only at the first call for this connect string and pool options.
+
+    :param connect_string: The SQLAlchemy database URI
+    :param pool_options: the arguments for the connection pool
+    :type pool_options: dict
+    :return: tuple of engine and session factory
+    """
+    pool_options = pool_options or {}
+    key = _engine_key(connect_string, pool_options)
+    with _registry_lock:
+        if key not in _engines:
+            log.debug("creating engine for {0!s}".format(connect_string))
+            engine = create_engine(connect_string, **pool_options)
+            try:
+                metadata.create_all(engine)
+            except OperationalError as exx:  # pragma: no cover
+                log.info("{0!r}".format(exx))
+            _engines[key] = (engine, sessionmaker(bind=engine))
+        return _engines[key]
+
+
+def get_sign_object(pub, priv):
+    """
+    Return the sign object for the given key files.
+
+    :param pub: Public key, used for verifying the signature
+    :type pub: string with filename
+    :param priv: Private key, used to sign the audit entry
+    :type priv: string with filename
+    :return: Sign object
+    """
+    with _registry_lock:
+        if (pub, priv) not in _sign_objects:
+            _sign_objects[(pub, priv)] = Sign(priv, pub)
+        return _sign_objects[(pub, priv)]
+
+
+def get_writer(config, connect_string, sign_object):
+    """
+    Return the asynchronous AuditWriter for the connect string and the
+    pool options of the config.
+    The writer is created at the first call and is stopped at the exit of the
+    process.
+
+    :param config: The config entries from the file config
+    :param connect_string: The SQLAlchemy database URI
+    :param sign_object: The Sign object to sign the audit entries
+    :return: AuditWriter
+    """
+    pool_options = get_pool_options(config)
+    _engine, Session = get_engine(connect_string, pool_options)
+    key = (_engine_key(connect_string, pool_options), sign_object)
+    with _registry_lock:
+        if key not in _writers:
+            writer = AuditWriter(
+                Session, sign_object,
+                queue_size=int(config.get("PI_AUDIT_ASYNC_QUEUE_SIZE", 1000)),
+                batch_size=int(config.get("PI_AUDIT_ASYNC_BATCH_SIZE", 50)),
+                interval=float(config.get("PI_AUDIT_ASYNC_INTERVAL", 1)))
+            atexit.register(writer.stop)
+            _writers[key] = writer
+        return _writers[key]
+
+
+class AuditWriter(object):
+    """
+    The AuditWriter writes the finalized log entries of a process in a
+    background thread. The entries are written in batches of batch_size
+    entries or after interval seconds.
+
+    A batch is inserted with one executemany INSERT. Since the signature
+    contains the id of the entry, the entries are inserted with a marker in
+    the column signature and read back with their ids. Then all signatures of
+    the batch are written with one executemany UPDATE in the same transaction.
+
+    A failed batch is retried. If it still fails, the entries are written one
+    by one.
+    """
+
+    def __init__(self, session_factory, sign_object, queue_size=1000,
+                 batch_size=50, interval=1.0, retries=2):
+        self.Session = session_factory
+        self.sign_object = sign_object
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.stopped = False
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        # The thread is started lazily. This way each forked worker process
+        # starts its own thread.
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run,
+                                               name="AuditWriter")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def put(self, entry):
+        """
+        Put a LogEntry into the queue.
+
+        :param entry: The unsaved log entry
+        :type entry: LogEntry
+        :return: False, if the queue is full or the writer is stopped. In this
+            case the caller needs to write the entry himself.
+        """
+        if self.stopped:
+            return False
+        self._start()
+        try:
+            self.queue.put_nowait(entry)
+        except Queue.Full:
+            log.warning("The audit queue is full. Writing the audit entry "
+                        "synchronously.")
+            return False
+        return True
+
+    def flush(self):
+        """
+        Wait until all entries in the queue are written.
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self, timeout=10):
+        """
+        Write all remaining entries and stop the thread.
+        """
+        self.stopped = True
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout)
+
+    def _run(self):
+        running = True
+        while running:
+            batch = []
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self.queue.get(
+                        timeout=max(deadline - time.time(), 0.001))
+                except Queue.Empty:
+                    break
+                if entry is None:
+                    # stop the thread after writing this batch
+                    self.queue.task_done()
+                    running = False
+                    break
+                batch.append(entry)
+            if batch:
+                self.write(batch)
+                for _entry in batch:
+                    self.queue.task_done()
+
+    def write(self, batch):
+        """
+        Insert and sign a list of log entries. A failed batch is retried
+        after interval seconds. If it still fails, each entry is written on
+        its own, so that only the failing entries are lost.
+
+        :param batch: list of LogEntry objects
+        """
+        rows = [dict((column.name, getattr(le, column.name))
+                     for column in logentry.columns if column.name != "id")
+                for le in batch]
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.interval)
+            try:
+                self._write_rows(rows)
+                return
+            except Exception as exx:
+                log.warning("failed to write {0!s} audit entries: "
+                            "{1!r}".format(len(rows), exx))
+                log.debug("{0!s}".format(traceback.format_exc()))
+        for row in rows:
+            try:
+                self._write_rows([row])
+            except Exception as exx:
+                log.error("exception {0!r}".format(exx))
+                log.error("DATA: {0!s}".format(row))
+
+    def _write_rows(self, rows):
+        """
+        Insert and sign the log entries with one transaction.
+
+        :param rows: list of dicts with the columns of the log entries
+        """
+        session = self.Session()
+        try:
+            if self.sign_object:
+                # The entries of this batch are found by their marker. They
+                # get ids above the current last id.
+                marker = "pending:{0!s}".format(uuid.uuid4().hex)
+                last_id = session.query(func.max(LogEntry.id)).scalar() or 0
+                rows = [dict(row, signature=marker) for row in rows]
+            session.execute(logentry.insert(), rows)
+            if self.sign_object:
+                # The stored entries are read, so that we sign the data like
+                # it is stored in the database.
+                entries = session.query(LogEntry).filter(
+                    LogEntry.id > last_id,
+                    LogEntry.signature == marker).all()
+                session.execute(
+                    logentry.update().where(
+                        logentry.c.id == bindparam("le_id")).values(
+                        signature=bindparam("le_signature")),
+                    [{"le_id": le.id,
+                      "le_signature": self.sign_object.sign(
+                          Audit._log_to_string(le))}
+                     for le in entries])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
 
 class Audit(AuditBase):
     """
@@ -136,23 +423,23 @@ class Audit(AuditBase):
                        self.config.get("PI_AUDIT_KEY_PRIVATE"))
         
         # an Engine, which the Session will use for connection
-        # resources
+        # resources. The engine and its connection pool are shared in the
+        # process.
         connect_string = self.config.get("PI_AUDIT_SQL_URI",
                                         self.config.get(
                                             "SQLALCHEMY_DATABASE_URI"))
         log.debug("using the connect string {0!s}".format(connect_string))
-        self.engine = create_engine(connect_string)
-
-        # create a configured "Session" class
-        Session = sessionmaker(bind=self.engine)
+        self.engine, Session = get_engine(connect_string,
+                                          get_pool_options(self.config))
 
         # create a Session
         self.session = Session()
         self.session._model_changes = {}
-        try:
-            metadata.create_all(self.engine)
-        except OperationalError as exx:  # pragma: no cover
-            log.info("{0!r}".format(exx))
+
+        self.writer = None
+        if self.config.get("PI_AUDIT_ASYNC"):
+            self.writer = get_writer(self.config, connect_string,
+                                     self.sign_object)
 
     @staticmethod
     def _create_filter(param):
@@ -240,6 +527,9 @@ class Audit(AuditBase):
                           loglevel=self.audit_data.get("log_level"),
                           clearance_level=self.audit_data.get("clearance_level")
                           )
+            if self.writer and self.writer.put(le):
+                # The entry is signed and written by the AuditWriter
+                return
             self.session.add(le)
             self.session.commit()
             # Add the signature
@@ -274,7 +564,7 @@ class Audit(AuditBase):
         :type priv: string with filename
         :return: None
         """
-        self.sign_object = Sign(priv, pub)
+        self.sign_object = get_sign_object(pub, priv)
 
     def _check_missing(self, audit_id):
         """
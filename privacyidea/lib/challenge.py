@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 #  privacyIDEA is a fork of LinOTP
 #
+#  2016-10-16 Delete the expired challenges in a background thread and do
+#             not return expired challenges
 #  2014-12-07 Cornelius Kölbel <cornelius@privacyidea.org>
 #
 #  Copyright (C) 2014 Cornelius Kölbel
@@ -23,26 +25,42 @@
 This is a helper module for the challenges database table.
 It is used by the lib.tokenclass
 
+The expired challenges are deleted by a background thread of each process
+every PI_CHALLENGE_CLEANUP_INTERVAL seconds, so that this is not done during
+the authentication. If the interval is set to 0, the expired challenges need
+to be deleted with "pi-manage challenge cleanup".
+
 The method is tested in test_lib_challenges
 """
 
+import atexit
 import logging
+import threading
+import traceback
+from flask import current_app
 from log import log_with
-from ..models import Challenge
+from ..models import Challenge, cleanup_challenges, db
 from datetime import datetime
 log = logging.getLogger(__name__)
 
+# The default interval of the deletion of the expired challenges in seconds
+CLEANUP_INTERVAL = 60
+
+_janitor_lock = threading.Lock()
+_janitor = None
+
 
 @log_with(log)
 def get_challenges(serial=None, transaction_id=None):
     """
-    This returns a list of database challenge objects.
+    This returns a list of database challenge objects. Expired challenges
+    are not returned, even if they were not deleted, yet.
 
     :param serial: challenges for this very serial number
     :param transaction_id: challenges with this very transaction id
     :return: list of objects
     """
-    sql_query = Challenge.query
+    sql_query = Challenge.query.filter(Challenge.expiration > datetime.now())
 
     if serial is not None:
         # filter for serial
@@ -145,3 +163,95 @@ def _create_challenge_query(serial=None, transaction_id=None):
             sql_query = sql_query.filter(Challenge.transaction_id == transaction_id)
 
     return sql_query
+
+
+class ChallengeJanitor(object):
+    """
+    The ChallengeJanitor deletes the expired challenges every interval
+    seconds in a background thread.
+    """
+
+    def __init__(self, app, interval=CLEANUP_INTERVAL):
+        self.app = app
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        # This is called with the _janitor_lock
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run,
+                                           name="ChallengeJanitor")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self, timeout=10):
+        """
+        Stop the thread.
+        """
+        self.stopped.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.cleanup()
+
+    def cleanup(self):
+        """
+        Delete the expired challenges.
+
+        :return: The number of deleted challenges
+        """
+        deleted = 0
+        with self.app.app_context():
+            try:
+                deleted = cleanup_challenges()
+                log.debug("deleted {0!s} expired challenges".format(deleted))
+            except Exception as exx:  # pragma: no cover
+                log.warning("Could not delete the expired challenges: "
+                            "{0!r}".format(exx))
+                log.debug("{0!s}".format(traceback.format_exc()))
+                db.session.rollback()
+            finally:
+                db.session.remove()
+        return deleted
+
+
+def start_challenge_janitor():
+    """
+    Start the ChallengeJanitor of this process, if it is not running. The
+    thread is started lazily with the first challenge, so that each forked
+    worker process starts its own thread.
+
+    The interval is read from PI_CHALLENGE_CLEANUP_INTERVAL. An interval of 0
+    disables the thread.
+
+    :return: The ChallengeJanitor or None
+    """
+    global _janitor
+    interval = float(current_app.config.get("PI_CHALLENGE_CLEANUP_INTERVAL",
+                                            CLEANUP_INTERVAL))
+    if interval <= 0:
+        return None
+    janitor = _janitor
+    if janitor is not None and janitor.thread.is_alive():
+        return janitor
+    with _janitor_lock:
+        if _janitor is None:
+            _janitor = ChallengeJanitor(current_app._get_current_object(),
+                                        interval=interval)
+            atexit.register(_janitor.stop)
+        _janitor.start()
+        return _janitor
+
+
+def stop_challenge_janitor():
+    """
+    Stop the ChallengeJanitor of this process.
+    """
+    global _janitor
+    with _janitor_lock:
+        if _janitor is not None:
+            _janitor.stop()
+            _janitor = None
@@ -1,5 +1,10 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-16 Cache the system config per process and refresh it, if the
+#             revision privacyidea.timestamp changes
+#  2016-10-16 Add revision stamps in the Config table
+#  2016-10-16 Build the class dictionaries only once per process and
+#             allow to register plugin classes
 #  2015-12-12 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Change eval to importlib
 #  2015-04-23 Cornelius Kölbel <cornelius.koelbel@netknigts.it>
@@ -28,14 +33,23 @@ the Config database table.
 
 It provides functions to retrieve (get) and and set configuration.
 
+Each process keeps a snapshot of the complete Config table. The snapshot is
+read again, if the revision "privacyidea.timestamp" in the database changed.
+This revision is bumped by set_privacyidea_config and
+delete_privacyidea_config. During a request the revision is only checked
+once.
+
 The code is tested in tests/test_lib_config
 """
 
 import logging
 import inspect
-from flask import current_app
+import threading
+import time
+from flask import current_app, g, has_request_context
 
 from .log import log_with
+from .error import ConfigAdminError
 from ..models import Config, db
 
 from .crypto import encryptPassword
@@ -43,22 +57,203 @@ from .crypto import decryptPassword
 from .resolvers.UserIdResolver import UserIdResolver
 from .machines.base import BaseMachineResolver
 from .caconnectors.localca import BaseCAConnector
-from datetime import datetime
 import importlib
 
 log = logging.getLogger(__name__)
 
 ENCODING = 'utf-8'
 
+# The dictionaries of the token, resolver, machine resolver and CA connector
+# classes. They are built only once per process.
+_class_registry = {}
+_class_registry_lock = threading.RLock()
+
+# The lists, that are cached in the app config and need to be rebuilt, if a
+# class is registered.
+_APP_CLASS_CACHES = ["pi_resolver_types", "pi_resolver_classes",
+                     "pi_token_types", "pi_token_classes"]
+
+
+def _get_class_registry(name, build_func):
+    """
+    Return the cached entry of the class registry or build it.
+
+    :param name: The name of the registry entry like "token"
+    :param build_func: The function, that builds the entry
+    """
+    with _class_registry_lock:
+        if name not in _class_registry:
+            _class_registry[name] = build_func()
+        return _class_registry[name]
+
+
+def reset_class_registry():
+    """
+    Drop the class registry. The class dictionaries are built again at the
+    next call.
+    """
+    with _class_registry_lock:
+        _class_registry.clear()
+    _reset_app_class_caches()
+
+
+def _reset_app_class_caches():
+    try:
+        for key in _APP_CLASS_CACHES:
+            current_app.config.pop(key, None)
+    except RuntimeError:  # pragma: no cover
+        # We are not running within an application context
+        pass
+
+
+def register_class(klass):
+    """
+    Register a token class, a resolver class, a machine resolver class or a
+    CA connector class, that is e.g. provided by a plugin.
+    A class of the same type, that was registered before, is replaced.
+
+    :param klass: The class to register
+    :return: The type of the registered class like "hotp"
+    :rtype: basestring
+    """
+    from .tokenclass import TokenClass
+    if issubclass(klass, TokenClass):
+        name = "token"
+        class_type = klass.get_class_type()
+        class_dicts = get_token_class_dict()
+    elif issubclass(klass, UserIdResolver):
+        name = "resolver"
+        class_type = klass.getResolverClassType()
+        class_dicts = get_resolver_class_dict()
+    elif issubclass(klass, BaseMachineResolver):
+        name = "machineresolver"
+        class_type = klass.type
+        class_dicts = get_machine_resolver_class_dict()
+    elif issubclass(klass, BaseCAConnector):
+        name = "caconnector"
+        class_type = klass.connector_type
+        class_dicts = get_caconnector_class_dict()
+    else:
+        raise ConfigAdminError("Can not register the class {0!r}".format(
+                               klass))
+
+    class_name = "{0!s}.{1!s}".format(klass.__module__, klass.__name__)
+    with _class_registry_lock:
+        class_dict, type_dict = class_dicts
+        for registered_name, registered_type in type_dict.items():
+            if registered_type == class_type:
+                # replace the former class of this type
+                del type_dict[registered_name]
+                class_dict.pop(registered_name, None)
+        class_dict[class_name] = klass
+        type_dict[class_name] = class_type
+        # The token type index needs to be rebuilt
+        _class_registry.pop("tokentype", None)
+    _reset_app_class_caches()
+    log.info("registered {0!s} class {1!s}".format(name, class_name))
+    return class_type
+
+
+# The key in the Config table, that holds the config revision stamp
+CONFIG_REVISION_KEY = "privacyidea.timestamp"
+
+_config_cache = {"snapshot": None,
+                 "checked": 0}
+_config_cache_lock = threading.Lock()
+
+
+class ConfigSnapshot(object):
+    """
+    The entries of the Config table of one config revision.
+    The values of the type "password" are decrypted, when they are read
+    for the first time.
+    """
+
+    def __init__(self, revision, entries):
+        """
+        :param revision: The config revision
+        :param entries: list of Config database objects
+        """
+        self.revision = revision
+        # The key mapped to the tuple (value, type)
+        self.entries = dict((entry.Key, (entry.Value, entry.Type))
+                            for entry in entries)
+        self._decrypted = {}
+
+    def keys(self, role="admin"):
+        """
+        :return: The keys, that can be read by the given role
+        """
+        return [key for key, (_value, typ) in self.entries.items()
+                if role == "admin" or typ == "public"]
+
+    def has_key(self, key, role="admin"):
+        entry = self.entries.get(key)
+        return entry is not None and (role == "admin" or entry[1] == "public")
+
+    def get_value(self, key):
+        """
+        :return: the value of the key. Passwords are decrypted.
+        """
+        value, typ = self.entries[key]
+        if typ == "password":
+            if key not in self._decrypted:
+                self._decrypted[key] = decryptPassword(value)
+            value = self._decrypted[key]
+        return value
+
+
+def invalidate_config_cache():
+    """
+    Drop the config snapshot of this process. The config is read from the
+    database with the next call of get_from_config.
+    """
+    with _config_cache_lock:
+        _config_cache["snapshot"] = None
+        _config_cache["checked"] = 0
+
+
+def _get_config_snapshot():
+    """
+    Return the snapshot of the config.
+
+    The config is only read from the database, if the config revision in
+    the database differs from the revision of the snapshot.
+    During a request the revision is checked only once. Outside of a
+    request it is checked every PI_CONFIG_CACHE_TIMEOUT seconds. The default
+    is 0, i.e. with each call.
+
+    :return: ConfigSnapshot
+    """
+    snapshot = _config_cache["snapshot"]
+    if snapshot is not None:
+        if has_request_context():
+            if getattr(g, "config_revision", None) == snapshot.revision:
+                return snapshot
+        elif time.time() - _config_cache["checked"] < \
+                current_app.config.get("PI_CONFIG_CACHE_TIMEOUT", 0):
+            return snapshot
+
+    now = time.time()
+    revision = get_revision(CONFIG_REVISION_KEY)
+    if snapshot is None or snapshot.revision != revision:
+        # The revision changed, so we need to reread the config.
+        snapshot = ConfigSnapshot(revision, Config.query.all())
+        log.debug("read {0!s} config entries of revision {1!s}".format(
+            len(snapshot.entries), revision))
+    with _config_cache_lock:
+        _config_cache["snapshot"] = snapshot
+        _config_cache["checked"] = now
+    if has_request_context():
+        g.config_revision = revision
+    return snapshot
+
 
-#@cache.memoize(1)
 def get_privacyidea_config():
-    # timestamp = Config.query.filter_by(Key="privacyidea.timestamp").first()
     return get_from_config()
 
 
 @log_with(log)
-#@cache.memoize(1)
 def get_from_config(key=None, default=None, role="admin"):
     """
     :param key: A key to retrieve
@@ -73,19 +268,16 @@ def get_from_config(key=None, default=None, role="admin"):
     """
     default_true_keys = ["PrependPin", "splitAtSign",
                          "IncFailCountOnFalsePin", "ReturnSamlAttributes"]
-    sql_query = Config.query
+    snapshot = _get_config_snapshot()
     if role != "admin":
-        # set the filter to get only public infos!
+        # get only public infos!
         # We could match for "public", but matching for not "admin" seems to
         # be safer
-        sql_query = sql_query.filter_by(Type="public")
+        role = "public"
 
     if key:
-        sql_query = sql_query.filter_by(Key=key).first()
-        if sql_query:
-            rvalue = sql_query.Value
-            if sql_query.Type == "password":
-                rvalue = decryptPassword(rvalue)
+        if snapshot.has_key(key, role):
+            rvalue = snapshot.get_value(key)
         else:
             if key in default_true_keys:
                 rvalue = "True"
@@ -93,12 +285,8 @@ def get_from_config(key=None, default=None, role="admin"):
                 rvalue = default
     else:
         rvalue = {}
-        sql_query.all()
-        for entry in sql_query:
-            value = entry.Value
-            if entry.Type == "password":
-                value = decryptPassword(value)
-            rvalue[entry.Key] = value
+        for entry_key in snapshot.keys(role):
+            rvalue[entry_key] = snapshot.get_value(entry_key)
         if role == "admin":
             for tkey in default_true_keys:
                 if tkey not in rvalue:
@@ -172,6 +360,13 @@ def get_token_class_dict():
 
     :return: tuple of two dicts
     """
+    return _get_class_registry("token", _build_token_class_dict)
+
+
+def _build_token_class_dict():
+    """
+    Build the dictionaries for get_token_class_dict from the modules.
+    """
     from .tokenclass import TokenClass
 
     tokenclass_dict = {}
@@ -202,19 +397,25 @@ def get_token_class(tokentype):
     :return: The tokenclass for the given type
     :rtype: tokenclass
     """
-    class_dict, type_dict = get_token_class_dict()
-    tokenmodule = ""
     tokenclass = None
-    for module, ttype in type_dict.items():
-        if ttype.lower() == tokentype.lower():
-            tokenmodule = module
-            break
-    if tokenmodule:
-        tokenclass = class_dict.get(tokenmodule)
-
+    if tokentype:
+        tokenclass = _get_class_registry("tokentype",
+                                         _build_token_type_index).get(
+            tokentype.lower())
     return tokenclass
 
 
+def _build_token_type_index():
+    """
+    Build the dictionary of the lowercase token types and the token classes.
+    """
+    class_dict, type_dict = get_token_class_dict()
+    index = {}
+    for module, ttype in type_dict.items():
+        index[ttype.lower()] = class_dict.get(module)
+    return index
+
+
 #@cache.memoize(1)
 def get_token_types():
     """
@@ -289,6 +490,15 @@ def get_machine_resolver_class_dict():
 
     :return: tuple of two dicts
     """
+    return _get_class_registry("machineresolver",
+                               _build_machine_resolver_class_dict)
+
+
+def _build_machine_resolver_class_dict():
+    """
+    Build the dictionaries for get_machine_resolver_class_dict from the
+    modules.
+    """
     resolverclass_dict = {}
     resolvertype_dict = {}
 
@@ -324,6 +534,13 @@ def get_caconnector_class_dict():
 
     :return: tuple of two dicts
     """
+    return _get_class_registry("caconnector", _build_caconnector_class_dict)
+
+
+def _build_caconnector_class_dict():
+    """
+    Build the dictionaries for get_caconnector_class_dict from the modules.
+    """
     class_dict = {}
     type_dict = {}
 
@@ -365,6 +582,13 @@ def get_resolver_class_dict():
 
     :return: tuple of two dicts.
     """
+    return _get_class_registry("resolver", _build_resolver_class_dict)
+
+
+def _build_resolver_class_dict():
+    """
+    Build the dictionaries for get_resolver_class_dict from the modules.
+    """
     resolverclass_dict = {}
     resolverprefix_dict = {}
 
@@ -660,15 +884,9 @@ def set_privacyidea_config(key, value, typ="", desc=""):
         new_entry = Config(key, value, typ, desc)
         db.session.add(new_entry)
         ret = "insert"
-        
-    # Do the timestamp
-    if Config.query.filter_by(Key="__timestamp__").count() > 0:
-        Config.query.filter_by(Key="__timestamp__")\
-            .update({'Value': datetime.now()})
-    else:
-        new_timestamp = Config("__timestamp__", datetime.now())
-        db.session.add(new_timestamp)
-    db.session.commit()
+
+    # Do the timestamp. This commits the config entry.
+    bump_config_revision()
     return ret
 
 
@@ -681,11 +899,70 @@ def delete_privacyidea_config(key):
     q = Config.query.filter_by(Key=key).first()
     if q:
         db.session.delete(q)
-        db.session.commit()
+        # This commits the deletion.
+        bump_config_revision()
         ret = True
     return ret
 
 
+def bump_config_revision():
+    """
+    Increase the config revision stamp in the database and invalidate the
+    config snapshot of this process. Other processes will read the config
+    again, when they notice the new revision.
+
+    :return: the new revision
+    """
+    revision = bump_revision(CONFIG_REVISION_KEY, u"config revision")
+    invalidate_config_cache()
+    return revision
+
+
+def get_revision(key):
+    """
+    Return the revision stamp, that is stored in the Config table with the
+    given key. Revision stamps are used by the process wide caches to
+    detect changes, that were written by other processes or nodes.
+
+    :param key: The key of the revision in the Config table like
+        "__resolver_revision__"
+    :return: the revision or 0, if the revision was never written
+    :rtype: int
+    """
+    entry = Config.query.filter_by(Key=key).first()
+    revision = 0
+    if entry:
+        try:
+            revision = int(entry.Value)
+        except ValueError:  # pragma: no cover
+            log.warning("Invalid revision {0!r} of {1!s}".format(entry.Value,
+                                                                 key))
+    return revision
+
+
+def bump_revision(key, description=u""):
+    """
+    Increase the revision stamp in the Config table and commit it.
+
+    The new revision is at least the current time in microseconds, so that
+    two nodes, that bump the revision at the same time, will most likely
+    not write the same value.
+
+    :param key: The key of the revision in the Config table
+    :param description: The description of the Config entry
+    :return: the new revision
+    :rtype: int
+    """
+    revision = max(get_revision(key) + 1, int(time.time() * 1000000))
+    entry = Config.query.filter_by(Key=key).first()
+    if entry:
+        entry.Value = unicode(revision)
+    else:
+        db.session.add(Config(key, revision, Description=description))
+    db.session.commit()
+    return revision
+
+
 #@cache.memoize(1)
 def get_inc_fail_count_on_false_pin():
     """
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-16 Return a reusable keyed HMAC object from the SecretObj
+#  2016-10-16 Cache the imported RSA keys of the Sign class
+#
 #  privacyIDEA is a fork of LinOTP
 #  May 08, 2014 Cornelius Kölbel
 #  License:  AGPLv3
@@ -52,7 +55,9 @@ except ImportError:
     # Bummer the version of PyCrypto has no PKCS1_15
     SIGN_WITH_RSA = True
 import passlib.hash
+import os
 import sys
+import threading
 import traceback
 
 
@@ -123,6 +128,20 @@ class SecretObj(object):
         self._clearKey_(preserve=self.preserve)
         return h
 
+    def hmac_state(self, hash_algo):
+        """
+        Return a keyed HMAC object, that did not process any data, yet.
+        Copies of this object calculate HMACs with this key without
+        decrypting the key and setting up the HMAC again.
+
+        :param hash_algo: The hash function like hashlib.sha1
+        :return: hmac object
+        """
+        self._setupKey_()
+        h = hmac.new(self.bkey, digestmod=hash_algo)
+        self._clearKey_(preserve=self.preserve)
+        return h
+
     def aes_decrypt(self, data_input):
         '''
         support inplace aes decryption for the yubikey
@@ -586,9 +605,49 @@ def zerome(bufferObject):
     return
 
 
+# The imported RSA keys of the process, keyed by the filename of the key.
+# Each entry is a tuple (mtime, size, PEM data, RSA key object)
+_rsa_key_cache = {}
+_rsa_key_cache_lock = threading.Lock()
+
+
+def get_rsa_key(filename):
+    """
+    Return the PEM data and the imported RSA key from the given key file.
+
+    The key is read and imported only once per process. If the
+    modification time or the size of the file changes, the key is read
+    again.
+
+    :param filename: The name of the PEM file
+    :return: tuple of the PEM data and the RSA key object
+    """
+    try:
+        stat = os.stat(filename)
+    except OSError as exx:
+        # Raise the same error as open() for a missing file
+        raise IOError(exx.errno, exx.strerror, filename)
+    with _rsa_key_cache_lock:
+        entry = _rsa_key_cache.get(filename)
+    if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+        return entry[2], entry[3]
+
+    log.debug("Reading RSA key {0!s}".format(filename))
+    f = open(filename, "r")
+    pem = f.read()
+    f.close()
+    RSAkey = RSA.importKey(pem)
+    with _rsa_key_cache_lock:
+        _rsa_key_cache[filename] = (stat.st_mtime, stat.st_size, pem, RSAkey)
+    return pem, RSAkey
+
+
 class Sign(object):
     """
     Signing class that is used to sign Audit Entries and to sign API responses.
+
+    The imported keys are cached per process, so creating a Sign object and
+    signing does not read and parse the key files again.
     """
     def __init__(self, private_file, public_file):
         """
@@ -598,20 +657,18 @@ class Sign(object):
         :type public_file: filename
         :return: Sign Object
         """
+        self.private_file = private_file
+        self.public_file = public_file
         self.private = ""
         self.public = ""
         try:
-            f = open(private_file, "r")
-            self.private = f.read()
-            f.close()
+            self.private, _key = get_rsa_key(private_file)
         except Exception as e:
             log.error("Error reading private key {0!s}: ({1!r})".format(private_file, e))
             raise e
 
         try:
-            f = open(public_file, "r")
-            self.public = f.read()
-            f.close()
+            self.public, _key = get_rsa_key(public_file)
         except Exception as e:
             log.error("Error reading public key {0!s}: ({1!r})".format(public_file, e))
             raise e
@@ -623,7 +680,7 @@ class Sign(object):
         :return: The signature of the string
         :rtype: long
         """
-        RSAkey = RSA.importKey(self.private)
+        _pem, RSAkey = get_rsa_key(self.private_file)
         if SIGN_WITH_RSA:
             hashvalue = HashFunc.new(s).digest()
             signature = RSAkey.sign(hashvalue, 1)
@@ -639,7 +696,7 @@ class Sign(object):
         """
         r = False
         try:
-            RSAkey = RSA.importKey(self.public)
+            _pem, RSAkey = get_rsa_key(self.public_file)
             signature = long(signature)
             if SIGN_WITH_RSA:
                 hashvalue = HashFunc.new(s).digest()
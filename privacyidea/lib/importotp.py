@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-16 Add the yubikey.prefix of the imported Yubikeys
 #  2016-01-16 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add PSKC import with pre shared key
 #  2015-05-28 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -207,7 +208,8 @@ def parseYubicoCSV(csv):
             serial: {   'type' : yubico,
                         'otpkey' : xxxx,
                         'otplen' : xxx,
-                        'description' : xxx
+                        'description' : xxx,
+                        'yubikey.prefix' : public ID
                          }
         }
     '''
@@ -249,7 +251,8 @@ def parseYubicoCSV(csv):
                     TOKENS[serial] = {'type': ttype,
                                       'otpkey': key,
                                       'otplen': otplen,
-                                      'description': public_id
+                                      'description': public_id,
+                                      'yubikey.prefix': public_id
                                       }
                 elif typ.lower() == "oath-hotp":
                     '''
@@ -305,6 +308,8 @@ def parseYubicoCSV(csv):
                                   'otplen': otplen,
                                   'description': public_id
                                   }
+                if typ == "yubikey" and public_id:
+                    TOKENS[serial]['yubikey.prefix'] = public_id
         else:
             log.warning("the line {0!r} did not contain a enough values".format(line))
             continue
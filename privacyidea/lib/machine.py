@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Only query a machine resolver, if a thread is free
+#  2016-10-17 Query the machine resolvers in parallel threads
 #  2015-02-27 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Initial writup
 #
@@ -27,8 +29,14 @@ tests/test_lib_machines.py.
 It depends on the database model models.py and on the machineresolver
 lib/machineresolver.py, so this can be tested standalone without realms,
 tokens and webservice!
+
+The machine resolvers are queried in parallel by a thread pool of each
+process with PI_MACHINE_RESOLVER_THREADS threads. The machines of a resolver,
+that does not answer within PI_MACHINE_RESOLVER_TIMEOUT seconds, are missing
+in the result. A resolver is only queried, if a thread is free. So resolvers,
+that hang, can not queue up the requests.
 """
-from .machineresolver import get_resolver_list, get_resolver_object
+from .machineresolver import get_resolver_objects
 from privacyidea.models import Token
 from privacyidea.models import (MachineToken, db, MachineTokenOptions,
                                 MachineResolver, get_token_id,
@@ -36,17 +44,70 @@ from privacyidea.models import (MachineToken, db, MachineTokenOptions,
                                 get_machinetoken_id)
 from netaddr import IPAddress
 from sqlalchemy import and_
+from flask import current_app, has_app_context
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
 import logging
+import os
+import threading
+import time
+import traceback
 log = logging.getLogger(__name__)
 from privacyidea.lib.log import log_with
 from privacyidea.lib.applications.base import get_auth_item
 
+# The default number of threads, that query the machine resolvers
+MACHINE_RESOLVER_THREADS = 4
+# The default time in seconds to wait for the machines of a resolver
+MACHINE_RESOLVER_TIMEOUT = 10
+
+# The process id, the thread pool of this process and the semaphore, that
+# counts the free threads
+_thread_pool = (None, None, None)
+_thread_pool_lock = threading.Lock()
+
+
+def _get_thread_pool():
+    """
+    Return the thread pool of this process and the semaphore of its free
+    threads. They are created with the first call in each process, so that
+    forked worker processes do not use the threads of their parent.
+
+    :return: tuple of the ThreadPool and the BoundedSemaphore
+    """
+    global _thread_pool
+    with _thread_pool_lock:
+        pid, pool, free_threads = _thread_pool
+        if pid != os.getpid():
+            size = MACHINE_RESOLVER_THREADS
+            if has_app_context():
+                size = int(current_app.config.get(
+                    "PI_MACHINE_RESOLVER_THREADS", MACHINE_RESOLVER_THREADS))
+            pool = ThreadPool(size)
+            free_threads = threading.BoundedSemaphore(size)
+            _thread_pool = (os.getpid(), pool, free_threads)
+    return pool, free_threads
+
+
+def _get_machines_in_thread(free_threads, reso_obj, **kwargs):
+    """
+    Get the machines of the resolver object and give the thread free
+    afterwards.
+    """
+    try:
+        return reso_obj.get_machines(**kwargs)
+    finally:
+        free_threads.release()
 
 
 @log_with(log)
-def get_machines(hostname=None, ip=None, id=None, resolver=None, any=None):
+def search_machines(hostname=None, ip=None, id=None, resolver=None, any=None):
     """
-    This returns a list of machines from ALL resolvers matching this criterion.
+    This returns a list of machines from ALL resolvers matching this
+    criterion. The resolvers are queried in parallel. If a resolver fails
+    or does not answer within PI_MACHINE_RESOLVER_TIMEOUT seconds, its
+    machines are missing and the name of the resolver is returned as
+    incomplete.
 
     :param hostname: The hostname of the machine, substring matching
     :type hostname: basestring
@@ -58,24 +119,75 @@ def get_machines(hostname=None, ip=None, id=None, resolver=None, any=None):
     :type resolver: basestring
     :param any: a substring, that matches EITHER of hostname, ip or resolver
     :type any: basestring
-    :return: list of Machine Objects.
+    :return: tuple of the list of Machine Objects and the list of the names
+        of the incomplete resolvers
     """
-    resolver_list = get_resolver_list()
+    timeout = MACHINE_RESOLVER_TIMEOUT
+    if has_app_context():
+        timeout = float(current_app.config.get("PI_MACHINE_RESOLVER_TIMEOUT",
+                                               MACHINE_RESOLVER_TIMEOUT))
+    pool, free_threads = _get_thread_pool()
+    results = []
     all_machines = []
-
-    for reso in resolver_list.keys():
+    incomplete = []
+    for reso, reso_obj in get_resolver_objects().items():
         # The resolvernames are the keys of the dictionary
         if resolver and resolver not in reso:
             # filter for other resolvers
             continue
-        reso_obj = get_resolver_object(reso)
-        resolver_machines = reso_obj.get_machines(hostname=hostname,
-                                                  ip=ip,
-                                                  machine_id=id, any=any,
-                                                  substring=True)
-        all_machines += resolver_machines
-
-    return all_machines
+        if not free_threads.acquire(False):
+            # All threads still wait for resolvers, that did not answer
+            log.warning("No free thread to query the machine resolver "
+                        "{0!s}.".format(reso))
+            incomplete.append(reso)
+            continue
+        results.append((reso, pool.apply_async(_get_machines_in_thread,
+                                               (free_threads, reso_obj),
+                                               {"hostname": hostname,
+                                                "ip": ip,
+                                                "machine_id": id,
+                                                "any": any,
+                                                "substring": True})))
+
+    deadline = time.time() + timeout
+    for reso, result in results:
+        try:
+            all_machines += result.get(max(deadline - time.time(), 0))
+        except TimeoutError:
+            log.warning("The machine resolver {0!s} did not answer within "
+                        "{1!s} seconds.".format(reso, timeout))
+            incomplete.append(reso)
+        except Exception as exx:
+            log.warning("Could not get the machines of the machine resolver "
+                        "{0!s}: {1!r}".format(reso, exx))
+            log.debug("{0!s}".format(traceback.format_exc()))
+            incomplete.append(reso)
+
+    return all_machines, incomplete
+
+
+@log_with(log)
+def get_machines(hostname=None, ip=None, id=None, resolver=None, any=None):
+    """
+    This returns a list of machines from ALL resolvers matching this criterion.
+    The machines of resolvers, that fail or do not answer in time, are
+    missing. See search_machines.
+
+    :param hostname: The hostname of the machine, substring matching
+    :type hostname: basestring
+    :param ip: The IPAddress of the machine
+    :type ip: netaddr.IPAddress
+    :param id: The id of the machine, substring matching
+    :type id: basestring
+    :param resolver: The resolver of the machine, substring matching
+    :type resolver: basestring
+    :param any: a substring, that matches EITHER of hostname, ip or resolver
+    :type any: basestring
+    :return: list of Machine Objects.
+    """
+    machines, _incomplete = search_machines(hostname=hostname, ip=ip, id=id,
+                                            resolver=resolver, any=any)
+    return machines
 
 
 def get_hostname(ip):
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Read the machine resolver revision once per request
+#  2016-10-17 Close the replaced machine resolver objects
+#  2016-10-17 Keep the machine resolver objects per process
 #  2015-02-25 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Initial writup
 #
@@ -29,9 +32,15 @@ MachineTestCase.
 Its only dependencies are to the database model.py and to the
 config.py, so this can be tested standalone without realms, tokens and
 webservice!
+
+The machine resolver objects are created once per process and are shared by
+all threads. They are created again, if the machine resolver revision in the
+database changes.
 """
 
 import logging
+import threading
+from flask import g, has_request_context
 from log import log_with
 from ..models import (MachineResolver,
                       MachineResolverConfig)
@@ -39,12 +48,20 @@ from ..api.lib.utils import required
 from ..api.lib.utils import getParam
 from sqlalchemy import func
 from .crypto import encryptPassword, decryptPassword
-from privacyidea.lib.config import get_machine_resolver_class_dict
+from privacyidea.lib.config import (get_machine_resolver_class_dict,
+                                    get_revision, bump_revision)
 from privacyidea.lib.utils import (sanity_name_check, get_data_from_params)
 
 
 log = logging.getLogger(__name__)
 
+# The key in the Config table, that holds the machine resolver revision stamp
+MACHINE_RESOLVER_REVISION_KEY = "__machineresolver_revision__"
+
+# The revision and the machine resolver objects of this process. The objects
+# do not hold connections, so they can be shared by all threads.
+_resolver_objects = (None, {})
+_resolver_objects_lock = threading.Lock()
 
 
 @log_with(log)
@@ -116,6 +133,7 @@ def save_resolver(params):
                               Value=value,
                               Type=types.get(key, ""),
                               Description=desc.get(key, "")).save()
+    bump_machine_resolver_revision()
     return resolver_id
 
 
@@ -175,9 +193,60 @@ def delete_resolver(resolvername):
     if reso:
         reso.delete()
         ret = reso.id
+        bump_machine_resolver_revision()
     return ret
 
 
+def get_machine_resolver_revision():
+    """
+    Return the current machine resolver revision stamp from the database.
+    The revision is bumped each time a machine resolver is written or
+    deleted.
+
+    :return: the revision or 0, if no machine resolver was ever written
+    :rtype: int
+    """
+    return get_revision(MACHINE_RESOLVER_REVISION_KEY)
+
+
+def get_request_machine_resolver_revision():
+    """
+    Return the machine resolver revision stamp. During a request it is read
+    from the database only once.
+
+    :return: the revision or 0, if no machine resolver was ever written
+    :rtype: int
+    """
+    if not has_request_context():
+        return get_machine_resolver_revision()
+    revision = getattr(g, "machine_resolver_revision", None)
+    if revision is None:
+        revision = g.machine_resolver_revision = \
+            get_machine_resolver_revision()
+    return revision
+
+
+def bump_machine_resolver_revision():
+    """
+    Increase the machine resolver revision stamp in the database and drop the
+    machine resolver objects of this process. All other processes create
+    their objects again, when they notice the new revision.
+
+    :return: the new revision
+    :rtype: int
+    """
+    global _resolver_objects
+    revision = bump_revision(MACHINE_RESOLVER_REVISION_KEY,
+                             u"machine resolver revision")
+    if has_request_context():
+        g.machine_resolver_revision = revision
+    with _resolver_objects_lock:
+        _old_revision, old_objects = _resolver_objects
+        _resolver_objects = (None, {})
+    _close_resolver_objects(old_objects)
+    return revision
+
+
 @log_with(log)
 #@cache.memoize(10)
 def get_resolver_config_description(resolver_type):
@@ -238,6 +307,65 @@ def get_resolver_config(resolvername):
     return reso.get(resolvername, {}).get("data", {})
 
 
+def _create_resolver_object(resolvername, resolver):
+    """
+    Create the resolver object from the resolver definition as returned by
+    get_resolver_list.
+    """
+    r_obj = None
+    r_obj_class = get_resolver_class(resolver.get("type"))
+
+    if r_obj_class is None:  # pragma: no cover
+        # This can only happen if a resolver class definition would be
+        # removed.
+        log.error("unknown resolver class for type {0!s} ".format(
+                  resolver.get("type")))
+    else:
+        # create the resolver instance and load the config
+        r_obj = r_obj_class(resolvername, resolver.get("data"))
+    return r_obj
+
+
+def _close_resolver_objects(objects):
+    """
+    Let the replaced resolver objects release their connection pools.
+
+    :param objects: dict of the resolver objects
+    """
+    for r_obj in objects.values():
+        try:
+            r_obj.close()
+        except Exception as exx:  # pragma: no cover
+            log.warning("Could not close machine resolver: "
+                        "{0!r}".format(exx))
+
+
+def get_resolver_objects():
+    """
+    Return the objects of all machine resolvers. The objects are kept per
+    process and are created again, if the machine resolver revision changed.
+    The revision is read once per request.
+
+    :return: dict with the resolver names as keys and the resolver objects
+        as values
+    :rtype: dict
+    """
+    global _resolver_objects
+    revision = get_request_machine_resolver_revision()
+    cached_revision, objects = _resolver_objects
+    if cached_revision != revision:
+        objects = {}
+        for resolvername, resolver in get_resolver_list().items():
+            r_obj = _create_resolver_object(resolvername, resolver)
+            if r_obj is not None:
+                objects[resolvername] = r_obj
+        with _resolver_objects_lock:
+            _old_revision, old_objects = _resolver_objects
+            _resolver_objects = (revision, objects)
+        _close_resolver_objects(old_objects)
+    return objects
+
+
 @log_with(log)
 #@cache.memoize(10)
 def get_resolver_object(resolvername):
@@ -249,22 +377,7 @@ def get_resolver_object(resolvername):
     :return: instance of the resolver with the loaded config
 
     """
-    r_obj = None
-    resolver = get_resolver_list(filter_resolver_name=resolvername).get(
-        resolvername)
-    if resolver:
-        r_obj_class = get_resolver_class(resolver.get("type"))
-
-        if r_obj_class is None:  # pragma: no cover
-            # This can only happen if a resolver class definition would be
-            # removed.
-            log.error("unknown resolver class for type {0!s} ".format(
-                      resolver.get("type")))
-        else:
-            # create the resolver instance and load the config
-            r_obj = r_obj_class(resolvername, resolver.get("data"))
-
-    return r_obj
+    return get_resolver_objects().get(resolvername)
 
 
 @log_with(log)
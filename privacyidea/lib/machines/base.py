@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Add a close hook for replaced resolver objects
 #  2015-02-25 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Initial writup
 #
@@ -116,6 +117,13 @@ class BaseMachineResolver(object):
     def get_type(cls):
         return cls.type
 
+    def close(self):
+        """
+        Hook to release the resources of the resolver like connection pools,
+        when the resolver object is replaced.
+        """
+        return
+
     def get_machines(self, machine_id=None, hostname=None, ip=None, any=None,
                      substring=False):
         """
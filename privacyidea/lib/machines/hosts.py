@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Keep the parsed hosts file with indexes in memory
 #  2015-02-25 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Initial writup
 #
@@ -21,6 +22,9 @@ __doc__ = """This contains the HostsMachineResolver which simply resolves
 the machines in a file like /etc/hosts.
 The machine id is the IP address in this case.
 
+The parsed file is shared by all resolvers of a process. It is parsed again,
+if the modification time or the size of the file changed.
+
 This file is tested in tests/test_lib_machines.py in the class
 HostsMachineTestCase
 """
@@ -30,30 +34,76 @@ from .base import BaseMachineResolver
 from .base import MachineResolverError
 
 import netaddr
+import os
+import threading
+from bisect import bisect_right
 
+# The parsed hosts files of this process, keyed by the absolute file name
+_hosts_indexes = {}
+_hosts_indexes_lock = threading.Lock()
 
-class HostsMachineResolver(BaseMachineResolver):
 
-    type = "hosts"
+class SubstringIndex(object):
+    """
+    The values joined to one text with the sorted start offsets of the
+    values. A substring is searched in the text and the offsets are used to
+    find the entries of the matching values.
+    """
 
-    def get_machines(self, machine_id=None, hostname=None, ip=None, any=None,
-                     substring=False):
+    def __init__(self, values):
         """
-        Return matching machines.
+        :param values: list of tuples of a value and the number of its entry
+        """
+        self.text = "\n".join([value for value, _n in values])
+        self.offsets = []
+        self.entries = []
+        offset = 0
+        for value, n in values:
+            self.offsets.append(offset)
+            self.entries.append(n)
+            offset += len(value) + 1
 
-        :param machine_id: can be matched as substring
-        :param hostname: can be matched as substring
-        :param ip: can not be matched as substring
-        :param substring: Whether the filtering should be a substring matching
-        :type substring: bool
-        :param any: a substring that matches EITHER hostname, machineid or ip
-        :type any: basestring
-        :return: list of Machine Objects
+    def find(self, substring):
         """
-        machines = []
+        :return: the set of the entries, that contain the substring
+        """
+        result = set()
+        if type(substring) == unicode:
+            substring = substring.encode("utf-8")
+        if "\n" in substring or not self.offsets:
+            # The values do not contain whitespace
+            return result
+        start = self.text.find(substring)
+        while start != -1:
+            i = bisect_right(self.offsets, start) - 1
+            result.add(self.entries[i])
+            # continue with the next value
+            if i + 1 >= len(self.offsets):
+                break
+            start = self.text.find(substring, self.offsets[i + 1])
+        return result
+
 
-        f = open(self.filename, "r")
-        try:
+class HostsIndex(object):
+    """
+    The entries of a hosts file with the indexes of the machine ids, the
+    hostnames and the IP addresses.
+    """
+
+    def __init__(self, filename):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        # list of tuples of the machine id, the hostnames and the IP
+        self.entries = []
+        # machine id -> number of the first entry
+        self.ids = {}
+        # hostname -> numbers of the entries
+        self.hostnames = {}
+        # IPAddress -> numbers of the entries
+        self.ips = {}
+        with open(filename, "r") as f:
             for line in f:
                 split_line = line.split()
                 if len(split_line) < 2:
@@ -62,46 +112,118 @@ class HostsMachineResolver(BaseMachineResolver):
                 if split_line[0][0] == "#":
                     # skip comments
                     continue
+                n = len(self.entries)
                 line_id = split_line[0]
                 line_ip = netaddr.IPAddress(split_line[0])
                 line_hostname = split_line[1:]
-                if any:
-                    # check if machineid, ip or hostname matches a substring
-                    if any not in line_id and \
-                        len([x for x in line_hostname if any in x]) <= 0 \
-                            and any not in "{0!s}".format(line_ip):
-                            # "any" was provided but did not match either
-                            # hostname, ip or machine_id
-                            continue
+                self.entries.append((line_id, line_hostname, line_ip))
+                self.ids.setdefault(line_id, n)
+                for hostname in line_hostname:
+                    self.hostnames.setdefault(hostname, []).append(n)
+                self.ips.setdefault(line_ip, []).append(n)
+
+        self.id_substrings = SubstringIndex(
+            [(line_id, n) for n, (line_id, _h, _i) in enumerate(self.entries)])
+        self.hostname_substrings = SubstringIndex(
+            [(hostname, n) for n, (_id, line_hostname, _i)
+             in enumerate(self.entries) for hostname in line_hostname])
+        self.ip_substrings = SubstringIndex(
+            [("{0!s}".format(line_ip), n) for n, (_id, _h, line_ip)
+             in enumerate(self.entries)])
+
+    def is_current(self):
+        """
+        :return: True, if the file was not changed since it was parsed
+        """
+        stat = os.stat(self.filename)
+        return self.mtime == stat.st_mtime and self.size == stat.st_size
+
+    def find_ip(self, ip):
+        """
+        :param ip: The IP address
+        :type ip: netaddr.IPAddress or basestring
+        :return: the set of the entries with this IP address
+        """
+        if type(ip) in [str, unicode]:
+            ip = netaddr.IPAddress(ip)
+        return set(self.ips.get(ip, []))
+
 
+def _intersect(entries, found):
+    """
+    :param entries: the set of entries found so far or None for all entries
+    """
+    if entries is None:
+        return found
+    return entries & found
+
+
+def get_hosts_index(filename):
+    """
+    Return the parsed hosts file of this process. The file is parsed, if it
+    was not parsed, yet, or if its modification time or size changed.
+
+    :param filename: The name of the hosts file
+    :rtype: HostsIndex
+    """
+    filename = os.path.abspath(filename)
+    index = _hosts_indexes.get(filename)
+    if index is None or not index.is_current():
+        with _hosts_indexes_lock:
+            index = _hosts_indexes.get(filename)
+            if index is None or not index.is_current():
+                index = _hosts_indexes[filename] = HostsIndex(filename)
+    return index
+
+
+class HostsMachineResolver(BaseMachineResolver):
+
+    type = "hosts"
+
+    def _get_machine(self, index, n):
+        line_id, line_hostname, line_ip = index.entries[n]
+        return Machine(self.name, line_id, hostname=list(line_hostname),
+                       ip=line_ip)
+
+    def get_machines(self, machine_id=None, hostname=None, ip=None, any=None,
+                     substring=False):
+        """
+        Return matching machines.
+
+        :param machine_id: can be matched as substring
+        :param hostname: can be matched as substring
+        :param ip: can not be matched as substring
+        :param substring: Whether the filtering should be a substring matching
+        :type substring: bool
+        :param any: a substring that matches EITHER hostname, machineid or ip
+        :type any: basestring
+        :return: list of Machine Objects
+        """
+        index = get_hosts_index(self.filename)
+        if any:
+            # check if machineid, ip or hostname matches a substring
+            entries = index.id_substrings.find(any) | \
+                index.hostname_substrings.find(any) | \
+                index.ip_substrings.find(any)
+        else:
+            if machine_id and not substring and machine_id in index.ids:
+                return [self._get_machine(index, index.ids[machine_id])]
+            entries = None
+            if machine_id and substring:
+                entries = _intersect(entries,
+                                     index.id_substrings.find(machine_id))
+            if hostname:
+                if substring:
+                    found = index.hostname_substrings.find(hostname)
                 else:
-                    if machine_id:
-                        if not substring and machine_id == line_id:
-                            return [Machine(self.name, line_id,
-                                            hostname=line_hostname, ip=line_ip)]
-                        if substring and machine_id not in line_id:
-                            # do not append this machine!
-                            continue
-                    if hostname:
-                        if substring:
-                            h_match = len([x for x in line_hostname if hostname in x])
-                        else:
-                            h_match = hostname in line_hostname
-                        if not h_match:
-                            # do not append this machine!
-                            continue
-
-                    if ip:
-                        if ip != line_ip:
-                            # Do not append this machine!
-                            continue
-
-                machines.append(Machine(self.name, line_id,
-                                        hostname=line_hostname,
-                                        ip=line_ip))
-        finally:
-            f.close()
-        return machines
+                    found = set(index.hostnames.get(hostname, []))
+                entries = _intersect(entries, found)
+            if ip:
+                entries = _intersect(entries, index.find_ip(ip))
+            if entries is None:
+                entries = range(len(index.entries))
+
+        return [self._get_machine(index, n) for n in sorted(entries)]
 
     def get_machine_id(self, hostname=None, ip=None):
         """
@@ -118,12 +240,16 @@ class HostsMachineResolver(BaseMachineResolver):
         :return: The machine ID, which depends on the resolver
         :rtype: basestring
         """
-        machines = self.get_machines()
-        for machine in machines:
-            h_match = not hostname or machine.has_hostname(hostname)
-            i_match = not ip or machine.has_ip(ip)
-            if h_match and i_match:
-                return machine.id
+        index = get_hosts_index(self.filename)
+        entries = None
+        if hostname:
+            entries = set(index.hostnames.get(hostname, []))
+        if ip:
+            entries = _intersect(entries, index.find_ip(ip))
+        if entries is None:
+            entries = [0] if index.entries else []
+        if entries:
+            return index.entries[min(entries)][0]
 
         return
 
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Use the LDAP connection pools of the LDAP resolver
+#  2016-10-17 Close the connection pool of a replaced resolver object
 #  2015-03-02 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Initial writup
 #
@@ -28,6 +30,10 @@ The computer objects are identified by
 
 The machine id can be the DN or the objectSid in this case.
 
+The bound connections are kept in the connection pools of the LDAP resolver
+module and are shared with the LDAP resolvers, that use the same servers and
+service account.
+
 This file is tested in tests/test_lib_machine_resolver_ldap.py in the class
 LdapMachineTestCase
 """
@@ -39,8 +45,14 @@ import ldap3
 import netaddr
 import traceback
 import logging
+from ldap3.core.exceptions import LDAPCommunicationError
 from privacyidea.lib.resolvers.LDAPIdResolver import AUTHTYPE
 from privacyidea.lib.resolvers.LDAPIdResolver import IdResolver
+from privacyidea.lib.resolvers.LDAPIdResolver import (get_connection_pool,
+                                                      release_connection_pools,
+                                                      pooled_connection,
+                                                      POOL_SIZE,
+                                                      POOL_MAX_AGE)
 from gettext import gettext as _
 
 log = logging.getLogger(__name__)
@@ -51,24 +63,57 @@ class LdapMachineResolver(BaseMachineResolver):
     type = "ldap"
 
     def __init__(self, name, config=None):
-        self.i_am_bound = False
         self.name = name
         if config:
             self.load_config(config)
 
-    def _bind(self):
-        if not self.i_am_bound:
-            server_pool = IdResolver.get_serverpool(self.uri, self.timeout)
-            self.l = IdResolver.create_connection(authtype=self.authtype,
-                                                  server=server_pool,
-                                                  user=self.binddn,
-                                                  password=self.bindpw,
-                                                  auto_referrals=not
-                                                  self.noreferrals)
-            self.l.open()
-            if not self.l.bind():
-                raise Exception("Wrong credentials")
-            self.i_am_bound = True
+    def _create_connection(self):
+        """
+        Create a connection, that is bound with the service account.
+        """
+        server_pool = IdResolver.get_serverpool(self.uri, self.timeout)
+        l = IdResolver.create_connection(authtype=self.authtype,
+                                         server=server_pool,
+                                         user=self.binddn,
+                                         password=self.bindpw,
+                                         auto_referrals=not
+                                         self.noreferrals)
+        l.open()
+        if not l.bind():
+            raise Exception("Wrong credentials")
+        return l
+
+    def _search(self, **kwargs):
+        """
+        Search in the LDAP directory with a pooled connection. If the server
+        closed the connection, the search is repeated once with a new
+        connection.
+
+        :param kwargs: The parameters of the search
+        :return: list of the found entries
+        """
+        pool = get_connection_pool(("machineresolver", self.name, "search"),
+                                   (self.binddn, self.bindpw, self.uri,
+                                    self.authtype, self.timeout,
+                                    bool(self.noreferrals)),
+                                   POOL_SIZE, POOL_MAX_AGE)
+        for attempt in [1, 2]:
+            try:
+                with pooled_connection(pool, self._create_connection) as l:
+                    l.search(**kwargs)
+                    return l.response
+            except LDAPCommunicationError as exx:
+                if attempt > 1:
+                    raise
+                log.warning("Repeating the LDAP search with a new "
+                            "connection: {0!r}".format(exx))
+
+    def close(self):
+        """
+        Close the connection pool of this machine resolver.
+        """
+        release_connection_pools(lambda owner, key: owner[:2] ==
+                                 ("machineresolver", self.name))
 
     def _get_uid(self, entry):
         if type(entry.get(self.id_attribute)) == list:
@@ -127,7 +172,6 @@ class LdapMachineResolver(BaseMachineResolver):
         :return: list of Machine Objects
         """
         machines = []
-        self._bind()
         attributes = []
         if self.id_attribute.lower() != "dn":
             attributes.append(self.id_attribute)
@@ -142,13 +186,13 @@ class LdapMachineResolver(BaseMachineResolver):
                                           self.ip_attribute, ip,
                                           substring, any)
 
-        self.l.search(search_base=self.basedn,
-                      search_scope=ldap3.SUBTREE,
-                      search_filter=filter,
-                      attributes=attributes,
-                      paged_size=self.sizelimit)
+        response = self._search(search_base=self.basedn,
+                                search_scope=ldap3.SUBTREE,
+                                search_filter=filter,
+                                attributes=attributes,
+                                paged_size=self.sizelimit)
         # returns a list of dictionaries
-        for entry in self.l.response:
+        for entry in response:
             dn = entry.get("dn")
             attributes = entry.get("attributes")
             try:
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+#  2016-10-17 Move the index of a token forward, when its counter advances
+#  2016-10-17 Keep the OTP index in the database and fill it by a job
+#  2016-10-16 Index of the OTP values of the event based tokens to find
+#             the token of a given OTP value
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+__doc__ = """
+The OTP index maps the OTP values of the next counters of the event based
+tokens to these tokens. It is used by lib.token.get_token_by_otp, so that the
+token of an OTP value can be found with an indexed query instead of
+calculating the OTP values of all tokens.
+
+The index is the database table "otpindex". It does not contain the OTP
+values but their digests, that are keyed with PI_PEPPER. It is filled by the
+job "pi-manage otpindex update" outside of the requests. When the counter of
+an indexed token advances, its index is moved forward by the same number of
+counters, so that the token stays in the index between the runs of the job.
+
+A token is answered by the index, as long as the index contains its current
+counter and the counters of the requested look ahead window. All other tokens
+still need to be checked by calculating their OTP values.
+
+This module is tested in tests/test_lib_otpindex.py
+"""
+
+import hashlib
+import hmac
+import logging
+from flask import current_app
+from sqlalchemy import and_, or_, not_, exists, func
+from privacyidea.lib.config import get_token_classes
+from privacyidea.lib.tokens.HMAC import HmacOtp
+from privacyidea.lib.utils import to_utf8
+from privacyidea.models import Token, OTPIndex, db, commit_session
+
+log = logging.getLogger(__name__)
+
+# The number of counters of each token, that are added to the index
+OTP_INDEX_WINDOW = 100
+# The number of tokens, that are read and updated at once
+CHUNK_SIZE = 100
+
+
+def get_otp_digest(otp):
+    """
+    Return the digest of an OTP value, that is stored in the index.
+
+    :param otp: The OTP value
+    :return: The hex digest
+    :rtype: unicode
+    """
+    key = current_app.config.get("PI_PEPPER", "missing")
+    return unicode(hmac.new(to_utf8(key), to_utf8(otp),
+                            hashlib.sha256).hexdigest())
+
+
+def get_indexed_types():
+    """
+    :return: The token types, whose OTP values are added to the index
+    :rtype: list
+    """
+    return [token_class.get_class_type()
+            for token_class in get_token_classes()
+            if token_class.otp_index]
+
+
+def filter_otp_candidates(sql_query, otp, window=10):
+    """
+    Restrict a token query to the tokens, that create the given OTP value
+    within the window according to the index.
+
+    :param sql_query: A query of the table token
+    :param otp: The OTP value
+    :param window: The look ahead window of the counter
+    :return: The restricted query
+    """
+    return sql_query.join(OTPIndex, OTPIndex.token_id == Token.id).filter(
+        OTPIndex.digest == get_otp_digest(otp),
+        OTPIndex.counter >= Token.count,
+        OTPIndex.counter < Token.count + window)
+
+
+def filter_not_indexed(sql_query, window=10):
+    """
+    Restrict a token query to the tokens, that can not be answered by the
+    index. These are the tokens of other types and the tokens, whose current
+    counter or whose window is not in the index.
+
+    :param sql_query: A query of the table token
+    :param window: The look ahead window of the counter
+    :return: The restricted query
+    """
+    first = exists().where(and_(OTPIndex.token_id == Token.id,
+                                OTPIndex.counter == Token.count))
+    last = exists().where(and_(OTPIndex.token_id == Token.id,
+                               OTPIndex.counter == Token.count + window - 1))
+    return sql_query.filter(or_(not_(Token.tokentype.in_(get_indexed_types())),
+                                not_(first), not_(last)))
+
+
+def iter_token_chunks(sql_query, chunk_size=CHUNK_SIZE, for_update=False):
+    """
+    Read the tokens of a query in chunks ordered by their id, so that not all
+    tokens are loaded at once.
+
+    :param sql_query: A query of the table token
+    :param chunk_size: The number of tokens in a chunk
+    :param for_update: Lock the tokens of a chunk
+    :return: generator of lists of Token objects
+    """
+    last_id = 0
+    while True:
+        chunk_query = sql_query.filter(Token.id > last_id).order_by(
+            Token.id).limit(chunk_size)
+        if for_update:
+            chunk_query = chunk_query.with_for_update()
+        db_tokens = chunk_query.all()
+        if not db_tokens:
+            break
+        last_id = db_tokens[-1].id
+        yield db_tokens
+
+
+def _get_index_entries(tokenobject, counters):
+    """
+    Calculate the index entries of the given counters of a token.
+
+    :return: list of dicts, that can be inserted into the table otpindex
+    """
+    _counter, otplen, hashlib_name = tokenobject.get_hotp_parameters()
+    hmac_otp = HmacOtp(tokenobject.token.get_otpkey(), digits=otplen,
+                       hashfunc=tokenobject.get_hashlib(hashlib_name))
+    return [{"token_id": tokenobject.token.id,
+             "counter": counter,
+             "digest": get_otp_digest(hmac_otp.generate(counter=counter,
+                                                        inc_counter=False))}
+            for counter in counters]
+
+
+def update_otp_index(window=OTP_INDEX_WINDOW, chunk_size=CHUNK_SIZE):
+    """
+    Add the next counters of all event based tokens to the index and remove
+    the counters, that were already used. This is run by the job
+    "pi-manage otpindex update".
+
+    :param window: The number of counters of each token in the index
+    :param chunk_size: The number of tokens, that are updated with one commit
+    :return: The number of tokens, whose index was updated
+    :rtype: int
+    """
+    token_classes = dict((token_class.get_class_type(), token_class)
+                         for token_class in get_token_classes()
+                         if token_class.otp_index)
+    updated = 0
+    # The tokens of a chunk are locked, since advance_otp_index adds index
+    # entries during the authentication.
+    for db_tokens in iter_token_chunks(
+            Token.query.filter(Token.tokentype.in_(token_classes.keys())),
+            chunk_size, for_update=True):
+        indexed = {}
+        for token_id, counter in db.session.query(
+                OTPIndex.token_id, OTPIndex.counter).filter(
+                OTPIndex.token_id.in_([t.id for t in db_tokens])):
+            indexed.setdefault(token_id, set()).add(counter)
+        entries = []
+        for db_token in db_tokens:
+            tokenobject = token_classes[db_token.tokentype.lower()](db_token)
+            counter = int(db_token.count)
+            counters = indexed.get(db_token.id, set())
+            if counters and min(counters) < counter:
+                OTPIndex.query.filter(OTPIndex.token_id == db_token.id,
+                                      OTPIndex.counter < counter).delete()
+            missing = [c for c in xrange(counter, counter + window)
+                       if c not in counters]
+            if missing:
+                entries.extend(_get_index_entries(tokenobject, missing))
+                updated += 1
+        if entries:
+            db.session.execute(OTPIndex.__table__.insert(), entries)
+        db.session.commit()
+        log.debug("updated the OTP index up to token "
+                  "{0!s}".format(db_tokens[-1].id))
+    return updated
+
+
+def advance_otp_index(tokenobject):
+    """
+    Move the index of a token forward to its new counter. The index entries
+    of the used counters are removed and the same number of new counters is
+    added. This is called, when the counter of the token advances.
+    A token, that is not in the index, is left to the job.
+
+    :param tokenobject: The token object with the new counter
+    """
+    token_id = tokenobject.token.id
+    count = int(tokenobject.token.count)
+    first, last = db.session.query(func.min(OTPIndex.counter),
+                                   func.max(OTPIndex.counter)).filter(
+        OTPIndex.token_id == token_id).one()
+    if first is None or first >= count:
+        return
+    OTPIndex.query.filter(OTPIndex.token_id == token_id,
+                          OTPIndex.counter < count).delete(
+        synchronize_session=False)
+    counters = range(max(last + 1, count), count + last + 1 - first)
+    if counters:
+        db.session.execute(OTPIndex.__table__.insert(),
+                           _get_index_entries(tokenobject, counters))
+    commit_session()
+
+
+def remove_from_otp_index(token_id):
+    """
+    Remove a token from the index. This is called, when the OTP key or the
+    algorithm of the token changes.
+
+    :param token_id: The database id of the token
+    """
+    if token_id:
+        OTPIndex.query.filter(OTPIndex.token_id == token_id).delete()
+        commit_session()
+
+
+def clear_otp_index():
+    """
+    Remove all tokens from the index.
+    """
+    OTPIndex.query.delete()
+    db.session.commit()
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-16 Cache the parsed policies per process and invalidate
+#             them by a policy revision stamp
 #  2016-02-22 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Add RADIUS passthru policy
 #  2016-02-05 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -119,10 +121,14 @@ from configobj import ConfigObj
 from netaddr import IPAddress
 from netaddr import IPNetwork
 from gettext import gettext as _
+from flask import current_app
 
 import logging
+import threading
+import time
 from ..models import (Policy, db)
-from privacyidea.lib.config import (get_token_classes, get_token_types)
+from privacyidea.lib.config import (get_token_classes, get_token_types,
+                                    get_revision, bump_revision)
 from privacyidea.lib.error import ParameterError, PolicyError
 from privacyidea.lib.realm import get_realms
 from privacyidea.lib.resolver import get_resolver_list
@@ -265,6 +271,384 @@ class AUTOASSIGNVALUE(object):
     NONE = "any_pin"
 
 
+# The key in the Config table, that holds the policy revision stamp
+POLICY_REVISION_KEY = "__policy_revision__"
+
+# The process wide cache of the parsed policies.
+_policy_cache = {"revision": None,
+                 "checked": 0,
+                 "matcher": None}
+_policy_cache_lock = threading.Lock()
+
+
+def get_policy_revision():
+    """
+    Return the current policy revision stamp from the database.
+    The revision is a monotonically increasing integer, that is bumped
+    each time a policy is written or deleted.
+
+    :return: the revision or 0, if no policy was ever written
+    :rtype: int
+    """
+    return get_revision(POLICY_REVISION_KEY)
+
+
+def bump_policy_revision():
+    """
+    Increase the policy revision stamp in the database and invalidate the
+    policy cache of this process.
+    Other processes will notice the new revision the next time they check
+    the revision.
+
+    :return: the new revision
+    :rtype: int
+    """
+    revision = bump_revision(POLICY_REVISION_KEY, u"policy revision")
+    invalidate_policy_cache()
+    return revision
+
+
+def invalidate_policy_cache():
+    """
+    Drop the cached policies of this process. The next PolicyClass will read
+    the policies from the database.
+    """
+    with _policy_cache_lock:
+        _policy_cache["revision"] = None
+        _policy_cache["checked"] = 0
+        _policy_cache["matcher"] = None
+
+
+_EMPTY_SET = frozenset()
+
+
+def _match_client(client, policy_clients):
+    """
+    Check if the client IP matches the client definition of a policy.
+
+    Client IPs may be direct match, may be located in subnets or may
+    be excluded by a leading "-" or "!" sign.
+    The client definition in the policy may ba a comma separated list.
+    It may start with a "-" or a "!" to exclude the client
+    from a subnet.
+    Thus a client 10.0.0.2 matches a policy "10.0.0.0/8, -10.0.0.1" but
+    the client 10.0.0.1 does not match the policy "10.0.0.0/8, -10.0.0.1".
+
+    :param client: The IP address of the client
+    :param policy_clients: The list of the clients of the policy
+    :return: True, if the client was contained in the defined subnets and was
+        not excluded
+    """
+    client_found = False
+    client_excluded = False
+    for polclient in policy_clients:
+        if polclient[0] in ['-', '!']:
+            # exclude the client?
+            if IPAddress(client) in IPNetwork(polclient[1:]):
+                log.debug("the client %s is excluded by %s" % (client,
+                                                               polclient))
+                client_excluded = True
+        elif IPAddress(client) in IPNetwork(polclient):
+            client_found = True
+    return client_found and not client_excluded
+
+
+def filter_policies(policies, name=None, scope=None, realm=None, active=None,
+                    resolver=None, user=None, client=None, action=None,
+                    adminrealm=None):
+    """
+    Filter the list of policies linearly by the given filter values.
+    This is the reference implementation of the PolicyMatcher. The
+    parameters are the same as in PolicyClass.get_policies.
+
+    :param policies: list of policy dicts
+    :return: list of policies
+    :rtype: list of dicts
+    """
+    reduced_policies = policies
+
+    # Do exact matches for "name", "active" and "scope", as these fields
+    # can only contain one entry
+    p = [("name", name), ("active", active), ("scope", scope)]
+    for searchkey, searchvalue in p:
+        if searchvalue is not None:
+            new_policies = []
+            for policy in reduced_policies:
+                if policy.get(searchkey) == searchvalue:
+                    new_policies.append(policy)
+            reduced_policies = new_policies
+
+    p = [("action", action), ("user", user), ("resolver", resolver),
+         ("realm", realm)]
+    # If this is an admin-policy, we also do check the adminrealm
+    if scope == "admin":
+        p.append(("adminrealm", adminrealm))
+    for searchkey, searchvalue in p:
+        if searchvalue is not None:
+            new_policies = []
+            # first we find policies, that really match!
+            # Either with the real value or with a "*"
+            # values can be excluded by a leading "!" or "-"
+            for policy in reduced_policies:
+                value_found = False
+                value_excluded = False
+                # iterate through the list of values:
+                for value in policy.get(searchkey):
+                    if value and value[0] in ["!", "-"] and \
+                                    searchvalue == value[1:]:
+                        value_excluded = True
+                    elif value in [searchvalue, "*"]:
+                        value_found = True
+                if value_found and not value_excluded:
+                    new_policies.append(policy)
+            # We also find the policies with no distinct information
+            # about the request value
+            for policy in reduced_policies:
+                if not policy.get(searchkey):
+                    new_policies.append(policy)
+            reduced_policies = new_policies
+
+    # Match the client IP.
+    # An empty client definition in the policy matches all clients.
+    if client is not None:
+        new_policies = []
+        for policy in reduced_policies:
+            if _match_client(client, policy.get("client")):
+                new_policies.append(policy)
+
+        # If there is a policy without any client, we also add it to the
+        # accepted list.
+        for policy in reduced_policies:
+            if not policy.get("client"):
+                new_policies.append(policy)
+        reduced_policies = new_policies
+
+    return reduced_policies
+
+
+class _ValueIndex(object):
+    """
+    Inverted index of a comma separated policy attribute like "realm",
+    "resolver", "user", "adminrealm" or "action".
+    The entries of the index are the positions of the policies in the policy
+    list.
+    """
+
+    def __init__(self):
+        # policies without any value in this attribute
+        self.empty = set()
+        # policies, that contain the wildcard "*"
+        self.wildcard = set()
+        # value -> policies, that contain this value
+        self.include = {}
+        # value -> policies, that exclude this value with "!" or "-"
+        self.exclude = {}
+
+    def add(self, position, values):
+        if not values:
+            self.empty.add(position)
+        for value in values:
+            if value == "*":
+                self.wildcard.add(position)
+                continue
+            if value and value[0] in ["!", "-"]:
+                self.exclude.setdefault(value[1:], set()).add(position)
+            self.include.setdefault(value, set()).add(position)
+
+    def match(self, candidates, searchvalue):
+        """
+        Return the candidates, that match the searchvalue.
+        """
+        found = (candidates & self.include.get(searchvalue, _EMPTY_SET)) | \
+                (candidates & self.wildcard)
+        found -= self.exclude.get(searchvalue, _EMPTY_SET)
+        return found | (candidates & self.empty)
+
+
+class _ClientIndex(object):
+    """
+    Index of the client definitions of the policies.
+
+    Each client network is stored under its IP version, prefix length and
+    network prefix. A client IP is looked up by cutting its address to each
+    prefix length, that is used in any policy, so that the cost of a lookup
+    does not depend on the number of policies.
+    """
+
+    def __init__(self):
+        self.empty = set()
+        # policies, that contain client definitions, that we can not parse.
+        # These are evaluated by _match_client.
+        self.unparsed = set()
+        self.prefixes = set()
+        self.include = {}
+        self.exclude = {}
+
+    @staticmethod
+    def _key(ip, prefixlen):
+        width = 32 if ip.version == 4 else 128
+        return ip.version, prefixlen, int(ip) >> (width - prefixlen)
+
+    def add(self, position, clients):
+        if not clients:
+            self.empty.add(position)
+            return
+        try:
+            entries = []
+            for polclient in clients:
+                if polclient[0] in ['-', '!']:
+                    entries.append((self.exclude, IPNetwork(polclient[1:])))
+                else:
+                    entries.append((self.include, IPNetwork(polclient)))
+        except Exception as exx:
+            log.warning("Can not parse client definition {0!r}: "
+                        "{1!r}".format(clients, exx))
+            self.unparsed.add(position)
+            return
+        for index, network in entries:
+            self.prefixes.add((network.version, network.prefixlen))
+            key = self._key(network.network, network.prefixlen)
+            index.setdefault(key, set()).add(position)
+
+    def match(self, candidates, client, policies):
+        """
+        Return the candidates, that match the client IP.
+        """
+        matching = candidates & self.empty
+        if not candidates - matching:
+            return matching
+        ip = IPAddress(client)
+        found = set()
+        excluded = set()
+        for version, prefixlen in self.prefixes:
+            if version == ip.version:
+                key = self._key(ip, prefixlen)
+                found |= self.include.get(key, _EMPTY_SET)
+                excluded |= self.exclude.get(key, _EMPTY_SET)
+        matching |= (candidates & found) - excluded
+        for position in candidates & self.unparsed:
+            if _match_client(client, policies[position].get("client")):
+                matching.add(position)
+        return matching
+
+
+class PolicyMatcher(object):
+    """
+    The PolicyMatcher holds a list of parsed policies together with indexes
+    on all attributes, that are used in PolicyClass.get_policies.
+
+    The policies are bucketed by name, active and scope. The comma
+    separated attributes action, user, resolver, realm and adminrealm get an
+    inverted index, that also handles the wildcard "*" and the exclusions
+    with "!" and "-". The client networks are parsed only once.
+
+    The matcher returns the same policies in the same order as
+    filter_policies.
+    """
+
+    EXACT_KEYS = ["name", "active", "scope"]
+    VALUE_KEYS = ["action", "user", "resolver", "realm", "adminrealm"]
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.exact = dict((key, {}) for key in self.EXACT_KEYS)
+        self.values = dict((key, _ValueIndex()) for key in self.VALUE_KEYS)
+        self.clients = _ClientIndex()
+        for position, policy in enumerate(policies):
+            for key in self.EXACT_KEYS:
+                self.exact[key].setdefault(policy.get(key),
+                                           set()).add(position)
+            for key in self.VALUE_KEYS:
+                self.values[key].add(position, policy.get(key) or [])
+            self.clients.add(position, policy.get("client"))
+
+    def get_policies(self, name=None, scope=None, realm=None, active=None,
+                     resolver=None, user=None, client=None, action=None,
+                     adminrealm=None):
+        """
+        Return the policies of the given filter values. The parameters are
+        the same as in PolicyClass.get_policies.
+
+        :return: list of policies
+        :rtype: list of dicts
+        """
+        filters = [("action", action), ("user", user),
+                   ("resolver", resolver), ("realm", realm)]
+        if scope == "admin":
+            filters.append(("adminrealm", adminrealm))
+        filters = [(key, value) for key, value in filters if value is not None]
+        exact = [(key, value) for key, value in [("name", name),
+                                                 ("active", active),
+                                                 ("scope", scope)]
+                 if value is not None]
+        if not exact and not filters and client is None:
+            return list(self.policies)
+
+        buckets = [self.exact[key].get(value, _EMPTY_SET)
+                   for key, value in exact]
+        if buckets:
+            buckets.sort(key=len)
+            candidates = set(buckets[0])
+            for bucket in buckets[1:]:
+                candidates &= bucket
+        else:
+            candidates = set(range(len(self.policies)))
+
+        applied = []
+        for key, value in filters:
+            if not candidates:
+                break
+            candidates = self.values[key].match(candidates, value)
+            applied.append(self.values[key])
+        if client is not None and candidates:
+            candidates = self.clients.match(candidates, client, self.policies)
+            applied.append(self.clients)
+
+        # filter_policies puts the policies with an empty attribute behind
+        # the policies, that matched the attribute. We return the policies
+        # in the very same order.
+        applied.reverse()
+        positions = sorted(candidates,
+                           key=lambda pos: [pos in idx.empty
+                                            for idx in applied] + [pos])
+        return [self.policies[pos] for pos in positions]
+
+
+def _get_cached_policies():
+    """
+    Return the PolicyMatcher of the parsed policies.
+
+    The policies are only read from the database, if the policy revision
+    in the database differs from the cached revision.
+    The revision itself is only checked every PI_POLICY_CACHE_TIMEOUT
+    seconds. The default is 0, i.e. the revision is checked with each call.
+
+    :return: PolicyMatcher
+    """
+    timeout = current_app.config.get("PI_POLICY_CACHE_TIMEOUT", 0)
+    now = time.time()
+    with _policy_cache_lock:
+        if _policy_cache["revision"] is not None and \
+                now - _policy_cache["checked"] < timeout:
+            return _policy_cache["matcher"]
+
+    revision = get_policy_revision()
+    with _policy_cache_lock:
+        if _policy_cache["revision"] == revision:
+            _policy_cache["checked"] = now
+            return _policy_cache["matcher"]
+
+    # The revision changed, so we need to reread the policies.
+    matcher = PolicyMatcher([pol.get() for pol in Policy.query.all()])
+    with _policy_cache_lock:
+        _policy_cache["revision"] = revision
+        _policy_cache["checked"] = now
+        _policy_cache["matcher"] = matcher
+    log.debug("read {0!s} policies of revision {1!s}".format(
+        len(matcher.policies), revision))
+    return matcher
+
+
 class PolicyClass(object):
 
     """
@@ -276,15 +660,49 @@ class PolicyClass(object):
 
     def __init__(self):
         """
-        Create the Policy_Object from the database table
+        Create the Policy_Object from the process wide policy cache.
+        The cache is reread from the database table, if the policy revision
+        has changed.
+        """
+        self.matcher = _get_cached_policies()
+        self.policies = self.matcher.policies
+        # The same lookups are done several times during one request. So we
+        # remember the results of get_policies and get_action_values.
+        self._memo = {}
+        self.memo_hits = 0
+        self.memo_misses = 0
+
+    def _memoize(self, key, func):
+        """
+        Return the result of func() from the memo of this object or
+        calculate and remember it.
 
+        :param key: The normalized arguments of the lookup
+        :param func: The function, that calculates the result
+        :return: a copy of the result list
         """
-        self.policies = []
-        # read the policies from the database and store it in the object
-        policies = Policy.query.all()
-        for pol in policies:
-            # read each policy
-            self.policies.append(pol.get())
+        try:
+            result = self._memo.get(key)
+        except TypeError:  # pragma: no cover
+            # unhashable arguments can not be memoized
+            return func()
+        if result is None:
+            self.memo_misses += 1
+            result = func()
+            self._memo[key] = result
+        else:
+            self.memo_hits += 1
+        return list(result)
+
+    def get_memo_stats(self):
+        """
+        Return the number of lookups, that were answered from the memo of
+        this object and the number of lookups, that were calculated.
+
+        :return: dict with the keys "hits" and "misses"
+        """
+        return {"hits": self.memo_hits,
+                "misses": self.memo_misses}
 
     def get_policies(self, name=None, scope=None, realm=None, active=None,
                      resolver=None, user=None, client=None, action=None,
@@ -305,85 +723,15 @@ class PolicyClass(object):
         :return: list of policies
         :rtype: list of dicts
         """
-        reduced_policies = self.policies
-
-        # Do exact matches for "name", "active" and "scope", as these fields
-        # can only contain one entry
-        p = [("name", name), ("active", active), ("scope", scope)]
-        for searchkey, searchvalue in p:
-            if searchvalue is not None:
-                new_policies = []
-                for policy in reduced_policies:
-                    if policy.get(searchkey) == searchvalue:
-                        new_policies.append(policy)
-                reduced_policies = new_policies
-
-        p = [("action", action), ("user", user), ("resolver", resolver),
-             ("realm", realm)]
-        # If this is an admin-policy, we also do check the adminrealm
-        if scope == "admin":
-            p.append(("adminrealm", adminrealm))
-        for searchkey, searchvalue in p:
-            if searchvalue is not None:
-                new_policies = []
-                # first we find policies, that really match!
-                # Either with the real value or with a "*"
-                # values can be excluded by a leading "!" or "-"
-                for policy in reduced_policies:
-                    value_found = False
-                    value_excluded = False
-                    # iterate through the list of values:
-                    for value in policy.get(searchkey):
-                        if value and value[0] in ["!", "-"] and \
-                                        searchvalue == value[1:]:
-                            value_excluded = True
-                        elif value in [searchvalue, "*"]:
-                            value_found = True
-                    if value_found and not value_excluded:
-                        new_policies.append(policy)
-                # We also find the policies with no distinct information
-                # about the request value
-                for policy in reduced_policies:
-                    if not policy.get(searchkey):
-                        new_policies.append(policy)
-                reduced_policies = new_policies
-
-        # Match the client IP.
-        # Client IPs may be direct match, may be located in subnets or may
-        # be excluded by a leading "-" or "!" sign.
-        # The client definition in the policy may ba a comma separated list.
-        # It may start with a "-" or a "!" to exclude the client
-        # from a subnet.
-        # Thus a client 10.0.0.2 matches a policy "10.0.0.0/8, -10.0.0.1" but
-        # the client 10.0.0.1 does not match the policy "10.0.0.0/8, -10.0.0.1".
-        # An empty client definition in the policy matches all clients.
-        if client is not None:
-            new_policies = []
-            for policy in reduced_policies:
-                client_found = False
-                client_excluded = False
-                for polclient in policy.get("client"):
-                    if polclient[0] in ['-', '!']:
-                        # exclude the client?
-                        if IPAddress(client) in IPNetwork(polclient[1:]):
-                            log.debug("the client %s is excluded by %s in "
-                                      "policy %s" % (client, polclient, policy))
-                            client_excluded = True
-                    elif IPAddress(client) in IPNetwork(polclient):
-                        client_found = True
-                if client_found and not client_excluded:
-                    # The client was contained in the defined subnets and was
-                    #  not excluded
-                    new_policies.append(policy)
-
-            # If there is a policy without any client, we also add it to the
-            # accepted list.
-            for policy in reduced_policies:
-                if not policy.get("client"):
-                    new_policies.append(policy)
-            reduced_policies = new_policies
-
-        return reduced_policies
+        if scope != "admin":
+            # The adminrealm is only evaluated in the admin scope
+            adminrealm = None
+        key = ("policies", name, scope, realm, active, resolver, user,
+               client, action, adminrealm)
+        return self._memoize(key, lambda: self.matcher.get_policies(
+            name=name, scope=scope, realm=realm, active=active,
+            resolver=resolver, user=user, client=client, action=action,
+            adminrealm=adminrealm))
 
     def get_action_values(self, action, scope=SCOPE.AUTHZ, realm=None,
                           resolver=None, user=None, client=None, unique=False,
@@ -408,11 +756,31 @@ class PolicyClass(object):
         :return: A list of the allowed tokentypes
         :rtype: list
         """
+        key = ("action_values", action, scope, realm, resolver, user, client,
+               allow_white_space_in_action)
+        action_values = self._memoize(key, lambda: self._get_action_values(
+            action, scope=scope, realm=realm, resolver=resolver, user=user,
+            client=client,
+            allow_white_space_in_action=allow_white_space_in_action))
+        if unique:
+            if len(action_values) > 1:
+                raise PolicyError("There are conflicting %s"
+                                  " definitions!" % action)
+        return action_values
+
+    def _get_action_values(self, action, scope, realm, resolver, user, client,
+                           allow_white_space_in_action):
+        """
+        Calculate the action values for get_action_values.
+
+        :return: A list of the unique action values
+        :rtype: list
+        """
         action_values = []
-        policies = self.get_policies(scope=scope,
-                                     action=action, active=True,
-                                     realm=realm, resolver=resolver, user=user,
-                                     client=client)
+        policies = self.matcher.get_policies(scope=scope,
+                                             action=action, active=True,
+                                             realm=realm, resolver=resolver,
+                                             user=user, client=client)
         for pol in policies:
             action_dict = pol.get("action", {})
             action_value = action_dict.get(action, "")
@@ -431,12 +799,7 @@ class PolicyClass(object):
                 action_values.extend(action_dict.get(action, "").split())
 
         # reduce the entries to unique entries
-        action_values = list(set(action_values))
-        if unique:
-            if len(action_values) > 1:
-                raise PolicyError("There are conflicting %s"
-                                  " definitions!" % action)
-        return action_values
+        return list(set(action_values))
 
     def ui_get_rights(self, scope, realm, username, client=None):
         """
@@ -589,6 +952,7 @@ def set_policy(name=None, scope=None, action=None, realm=None, resolver=None,
     p = Policy(name, action=action, scope=scope, realm=realm,
                user=user, time=time, client=client, active=active,
                resolver=resolver, adminrealm=adminrealm).save()
+    bump_policy_revision()
     return p
 
 
@@ -619,6 +983,7 @@ def delete_policy(name):
     p = Policy.query.filter_by(name=name)
     res = p.delete()
     db.session.commit()
+    bump_policy_revision()
     return res
 
 
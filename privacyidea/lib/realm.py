@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 #  privacyIDEA is a fork of LinOTP
 #
+#  2016-10-16 Cache the realms and their resolvers per process and refresh
+#             them by a realm revision stamp
 #  Nov 27, 2014 Cornelius Kölbel <cornelius@privacyidea.org>
 #               Migration to flask
 #               Rewrite of methods
@@ -33,6 +35,11 @@
 These are the library functions to create, modify and delete realms in the
 database. It depends on the lib.resolver.
 
+The realms with their resolvers and the default realm are cached per process.
+The cache is read again, if the realm revision in the database changed. The
+revision is bumped by set_realm, delete_realm and set_default_realm and is
+checked only once per request.
+
 It is independent of any user or token libraries and can be tested standalone
 in tests/test_lib_realm.py
 '''
@@ -42,12 +49,94 @@ from ..models import (Realm,
                       db)
 from log import log_with
 import logging
+import threading
+from flask import g, has_request_context
+from privacyidea.lib.config import get_revision, bump_revision
 from privacyidea.lib.utils import sanity_name_check
 log = logging.getLogger(__name__)
 
+# The key in the Config table, that holds the realm revision stamp
+REALM_REVISION_KEY = "__realm_revision__"
+
+# The priority of a resolver in a realm without a priority
+DEFAULT_PRIORITY = 999
+
+_realm_cache = {"revision": None,
+                "realms": {}}
+_realm_cache_lock = threading.Lock()
+
+
+def get_realm_revision():
+    """
+    Return the current realm revision stamp from the database.
+
+    :return: the revision or 0, if no realm was ever written
+    :rtype: int
+    """
+    return get_revision(REALM_REVISION_KEY)
+
+
+def bump_realm_revision():
+    """
+    Increase the realm revision stamp in the database and invalidate the
+    realm cache of this process. Other processes read the realms again, when
+    they notice the new revision.
+
+    :return: the new revision
+    """
+    revision = bump_revision(REALM_REVISION_KEY, u"realm revision")
+    invalidate_realm_cache()
+    return revision
+
+
+def invalidate_realm_cache():
+    """
+    Drop the cached realms of this process.
+    """
+    with _realm_cache_lock:
+        _realm_cache["revision"] = None
+        _realm_cache["realms"] = {}
+
+
+def _get_cached_realms():
+    """
+    Return the cached realms. The realm names are mapped to tuples of the
+    default flag and the list of the resolvers of the realm. The resolvers
+    are tuples (name, type, priority) ordered by the priority.
+
+    :return: dict
+    """
+    with _realm_cache_lock:
+        revision = _realm_cache["revision"]
+        realms = _realm_cache["realms"]
+    if revision is not None and has_request_context() and \
+            getattr(g, "realm_revision", None) == revision:
+        return realms
+
+    db_revision = get_realm_revision()
+    if db_revision != revision:
+        # The revision changed, so we need to reread the realms.
+        realms = {}
+        for realm in Realm.query.all():
+            # Resolvers with the same priority are ordered by the time they
+            # were added to the realm.
+            resolver_list = sorted(realm.resolver_list,
+                                   key=lambda res: (res.priority or
+                                                    DEFAULT_PRIORITY, res.id))
+            resolvers = [(res.resolver.name, res.resolver.rtype, res.priority)
+                         for res in resolver_list]
+            realms[realm.name] = (realm.default, resolvers)
+        with _realm_cache_lock:
+            _realm_cache["revision"] = db_revision
+            _realm_cache["realms"] = realms
+        log.debug("read {0!s} realms of revision {1!s}".format(len(realms),
+                                                              db_revision))
+    if has_request_context():
+        g.realm_revision = db_revision
+    return realms
+
 
 @log_with(log)
-#@cache.memoize(10)
 def get_realms(realmname=""):
     '''
     either return all defined realms or a specific realm
@@ -60,22 +149,41 @@ def get_realms(realmname=""):
     :rtype: dict
     '''
     result = {}
-
+    realms = _get_cached_realms()
     if realmname:
-        realm_q = Realm.query.filter_by(name=realmname)
+        names = [name for name in [realmname, realmname.lower()]
+                 if name in realms][:1]
     else:
-        realm_q = Realm.query.all()
-    for realm in realm_q:
+        names = realms.keys()
+    for name in names:
+        default, resolvers = realms[name]
         useridresolvers = []
-        for res in realm.resolver_list:
-            useridresolvers.append({"name": res.resolver.name,
-                                    "type": res.resolver.rtype,
-                                    "priority": res.priority})
-        result[realm.name] = {"resolver": useridresolvers,
-                              "default": realm.default}
+        for resolvername, rtype, priority in resolvers:
+            useridresolvers.append({"name": resolvername,
+                                    "type": rtype,
+                                    "priority": priority})
+        result[name] = {"resolver": useridresolvers,
+                        "default": default}
     return result
 
 
+def get_ordered_resolvers(realmname):
+    """
+    Return the names of the resolvers in the realm. The resolver with the
+    highest priority, i.e. the lowest number, comes first. Resolvers without
+    a priority come last. Resolvers with the same priority are ordered by
+    the time they were added to the realm.
+
+    :param realmname: The name of the realm
+    :return: list of resolver names
+    :rtype: list
+    """
+    realm = _get_cached_realms().get((realmname or "").lower())
+    if not realm:
+        return []
+    return [resolvername for resolvername, _rtype, _priority in realm[1]]
+
+
 #@cache.memoize(10)
 def get_realm(realmname):
     """
@@ -122,12 +230,12 @@ def set_default_realm(default_realm=None):
     r = Realm.query.filter_by(default=True).update({"default": False})
     if default_realm:
         r = Realm.query.filter_by(name=default_realm).update({"default": True})
-    db.session.commit()
+    # This commits the default realm
+    bump_realm_revision()
     return r
 
 
 @log_with(log)
-#@cache.memoize(10)
 def get_default_realm():
     """
     return the default realm
@@ -136,11 +244,10 @@ def get_default_realm():
     @return: the realm name
     @rtype : string
     """
-    r = Realm.query.filter_by(default=True).first()
-    if r:
-        return r.name
-    else:
-        return None
+    for name, (default, _resolvers) in _get_cached_realms().items():
+        if default:
+            return name
+    return None
 
 
 @log_with(log)
@@ -159,6 +266,7 @@ def delete_realm(realmname):
 
     realm = Realm.query.filter_by(name=realmname).first()
     ret = realm.delete()
+    bump_realm_revision()
 
     # If there was a default realm before
     # and if there is only one realm left, we set the
@@ -232,11 +340,11 @@ def set_realm(realm, resolvers=None, priority=None):
             added.append(reso_name)
         else:
             failed.append(reso_name)
-    db.session.commit() 
-    
+
     # if this is the first realm, make it the default
     if Realm.query.count() == 1:
         Realm.query.filter_by(name=realm).update({'default': True})
-        db.session.commit()
+    # This commits the realm and its resolvers
+    bump_realm_revision()
 
     return (added, failed)
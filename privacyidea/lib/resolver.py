@@ -1,4 +1,10 @@
 # -*- coding: utf-8 -*-
+#  2016-10-17 Read the resolver revision once per request
+#  2016-10-17 Flush the user cache, if a resolver is changed
+#  2016-10-17 Release the process wide resources of changed resolvers
+#  2016-10-16 Keep a pool of loaded resolver objects, that is invalidated
+#             by a resolver revision stamp
+#
 #  privacyIDEA is a fork of LinOTP
 #
 #  Nov 27, 2014 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -40,9 +46,12 @@ webservice!
 """
 
 import logging
+import threading
+from flask import g, has_request_context
 from log import log_with
 from config import (get_resolver_types,
-                     get_resolver_class_dict)
+                     get_resolver_class_dict,
+                     get_revision, bump_revision)
 from ..models import (Resolver,
                       ResolverConfig)
 from ..api.lib.utils import required
@@ -55,6 +64,20 @@ from privacyidea.lib.utils import sanity_name_check
 
 log = logging.getLogger(__name__)
 
+# The key in the Config table, that holds the resolver revision stamp
+RESOLVER_REVISION_KEY = "__resolver_revision__"
+
+# The loaded resolver objects. Resolver objects hold connections like an
+# LDAP bind or an SQL session, that must not be shared between threads.
+# So each thread keeps its own objects, which are reused for all requests
+# handled by this thread.
+_resolver_objects = threading.local()
+
+# The resolver revision, for which the process wide resources of the
+# resolver classes were released in this process
+_released_revision = None
+_released_revision_lock = threading.Lock()
+
 
 @log_with(log)
 def save_resolver(params):
@@ -153,6 +176,7 @@ def save_resolver(params):
                        Value=value,
                        Type=types.get(key, ""),
                        Description=desc.get(key, "")).save()
+    bump_resolver_revision()
     return resolver_id
 
 
@@ -228,9 +252,122 @@ def delete_resolver(resolvername):
                                    "realm %r." % (resolvername, realmname))
         reso.delete()
         ret = reso.id
+        # lib.usercache imports this module
+        from privacyidea.lib.usercache import delete_flush_stamp
+        delete_flush_stamp(resolvername)
+        bump_resolver_revision()
     return ret
 
 
+def get_resolver_revision():
+    """
+    Return the current resolver revision stamp from the database.
+    The revision is bumped each time a resolver is written or deleted.
+
+    :return: the revision or 0, if no resolver was ever written
+    :rtype: int
+    """
+    return get_revision(RESOLVER_REVISION_KEY)
+
+
+def get_request_resolver_revision():
+    """
+    Return the resolver revision stamp. During a request it is read from the
+    database only once, like the realm and the config revision.
+
+    :return: the revision or 0, if no resolver was ever written
+    :rtype: int
+    """
+    if not has_request_context():
+        return get_resolver_revision()
+    revision = getattr(g, "resolver_revision", None)
+    if revision is None:
+        revision = g.resolver_revision = get_resolver_revision()
+    return revision
+
+
+def bump_resolver_revision():
+    """
+    Increase the resolver revision stamp in the database and drop the loaded
+    resolver objects of this thread and the user cache of this process.
+    All other threads and processes drop their resolver objects and cached
+    users, when they notice the new revision.
+
+    :return: the new revision
+    :rtype: int
+    """
+    # lib.usercache imports this module
+    from privacyidea.lib.usercache import flush_user_cache
+    revision = bump_revision(RESOLVER_REVISION_KEY, u"resolver revision")
+    if has_request_context():
+        g.resolver_revision = revision
+    invalidate_resolver_objects()
+    flush_user_cache(all_processes=False)
+    release_shared_resources(revision)
+    return revision
+
+
+def release_shared_resources(revision):
+    """
+    Let the resolver classes release the process wide resources like
+    connection pools of the changed and deleted resolvers. This is done once
+    per resolver revision in each process.
+
+    :param revision: The current resolver revision
+    """
+    global _released_revision
+    with _released_revision_lock:
+        if _released_revision == revision:
+            return
+        _released_revision = revision
+    resolvers = get_resolver_list()
+    resolver_classes = set(get_resolver_class_dict()[0].values())
+    for resolver_class in resolver_classes:
+        try:
+            resolver_class.release_shared_resources(resolvers)
+        except Exception as exx:  # pragma: no cover
+            log.warning("Could not release the resources of {0!s}: "
+                        "{1!r}".format(resolver_class, exx))
+
+
+def _get_loaded_resolvers():
+    """
+    Return the dictionary of the resolver objects of this thread.
+    The keys are the resolver names, the values are tuples of the revision
+    and the resolver object.
+    """
+    objects = getattr(_resolver_objects, "objects", None)
+    if objects is None:
+        objects = _resolver_objects.objects = {}
+    return objects
+
+
+def invalidate_resolver_objects():
+    """
+    Close and drop the loaded resolver objects of this thread.
+    """
+    objects = _get_loaded_resolvers()
+    for _revision, r_obj in objects.values():
+        r_obj.close()
+    objects.clear()
+
+
+def close_resolver_objects(exception=None):
+    """
+    Call the close hook of all loaded resolver objects of this thread.
+    This is called at the end of each request. The resolver objects stay
+    in the pool, so that their connection pools can be used by the next
+    request.
+
+    :param exception: The exception passed by the flask teardown
+    """
+    for _revision, r_obj in _get_loaded_resolvers().values():
+        try:
+            r_obj.close()
+        except Exception as exx:  # pragma: no cover
+            log.warning("Could not close resolver: {0!r}".format(exx))
+
+
 @log_with(log)
 #@cache.memoize(10)
 def get_resolver_config(resolvername):
@@ -306,17 +443,31 @@ def get_resolver_type(resolvername):
 
 
 @log_with(log)
-#@cache.memoize(10)
 def get_resolver_object(resolvername):
     """
-    TODO: We can cache this
     create a resolver object from a resolvername
 
+    The loaded resolver objects are kept in a pool per thread, so that the
+    connection pools of the resolvers are reused by later requests.
+    The pool is dropped, if the resolver revision in the database changes.
+    The revision is read once per request.
+
     :param resolvername: the resolver string as from the token including
                          the config as last part
     :return: instance of the resolver with the loaded config
 
     """
+    objects = _get_loaded_resolvers()
+    revision = get_request_resolver_revision()
+    cached = objects.get(resolvername)
+    if cached and cached[0] == revision:
+        return cached[1]
+    if [rev for rev, _r_obj in objects.values() if rev != revision]:
+        # The resolvers were changed. We drop all objects of older revisions,
+        # since they would never be used again.
+        invalidate_resolver_objects()
+    release_shared_resources(revision)
+
     r_obj = None
     r_type = get_resolver_type(resolvername)
     r_obj_class = get_resolver_class(r_type)
@@ -327,8 +478,10 @@ def get_resolver_object(resolvername):
         # create the resolver instance and load the config
         r_obj = r_obj_class()
         if r_obj is not None:
+            r_obj.resolvername = resolvername
             resolver_config = get_resolver_config(resolvername)
             r_obj.loadConfig(resolver_config)
+            objects[resolvername] = (revision, r_obj)
 
     return r_obj
 
@@ -2,6 +2,9 @@
 #  Copyright (C) 2014 Cornelius Kölbel
 #  contact:  corny@cornelinux.de
 #
+#  2016-10-17 Keep the LDAP connections in process wide connection pools,
+#             that are shared with the LDAP machine resolver
+#  2016-10-17 Close the connection pools of changed and deleted resolvers
 #  2016-02-22 Salvo Rapisarda
 #             Allow objectGUID to be a users attribute
 #  2016-02-19 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -40,8 +43,13 @@ import ldap3
 import yaml
 import traceback
 import uuid
+from ldap3.core.exceptions import LDAPCommunicationError
 from ldap3.utils.conv import escape_bytes
 import datetime
+import itertools
+import threading
+import time
+from contextlib import contextmanager
 
 from UserIdResolver import UserIdResolver
 from gettext import gettext as _
@@ -53,6 +61,15 @@ ENCODING = "utf-8"
 # 1 sec == 10^9 nano secs == 10^7 * (100 nano secs)
 MS_AD_MULTIPLYER = 10 ** 7
 MS_AD_START = datetime.datetime(1601, 1, 1)
+# The maximum number of idle connections, that are kept in a pool
+POOL_SIZE = 10
+# The number of seconds, after which a connection is closed and reopened
+POOL_MAX_AGE = 300
+
+# The connection pools of this process. The keys are the owners of the
+# pools, the values are tuples of the key of the connections and the pool.
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
 
 
 def get_ad_timestamp_now():
@@ -77,10 +94,182 @@ class AUTHTYPE(object):
     NTLM = "NTLM"
 
 
+class ConnectionPool(object):
+    """
+    A pool of opened LDAP connections, that are shared by all threads of the
+    process. A connection is used by one thread at a time. It is taken from
+    the pool with get() and returned with put().
+
+    Connections, that were closed or that are older than max_age seconds,
+    are not used again. Pools for searches only hand out bound connections.
+    """
+
+    def __init__(self, size=POOL_SIZE, max_age=POOL_MAX_AGE,
+                 require_bound=True):
+        self.size = size
+        self.max_age = max_age
+        self.require_bound = require_bound
+        self.closed = False
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+    def _is_usable(self, created, connection):
+        if connection.closed or time.time() - created > self.max_age:
+            return False
+        return connection.bound or not self.require_bound
+
+    def get(self, create_connection):
+        """
+        Return an idle connection of the pool or a new connection.
+
+        :param create_connection: function, that returns a new connection
+        :return: tuple of the creation time and the connection
+        """
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                entry = self._idle.pop()
+            if self._is_usable(*entry):
+                with self._lock:
+                    self.reused += 1
+                return entry
+            self.discard(entry[1])
+        connection = create_connection()
+        with self._lock:
+            self.created += 1
+        return time.time(), connection
+
+    def put(self, entry):
+        """
+        Return a connection to the pool. It is closed, if it can not be used
+        again or if the pool is full.
+
+        :param entry: The tuple of the creation time and the connection
+        """
+        if self._is_usable(*entry):
+            with self._lock:
+                if not self.closed and len(self._idle) < self.size:
+                    self._idle.append(entry)
+                    return
+        self.discard(entry[1])
+
+    def discard(self, connection):
+        """
+        Close a connection, that is not returned to the pool.
+        """
+        with self._lock:
+            self.discarded += 1
+        try:
+            connection.unbind()
+        except Exception as exx:  # pragma: no cover
+            log.debug("Could not unbind connection: {0!r}".format(exx))
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for _created, connection in idle:
+            self.discard(connection)
+
+    def close(self):
+        """
+        Close all idle connections. The connections, that are in use, are
+        closed, when they are returned to the pool.
+        """
+        with self._lock:
+            self.closed = True
+        self.clear()
+
+
+def get_connection_pool(owner, key, size=POOL_SIZE, max_age=POOL_MAX_AGE,
+                        require_bound=True):
+    """
+    Return the connection pool of this process for the given owner. The pool
+    is created, if it does not exist, yet. If the key of the owner changed,
+    the old pool is closed and a new pool is created.
+
+    :param owner: A tuple, that identifies the user of the pool like
+        ("resolver", <resolvername>, "search")
+    :param key: A tuple of the server and the credentials of the connections
+    :param size: The maximum number of idle connections
+    :param max_age: The maximum age of a connection in seconds
+    :param require_bound: Only use connections, that are bound
+    :return: ConnectionPool
+    """
+    replaced = None
+    with _connection_pools_lock:
+        entry = _connection_pools.get(owner)
+        if entry is not None and entry[0] == key:
+            pool = entry[1]
+        else:
+            if entry is not None:
+                replaced = entry[1]
+            pool = ConnectionPool(require_bound=require_bound)
+            _connection_pools[owner] = (key, pool)
+        pool.size = size
+        pool.max_age = max_age
+    if replaced is not None:
+        replaced.close()
+    return pool
+
+
+@contextmanager
+def pooled_connection(pool, create_connection):
+    """
+    Take a connection from the connection pool and return it to the pool
+    afterwards. Connections with a communication error are closed.
+
+    :param pool: The ConnectionPool
+    :param create_connection: function, that returns a new connection
+    """
+    entry = pool.get(create_connection)
+    try:
+        yield entry[1]
+    except LDAPCommunicationError:
+        pool.discard(entry[1])
+        raise
+    except Exception:
+        pool.put(entry)
+        raise
+    pool.put(entry)
+
+
+def release_connection_pools(match):
+    """
+    Close and remove the connection pools of this process, whose owner and
+    key match.
+
+    :param match: function, that takes the owner and the key of a pool and
+        returns True, if the pool should be closed
+    :return: the number of closed pools
+    :rtype: int
+    """
+    with _connection_pools_lock:
+        owners = [owner for owner, (key, _pool) in _connection_pools.items()
+                  if match(owner, key)]
+        pools = [_connection_pools.pop(owner)[1] for owner in owners]
+    for pool in pools:
+        pool.close()
+    return len(pools)
+
+
+def clear_connection_pools():
+    """
+    Close all connection pools of this process and remove them.
+    """
+    release_connection_pools(lambda owner, key: True)
+
+
 class IdResolver (UserIdResolver):
 
     def __init__(self):
-        self.i_am_bound = False
         self.uri = ""
         self.basedn = ""
         self.binddn = ""
@@ -96,6 +285,8 @@ class IdResolver (UserIdResolver):
         self.certificate = ""
         self.resolverId = self.uri
         self.scope = ldap3.SUBTREE
+        self.pool_size = POOL_SIZE
+        self.pool_max_age = POOL_MAX_AGE
 
     def checkPass(self, uid, password):
         """
@@ -117,7 +308,6 @@ class IdResolver (UserIdResolver):
         else:
             bind_user = self._getDN(uid)
 
-        server_pool = self.get_serverpool(self.uri, self.timeout)
         password = to_utf8(password)
 
         try:
@@ -127,19 +317,29 @@ class IdResolver (UserIdResolver):
             # since we must avoid anonymous binds!
             if not bind_user or len(bind_user) < 1:
                 raise Exception("No valid user. Empty bind_user.")
-            l = self.create_connection(authtype=self.authtype,
-                                       server=server_pool,
-                                       user=bind_user,
-                                       password=password,
-                                       auto_referrals=not self.noreferrals)
-            l.open()
-            r = l.bind()
+            # The user binds use their own pool. An idle connection is
+            # bound again with the credentials of the user.
+            pool = self._get_pool("bind")
+            created, l = pool.get(lambda: self._create_bind_connection(
+                bind_user, password))
+            try:
+                if self.authtype == AUTHTYPE.SASL_DIGEST_MD5:  # pragma: no cover
+                    l.sasl_credentials = (str(bind_user), str(password))
+                else:
+                    l.user = bind_user
+                    l.password = password
+                r = l.bind()
+            except Exception:
+                pool.discard(l)
+                raise
+            # The password of the user is not kept in the pool
+            l.password = None
+            l.sasl_credentials = None
+            pool.put((created, l))
             log.debug("bind result: {0!s}".format(r))
             if not r:
                 raise Exception("Wrong credentials")
             log.debug("bind seems successful.")
-            l.unbind()
-            log.debug("unbind successful.")
         except Exception as e:
             log.warning("failed to check password for {0!r}/{1!r}: {2!r}".format(uid, bind_user, e))
             return False
@@ -222,13 +422,11 @@ class IdResolver (UserIdResolver):
                 userId = uuid.UUID("{{{0!s}}}".format(userId)).bytes_le
                 userId = escape_bytes(userId)
             # get the DN for the Object
-            self._bind()
             filter = "(&{0!s}({1!s}={2!s}))".format(self.searchfilter, self.uidtype, userId)
-            self.l.search(search_base=self.basedn,
-                          search_scope=self.scope,
-                          search_filter=filter,
-                          attributes=self.userinfo.values())
-            r = self.l.response
+            r = self._search(search_base=self.basedn,
+                             search_scope=self.scope,
+                             search_filter=filter,
+                             attributes=self.userinfo.values())
             r = self._trim_result(r)
             if len(r) > 1:  # pragma: no cover
                 raise Exception("Found more than one object for uid {0!r}".format(userId))
@@ -237,19 +435,121 @@ class IdResolver (UserIdResolver):
 
         return dn
         
-    def _bind(self):
-        if not self.i_am_bound:
-            server_pool = self.get_serverpool(self.uri, self.timeout)
-            self.l = self.create_connection(authtype=self.authtype,
-                                            server=server_pool,
-                                            user=self.binddn,
-                                            password=self.bindpw,
-                                            auto_referrals=not self.noreferrals)
-            self.l.open()
-            #log.error("LDAP Server Pool States: %s" % server_pool.pool_states)
-            if not self.l.bind():
-                raise Exception("Wrong credentials")
-            self.i_am_bound = True
+    def _get_server_key(self):
+        """
+        :return: tuple, that identifies the LDAP servers and the connection
+            options of the resolver
+        """
+        return self.uri, self.authtype, self.timeout, bool(self.noreferrals)
+
+    def _get_pool_keys(self):
+        """
+        :return: dict with the owners of the connection pools of this
+            resolver as keys and the keys of their connections as values
+        """
+        owner = ("resolver", self.resolvername)
+        return {owner + ("search",): (self.binddn, self.bindpw) +
+                self._get_server_key(),
+                owner + ("bind",): self._get_server_key()}
+
+    def _get_pool(self, kind):
+        """
+        Return the connection pool of this resolver for the searches with
+        the service account ("search") or for the password checks of the
+        users ("bind").
+        """
+        owner = ("resolver", self.resolvername, kind)
+        return get_connection_pool(owner, self._get_pool_keys()[owner],
+                                   self.pool_size, self.pool_max_age,
+                                   require_bound=(kind == "search"))
+
+    @classmethod
+    def release_shared_resources(cls, resolvers):
+        """
+        Close the connection pools of the LDAP resolvers, that were deleted
+        or whose server or credentials changed.
+
+        :param resolvers: The existing resolvers as returned by
+            lib.resolver.get_resolver_list
+        """
+        keys = {}
+        for name, resolver in resolvers.items():
+            if resolver.get("type") == cls.getResolverType():
+                r_obj = cls()
+                r_obj.resolvername = name
+                r_obj.loadConfig(resolver.get("data", {}))
+                keys.update(r_obj._get_pool_keys())
+        release_connection_pools(lambda owner, key: owner[0] == "resolver"
+                                 and keys.get(owner) != key)
+
+    def _create_search_connection(self):
+        """
+        Create a connection, that is bound with the service account of the
+        resolver.
+        """
+        server_pool = self.get_serverpool(self.uri, self.timeout)
+        l = self.create_connection(authtype=self.authtype,
+                                   server=server_pool,
+                                   user=self.binddn,
+                                   password=self.bindpw,
+                                   auto_referrals=not self.noreferrals)
+        l.open()
+        #log.error("LDAP Server Pool States: %s" % server_pool.pool_states)
+        if not l.bind():
+            raise Exception("Wrong credentials")
+        return l
+
+    def _create_bind_connection(self, bind_user, password):
+        """
+        Create an opened connection for the user binds. The connection is
+        created with the credentials of a user, so that it never binds
+        anonymously.
+        """
+        server_pool = self.get_serverpool(self.uri, self.timeout)
+        l = self.create_connection(authtype=self.authtype,
+                                   server=server_pool,
+                                   user=bind_user,
+                                   password=password,
+                                   auto_referrals=not self.noreferrals)
+        l.open()
+        return l
+
+    @contextmanager
+    def _search_connection(self):
+        """
+        Take a bound connection of the service account from the connection
+        pool and return it to the pool afterwards. Connections with a
+        communication error are closed.
+        """
+        pool = self._get_pool("search")
+        with pooled_connection(pool, self._create_search_connection) as l:
+            yield l
+
+    def _search(self, paged=False, limit=None, **kwargs):
+        """
+        Search in the LDAP directory with a pooled connection. If the server
+        closed the connection, the search is repeated once with a new
+        connection.
+
+        :param paged: Use a paged search
+        :param limit: The maximum number of entries of a paged search
+        :param kwargs: The parameters of the search
+        :return: list of the found entries
+        """
+        for attempt in [1, 2]:
+            try:
+                with self._search_connection() as l:
+                    if paged:
+                        g = l.extend.standard.paged_search(generator=True,
+                                                           **kwargs)
+                        return list(itertools.islice(g, limit))
+                    l.search(**kwargs)
+                    return l.response
+            except LDAPCommunicationError as exx:
+                if attempt > 1:
+                    raise
+                log.warning("Repeating the LDAP search with a new "
+                            "connection: {0!r}".format(exx))
 
     def getUserInfo(self, userId):
         """
@@ -261,22 +561,20 @@ class IdResolver (UserIdResolver):
         :rtype: dict
         """
         ret = {}
-        self._bind()
         
         if self.uidtype.lower() == "dn":
             # encode utf8, so that also german ulauts work in the DN
-            self.l.search(search_base=to_utf8(userId),
-                          search_scope=self.scope,
-                          search_filter="(&" + self.searchfilter + ")",
-                          attributes=self.userinfo.values())
+            r = self._search(search_base=to_utf8(userId),
+                             search_scope=self.scope,
+                             search_filter="(&" + self.searchfilter + ")",
+                             attributes=self.userinfo.values())
         else:
             filter = "(&{0!s}({1!s}={2!s}))".format(self.searchfilter, self.uidtype, userId)
-            self.l.search(search_base=self.basedn,
-                              search_scope=self.scope,
-                              search_filter=filter,
-                              attributes=self.userinfo.values())
+            r = self._search(search_base=self.basedn,
+                             search_scope=self.scope,
+                             search_filter=filter,
+                             attributes=self.userinfo.values())
 
-        r = self.l.response
         r = self._trim_result(r)
         if len(r) > 1:  # pragma: no cover
             raise Exception("Found more than one object for uid {0!r}".format(userId))
@@ -330,7 +628,6 @@ class IdResolver (UserIdResolver):
         :return: UserId as found for the LoginName
         """
         userid = ""
-        self._bind()
         filter = "(&{0!s}({1!s}={2!s}))".format(self.searchfilter, self.loginname_attribute,
              self._escape_loginname(LoginName))
 
@@ -339,12 +636,10 @@ class IdResolver (UserIdResolver):
         if self.uidtype.lower() != "dn":
             attributes.append(str(self.uidtype))
             
-        self.l.search(search_base=self.basedn,
-                      search_scope=self.scope,
-                      search_filter=filter,
-                      attributes=attributes)
-
-        r = self.l.response
+        r = self._search(search_base=self.basedn,
+                         search_scope=self.scope,
+                         search_filter=filter,
+                         attributes=attributes)
         r = self._trim_result(r)
         if len(r) > 1:  # pragma: no cover
             raise Exception("Found more than one object for Loginname {0!r}".format(
@@ -362,7 +657,6 @@ class IdResolver (UserIdResolver):
         :return: list of users, where each user is a dictionary
         """
         ret = []
-        self._bind()
         attributes = self.userinfo.values()
         ad_timestamp = get_ad_timestamp_now()
         if self.uidtype.lower() != "dn":
@@ -383,14 +677,14 @@ class IdResolver (UserIdResolver):
                 filter += "({0!s}={1!s})".format(self.userinfo[search_key], searchDict[search_key])
         filter += ")"
 
-        g = self.l.extend.standard.paged_search(search_base=self.basedn,
-                                                search_filter=filter,
-                                                search_scope=self.scope,
-                                                attributes=attributes,
-                                                paged_size=100,
-                                                size_limit=self.sizelimit,
-                                                generator=True)
-        # returns a generator of dictionaries
+        g = self._search(paged=True, limit=self.sizelimit,
+                         search_base=self.basedn,
+                         search_filter=filter,
+                         search_scope=self.scope,
+                         attributes=attributes,
+                         paged_size=100,
+                         size_limit=self.sizelimit)
+        # returns a list of dictionaries
         for entry in g:
             # Simple fix for ignored sizelimit with Active Directory
             if len(ret) >= self.sizelimit:
@@ -466,6 +760,8 @@ class IdResolver (UserIdResolver):
         self.scope = config.get("SCOPE") or ldap3.SUBTREE
         self.resolverId = self.uri
         self.authtype = config.get("AUTHTYPE", AUTHTYPE.SIMPLE)
+        self.pool_size = int(config.get("POOLSIZE") or POOL_SIZE)
+        self.pool_max_age = float(config.get("POOLMAXAGE") or POOL_MAX_AGE)
         
         return self
 
@@ -558,7 +854,9 @@ class IdResolver (UserIdResolver):
                                 'UIDTYPE': 'string',
                                 'NOREFERRALS': 'bool',
                                 'CACERTIFICATE': 'string',
-                                'AUTHTYPE': 'string'}
+                                'AUTHTYPE': 'string',
+                                'POOLSIZE': 'int',
+                                'POOLMAXAGE': 'int'}
         return {typ: descriptor}
 
     @classmethod
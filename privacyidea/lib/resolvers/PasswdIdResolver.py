@@ -6,6 +6,8 @@
 #  May, 08 2014 Cornelius Kölbel
 #  http://www.privacyidea.org
 #
+# 2016-10-17 Share the parsed file between the resolver objects and
+#            index the users for the wildcard searches
 # 2014-10-03 fix getUsername function
 #            Cornelius Kölbel <cornelius@privcyidea.org>
 #
@@ -39,12 +41,17 @@
                 for resolvin user info to the /etc/passwd user base
 
   Dependencies: -
+
+  The parsed file is shared by all resolver objects of a process. It is
+  parsed again, if the modification time or the size of the file changed.
 """
 
 import re
 import os
 import logging
 import crypt
+import threading
+from bisect import bisect_left
 
 
 from UserIdResolver import UserIdResolver
@@ -52,6 +59,13 @@ from UserIdResolver import UserIdResolver
 log = logging.getLogger(__name__)
 ENCODING = "utf-8"
 
+# very basic e-mail regex
+EMAIL_REGEX = re.compile('.+@.+\..+')
+
+# The parsed files of this process, keyed by the absolute file name
+_passwd_indexes = {}
+_passwd_indexes_lock = threading.Lock()
+
 
 def tokenise(r):
     def _(s):
@@ -64,6 +78,147 @@ def tokenise(r):
     return _
 
 
+def _lower(string):
+    if type(string) == unicode:
+        string = string.encode(ENCODING)
+    return string.lower()
+
+
+class PasswdUser(object):
+    """
+    A user, that was read from one line of the passwd file.
+    """
+    __slots__ = ("username", "cryptpass", "userid", "description",
+                 "givenname", "surname", "phone", "mobile", "email")
+
+    def __init__(self, line):
+        fields = line.split(":", 7)
+        self.username = fields[0]
+        self.cryptpass = fields[1]
+        self.userid = fields[2]
+        self.description = fields[4]
+
+        # surname, givenname and phones are part of the description
+        descriptions = self.description.split(",")
+        names = descriptions[0].split(' ', 1)
+        self.givenname = names[0]
+        self.surname = ""
+        self.mobile = ""
+        self.phone = ""
+        self.email = ""
+        if len(names) >= 2:
+            self.surname = names[1]
+        if len(descriptions) >= 4:
+            self.mobile = descriptions[2]
+            self.phone = descriptions[3]
+        for field in descriptions[4:]:
+            email_match = EMAIL_REGEX.search(field)
+            if email_match:
+                self.email = email_match.group(0)
+
+
+class PasswdIndex(object):
+    """
+    The users of a passwd file with sorted indexes of the lowercase user
+    names and descriptions. The indexes of the reversed values are used to
+    find the values with a given suffix.
+    """
+
+    def __init__(self, filename):
+        stat = os.stat(filename)
+        self.filename = filename
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        # uid -> PasswdUser
+        self.users = {}
+        # username -> uid
+        self.uids = {}
+        log.info('loading users from file {0!s}'.format(filename))
+        with open(filename, "r") as fileHandle:
+            for line in fileHandle:
+                line = line.strip()
+                if not line:
+                    # continue on an empty line
+                    continue
+                user = PasswdUser(line)
+                self.users[user.userid] = user
+                self.uids[user.username] = user.userid
+
+        self.prefixes = {}
+        self.suffixes = {}
+        for field in ["username", "description"]:
+            self.prefixes[field] = self._create_index(field, reverse=False)
+            self.suffixes[field] = self._create_index(field, reverse=True)
+
+    def _create_index(self, field, reverse):
+        """
+        :return: tuple of the sorted values and the corresponding uids
+        """
+        entries = []
+        for uid, user in self.users.iteritems():
+            value = getattr(user, field).lower()
+            if reverse:
+                value = value[::-1]
+            entries.append((value, uid))
+        entries.sort()
+        return [e[0] for e in entries], [e[1] for e in entries]
+
+    def is_current(self):
+        """
+        :return: True, if the file was not changed since it was parsed
+        """
+        stat = os.stat(self.filename)
+        return self.mtime == stat.st_mtime and self.size == stat.st_size
+
+    def find(self, field, pattern):
+        """
+        Find the users, whose field matches a pattern like "abc", "abc*" or
+        "*abc" with the sorted indexes. The result may contain users, that
+        do not match the complete pattern. A pattern like "*abc*" can not be
+        looked up in the indexes.
+
+        :param field: "username" or "description"
+        :param pattern: The search pattern
+        :return: set of uids or None, if all users need to be checked
+        """
+        pattern = _lower(pattern)
+        if pattern.startswith("*") and pattern.endswith("*"):
+            return None
+        if pattern.startswith("*"):
+            values, uids = self.suffixes[field]
+            start = pattern[1:][::-1]
+        elif pattern.endswith("*"):
+            values, uids = self.prefixes[field]
+            start = pattern[:-1]
+        else:
+            values, uids = self.prefixes[field]
+            start = pattern
+        result = set()
+        i = bisect_left(values, start)
+        while i < len(values) and values[i].startswith(start):
+            result.add(uids[i])
+            i += 1
+        return result
+
+
+def get_passwd_index(filename):
+    """
+    Return the parsed passwd file of this process. The file is parsed, if it
+    was not parsed, yet, or if its modification time or size changed.
+
+    :param filename: The name of the passwd file
+    :rtype: PasswdIndex
+    """
+    filename = os.path.abspath(filename)
+    index = _passwd_indexes.get(filename)
+    if index is None or not index.is_current():
+        with _passwd_indexes_lock:
+            index = _passwd_indexes.get(filename)
+            if index is None or not index.is_current():
+                index = _passwd_indexes[filename] = PasswdIndex(filename)
+    return index
+
+
 class IdResolver (UserIdResolver):
 
     fields = {"username": 1, "userid": 1,
@@ -97,6 +252,12 @@ class IdResolver (UserIdResolver):
         log.info("Setting up the PasswdResolver")
         return
 
+    # The indexed fields of the text search fields
+    searchIndexes = {"username": "username",
+                     "description": "description",
+                     "email": "description"
+                     }
+
     def __init__(self):
         """
         simple constructor
@@ -105,15 +266,7 @@ class IdResolver (UserIdResolver):
         self.fileName = ""
 
         self.name = "P"
-        self.nameDict = {}
-        self.descDict = {}
-        self.reversDict = {}
-        self.passDict = {}
-        self.officePhoneDict = {}
-        self.homePhoneDict = {}
-        self.surnameDict = {}
-        self.givennameDict = {}
-        self.emailDict = {}
+        self.index = None
 
     def loadFile(self):
 
@@ -121,58 +274,25 @@ class IdResolver (UserIdResolver):
         Loads the data of the file initially.
         if the self.fileName is empty, it loads /etc/passwd.
         Empty lines are ignored.
+
+        The file is only parsed again, if it was changed.
         """
 
         if self.fileName == "":
             self.fileName = "/etc/passwd"
 
-        log.info('loading users from file {0!s} from within {1!r}'.format(self.fileName,
-                                                                os.getcwd()))
-        with open(self.fileName, "r") as fileHandle:
-            ID = self.sF["userid"]
-            NAME = self.sF["username"]
-            PASS = self.sF["cryptpass"]
-            DESCRIPTION = self.sF["description"]
-
-            for line in fileHandle:
-                line = line.strip()
-                if not line:
-                    # continue on an empty line
-                    continue
+        self.index = get_passwd_index(self.fileName)
 
-                fields = line.split(":", 7)
-                self.nameDict["{0!s}".format(fields[NAME])] = fields[ID]
-
-                # for speed reason - build a revers lookup
-                self.reversDict[fields[ID]] = "{0!s}".format(fields[NAME])
-
-                # for full info store the line
-                self.descDict[fields[ID]] = fields
-
-                # store the crypted password
-                self.passDict[fields[ID]] = fields[PASS]
-
-                # store surname, givenname and phones
-                descriptions = fields[DESCRIPTION].split(",")
-                name = descriptions[0]
-                names = name.split(' ', 1)
-                self.givennameDict[fields[ID]] = names[0]
-                self.surnameDict[fields[ID]] = ""
-                self.officePhoneDict[fields[ID]] = ""
-                self.homePhoneDict[fields[ID]] = ""
-                self.emailDict[fields[ID]] = ""
-                if len(names) >= 2:
-                    self.surnameDict[fields[ID]] = names[1]
-                if len(descriptions) >= 4:
-                    self.officePhoneDict[fields[ID]] = descriptions[2]
-                    self.homePhoneDict[fields[ID]] = descriptions[3]
-                if len(descriptions) >= 5:
-                    for field in descriptions[4:]:
-                        # very basic e-mail regex
-                        email_match = re.search('.+@.+\..+', field)
-                        if email_match:
-                            self.emailDict[fields[ID]] = email_match.group(0)
+    def _get_index(self):
+        if self.index is None:
+            self.loadFile()
+        return self.index
 
+    def close(self):
+        """
+        The next request checks again, if the file was changed.
+        """
+        self.index = None
 
     def checkPass(self, uid, password):
         """
@@ -191,7 +311,7 @@ class IdResolver (UserIdResolver):
         :rtype: bool
         """
         log.info("checking password for user uid {0!s}".format(uid))
-        cryptedpasswd = self.passDict[uid]
+        cryptedpasswd = self._get_index().users[uid].cryptpass
         log.debug("We found the crypted pass {0!s} for uid {1!s}".format(cryptedpasswd, uid))
         if cryptedpasswd:
             if cryptedpasswd == 'x' or cryptedpasswd == '*':
@@ -222,20 +342,18 @@ class IdResolver (UserIdResolver):
         """
         ret = {}
 
-        if userId in self.reversDict:
-            fields = self.descDict.get(userId)
-
-            for key in self.sF:
-                if no_passwd and key == "cryptpass":
-                    continue
-                index = self.sF[key]
-                ret[key] = fields[index]
-
-            ret['givenname'] = self.givennameDict.get(userId)
-            ret['surname'] = self.surnameDict.get(userId)
-            ret['phone'] = self.homePhoneDict.get(userId)
-            ret['mobile'] = self.officePhoneDict.get(userId)
-            ret['email'] = self.emailDict.get(userId)
+        user = self._get_index().users.get(userId)
+        if user is not None:
+            ret = {"username": user.username,
+                   "userid": user.userid,
+                   "description": user.description,
+                   "givenname": user.givenname,
+                   "surname": user.surname,
+                   "phone": user.phone,
+                   "mobile": user.mobile,
+                   "email": user.email}
+            if not no_passwd:
+                ret["cryptpass"] = user.cryptpass
 
         return ret
 
@@ -247,9 +365,10 @@ class IdResolver (UserIdResolver):
         :return: username
         :rtype: string
         '''
-        fields = self.descDict.get(userId)
-        index = self.sF["username"]
-        return fields[index]
+        user = self._get_index().users.get(userId)
+        if user is None:
+            return ""
+        return user.username
 
     def getUserId(self, LoginName):
         """
@@ -264,10 +383,7 @@ class IdResolver (UserIdResolver):
         if type(LoginName) == unicode:
             LoginName = LoginName.encode(ENCODING)
 
-        if LoginName in self.nameDict.keys():
-            return self.nameDict[LoginName]
-        else:
-            return ""
+        return self._get_index().uids.get(LoginName, "")
 
     def getSearchFields(self, searchDict=None):
         """
@@ -296,18 +412,27 @@ class IdResolver (UserIdResolver):
         :param searchDict: dict of search expressions
         """
         ret = []
+        index = self._get_index()
 
         #  first check if the searches are in the searchDict
-        for l in self.descDict:
-            line = self.descDict[l]
+        uids = None
+        for search in searchDict:
+            if search not in self.searchFields:
+                return ret
+            # Only check the users, that are found in the indexes
+            if search in self.searchIndexes:
+                found = index.find(self.searchIndexes[search],
+                                   searchDict[search])
+                if found is not None:
+                    uids = found if uids is None else uids & found
+        if uids is None:
+            uids = index.users.keys()
+
+        for uid in uids:
+            line = index.users[uid]
             ok = True
 
             for search in searchDict:
-
-                if search not in self.searchFields:
-                    ok = False
-                    break
-
                 pattern = searchDict[search]
 
                 log.debug("searching for %s:%s", search, pattern)
@@ -325,7 +450,6 @@ class IdResolver (UserIdResolver):
                     break
 
             if ok is True:
-                uid = line[self.sF["userid"]]
                 info = self.getUserInfo(uid, no_passwd=True)
                 ret.append(info)
 
@@ -336,17 +460,17 @@ class IdResolver (UserIdResolver):
         check for user name
         """
 
-        username = line[self.sF["username"]]
+        username = line.username
         ret = self._stringMatch(username, pattern)
         return ret
 
     def checkDescription(self, line, pattern):
-        description = line[self.sF["description"]]
+        description = line.description
         ret = self._stringMatch(description, pattern)
         return ret
 
     def checkEmail(self, line, pattern):
-        email = line[self.sF["email"]]
+        email = line.description
         ret = self._stringMatch(email, pattern)
         return ret
 
@@ -401,8 +525,8 @@ class IdResolver (UserIdResolver):
         A pattern can be "=1000", ">=1000",
         "<2000" or "between 1000,2000".
 
-        :param line: the dictionary of a user
-        :type line: dict
+        :param line: the user
+        :type line: PasswdUser
         :param pattern: match pattern with <, <=...
         :type pattern: string
         :return: True or False
@@ -411,7 +535,7 @@ class IdResolver (UserIdResolver):
         ret = False
 
         try:
-            cUserId = int(line[self.sF["userid"]])
+            cUserId = int(line.userid)
         except:  # pragma: no cover
             return ret
 
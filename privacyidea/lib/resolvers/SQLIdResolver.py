@@ -1,5 +1,11 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Share an engine between the resolvers with the same connect
+#             string and pool options
+#  2016-10-17 Dispose the engines of changed and deleted resolvers
+#  2016-10-17 Share the engines and sessions of the SQL resolvers in a
+#             process wide engine registry
+#
 #  Copyright (C) 2014 Cornelius Kölbel
 #  License:  AGPLv3
 #  contact:  cornelius@privacyidea.org
@@ -19,17 +25,22 @@
 #
 __doc__ = """This is the resolver to find users in SQL databases.
 
+All resolver objects with the same connect string and pool options use the
+same SQLAlchemy engine, connection pool and mapped table of this process.
+
 The file is tested in tests/test_lib_resolver.py
 """
 
 import logging
+import threading
 import yaml
 
 from UserIdResolver import UserIdResolver
 
 from sqlalchemy import and_
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import event, exc, select
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 import traceback
 from base64 import (b64decode,
@@ -72,6 +83,221 @@ else:  # pragma: no cover
     # Fake PID
     _pid = urandom.randint(0, 100000)
 
+POOL_SIZE = 5
+POOL_TIMEOUT = 10
+POOL_RECYCLE = 3600
+
+# The engines of this process, keyed by the tuple of the connect string and
+# the pool options. The values are tuples of the SQLEngine and the set of the
+# names of the resolvers, that use it. An engine is disposed, when the last
+# resolver releases it.
+_engines = {}
+# The key of the engine of each resolver
+_resolver_keys = {}
+_engines_lock = threading.Lock()
+
+
+class SQLEngine(object):
+    """
+    An SQLAlchemy engine with its connection pool, a thread local session and
+    the SQLSoup, that maps the tables. It is shared by all objects of a
+    resolver in the process.
+    """
+
+    def __init__(self, connect_string, encoding="latin1",
+                 pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT,
+                 pool_recycle=POOL_RECYCLE):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidated = 0
+        try:
+            log.debug("using pool_size={0!s} and pool_timeout={1!s}".format(
+                      pool_size, pool_timeout))
+            self.engine = create_engine(connect_string,
+                                        encoding=encoding,
+                                        convert_unicode=False,
+                                        pool_size=pool_size,
+                                        pool_timeout=pool_timeout,
+                                        pool_recycle=pool_recycle)
+        except TypeError:
+            # The DB Engine/Poolclass might not support the pool_size.
+            log.debug("connecting without pool_size.")
+            self.engine = create_engine(connect_string,
+                                        encoding=encoding,
+                                        convert_unicode=False,
+                                        pool_recycle=pool_recycle)
+        event.listen(self.engine, "engine_connect", self._ping_connection)
+        event.listen(self.engine, "connect", self._on_connect)
+        event.listen(self.engine, "checkout", self._on_checkout)
+        # Each thread gets its own session, which is removed after the request
+        self.session = scoped_session(sessionmaker(bind=self.engine))
+        self.db = SQLSoup(self.engine, session=self.session)
+
+    def entity(self, table):
+        """
+        Return the mapped class of the table. The table is only reflected
+        once per engine.
+        """
+        with self.lock:
+            return self.db.entity(table)
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.connects += 1
+
+    def _on_checkout(self, dbapi_connection, connection_record,
+                     connection_proxy):
+        self.checkouts += 1
+
+    def _ping_connection(self, connection, branch):
+        """
+        Test the connection, before it is used. If the database closed the
+        connection, the pool is invalidated and a new connection is used.
+        """
+        if branch:
+            return
+        should_close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except exc.DBAPIError as err:
+            if not err.connection_invalidated:
+                raise
+            log.info("The connection to the database was closed. "
+                     "Reconnecting.")
+            self.invalidated += 1
+            connection.scalar(select([1]))
+        finally:
+            connection.should_close_with_result = should_close_with_result
+
+    def get_stats(self):
+        """
+        Return the statistics of the engine and its connection pool.
+
+        :return: dict with the database URL without the password, the pool
+            class and the counters. For a QueuePool also "size",
+            "checkedin", "checkedout" and "overflow".
+        :rtype: dict
+        """
+        pool = self.engine.pool
+        stats = {"url": repr(self.engine.url),
+                 "pool": pool.__class__.__name__,
+                 "connects": self.connects,
+                 "checkouts": self.checkouts,
+                 "invalidated": self.invalidated}
+        for name in ["size", "checkedin", "checkedout", "overflow"]:
+            method = getattr(pool, name, None)
+            if method:
+                stats[name] = method()
+        return stats
+
+    def dispose(self):
+        """
+        Close the pooled connections of the engine. Connections, that are
+        still checked out, are closed when they are returned.
+        """
+        self.session.remove()
+        self.engine.dispose()
+
+
+def get_engine(resolvername, connect_string, encoding="latin1",
+               pool_size=POOL_SIZE, pool_timeout=POOL_TIMEOUT,
+               pool_recycle=POOL_RECYCLE):
+    """
+    Return the shared SQLEngine for the connect string and the pool options
+    in this process. It is created, if it does not exist, yet. Resolvers
+    with the same connect string and pool options use the same engine.
+    If the connect string or the pool options of the resolver changed, the
+    resolver releases its old engine.
+
+    :param resolvername: The name of the resolver, that uses the engine
+    :rtype: SQLEngine
+    """
+    key = (connect_string, encoding, pool_size, pool_timeout, pool_recycle)
+    with _engines_lock:
+        entry = _engines.get(key)
+        if entry is None:
+            entry = _engines[key] = (SQLEngine(connect_string, encoding,
+                                               pool_size, pool_timeout,
+                                               pool_recycle), set())
+        entry[1].add(resolvername)
+        old_key = _resolver_keys.get(resolvername)
+        _resolver_keys[resolvername] = key
+        released = []
+        if old_key is not None and old_key != key:
+            released = _release_engine(resolvername, old_key)
+    for sql_engine in released:
+        sql_engine.dispose()
+    return entry[0]
+
+
+def _release_engine(resolvername, key):
+    """
+    Remove the resolver from the users of the engine. Must be called with
+    the _engines_lock.
+
+    :return: list with the engine, if no other resolver uses it, so that it
+        can be disposed
+    """
+    entry = _engines.get(key)
+    if entry is None:  # pragma: no cover
+        return []
+    entry[1].discard(resolvername)
+    if entry[1]:
+        return []
+    del _engines[key]
+    return [entry[0]]
+
+
+def get_engine_stats():
+    """
+    Return the statistics of all engines of this process.
+
+    :return: list of dicts as returned by SQLEngine.get_stats with the
+        additional entry "resolvers", the sorted list of the names of the
+        resolvers, that use the engine
+    :rtype: list
+    """
+    with _engines_lock:
+        entries = [(sorted(resolvernames), sql_engine)
+                   for sql_engine, resolvernames in _engines.values()]
+    res = []
+    for resolvernames, sql_engine in entries:
+        stats = sql_engine.get_stats()
+        stats["resolvers"] = resolvernames
+        res.append(stats)
+    return res
+
+
+def release_engines(match):
+    """
+    Let the resolvers, that are selected by the match function, release
+    their engines. Engines, that are not used by any other resolver, are
+    removed and their pooled connections are closed.
+
+    :param match: function, that is called with the resolver name and the
+        key of its engine and returns True, if the resolver should release
+        the engine.
+    :return: The number of disposed engines
+    :rtype: int
+    """
+    released = []
+    with _engines_lock:
+        for resolvername, key in _resolver_keys.items():
+            if match(resolvername, key):
+                del _resolver_keys[resolvername]
+                released.extend(_release_engine(resolvername, key))
+    for sql_engine in released:
+        sql_engine.dispose()
+    return len(released)
+
+
+def clear_engines():
+    """
+    Remove all engines of this process and close their pooled connections.
+    """
+    release_engines(lambda resolvername, key: True)
+
 
 class PasswordHash(object):
 
@@ -291,11 +517,21 @@ class IdResolver (UserIdResolver):
         self.conParams = ""
         self.connect_string = ""
         self.session = None
-        self.pool_size = 10
-        self.pool_timeout = 120
+        self.pool_size = POOL_SIZE
+        self.pool_timeout = POOL_TIMEOUT
+        self.pool_recycle = POOL_RECYCLE
         self.engine = None
         return
 
+    def close(self):
+        """
+        Remove the session of this thread after the request. This ends the
+        transaction and returns the connection to the pool of the engine, so
+        that the next request reads the current data.
+        """
+        if self.session is not None:
+            self.session.remove()
+
     def getSearchFields(self):
         return self.searchFields
 
@@ -549,46 +785,68 @@ class IdResolver (UserIdResolver):
         self.map = yaml.load(usermap)
         self.reverse_map = dict([[v, k] for k, v in self.map.items()])
         self.where = config.get('Where', "")
-        self.encoding = str(config.get('Encoding') or "latin1")
         self.conParams = config.get('conParams', "")
-        self.pool_size = int(config.get('poolSize') or 5)
-        self.pool_timeout = int(config.get('poolTimeout') or 10)
-        
-        # create the connectstring like
-        params = {'Port': self.port,
-                  'Password': self.password,
-                  'conParams': self.conParams,
-                  'Driver': self.driver,
-                  'User': self.user,
-                  'Server': self.server,
-                  'Database': self.database}
-        self.connect_string = self._create_connect_string(params)
+        (self.connect_string, self.encoding, self.pool_size,
+         self.pool_timeout, self.pool_recycle) = self._get_engine_key(config)
         log.info("using the connect string {0!s}".format(self.connect_string))
-        try:
-            log.debug("using pool_size={0!s} and pool_timeout={1!s}".format(
-                      self.pool_size, self.pool_timeout))
-            self.engine = create_engine(self.connect_string,
-                                        encoding=self.encoding,
-                                        convert_unicode=False,
-                                        pool_size=self.pool_size,
-                                        pool_timeout=self.pool_timeout)
-        except TypeError:
-            # The DB Engine/Poolclass might not support the pool_size.
-            log.debug("connecting without pool_size.")
-            self.engine = create_engine(self.connect_string,
-                                        encoding=self.encoding,
-                                        convert_unicode=False)
-        # create a configured "Session" class
-        Session = sessionmaker(bind=self.engine)
+        if self.resolvername:
+            sql_engine = get_engine(self.resolvername, self.connect_string,
+                                    self.encoding, self.pool_size,
+                                    self.pool_timeout, self.pool_recycle)
+        else:
+            # An object without a resolver name is not a saved resolver, e.g.
+            # a test of the configuration. Its engine is not registered.
+            sql_engine = SQLEngine(self.connect_string, self.encoding,
+                                   self.pool_size, self.pool_timeout,
+                                   self.pool_recycle)
+        self.engine = sql_engine.engine
+        self.session = sql_engine.session
+        self.db = sql_engine.db
+        self.TABLE = sql_engine.entity(self.table)
 
-        # create a Session
-        self.session = Session()
-        self.session._model_changes = {}
-        self.db = SQLSoup(self.engine)
-        self.TABLE = self.db.entity(self.table)
-        
         return self
 
+    @classmethod
+    def _get_engine_key(cls, config):
+        """
+        Return the connect string and the pool options of the resolver
+        configuration.
+
+        :param config: The configuration from the Config Table
+        :type config: dict
+        :return: tuple of connect string, encoding, pool size, pool timeout
+            and pool recycle
+        """
+        # create the connectstring like
+        params = {'Port': config.get('Port', ""),
+                  'Password': config.get('Password', ""),
+                  'conParams': config.get('conParams', ""),
+                  'Driver': config.get('Driver', ""),
+                  'User': config.get('User', ""),
+                  'Server': config.get('Server', ""),
+                  'Database': config.get('Database', "")}
+        return (cls._create_connect_string(params),
+                str(config.get('Encoding') or "latin1"),
+                int(config.get('poolSize') or POOL_SIZE),
+                int(config.get('poolTimeout') or POOL_TIMEOUT),
+                int(config.get('poolRecycle') or POOL_RECYCLE))
+
+    @classmethod
+    def release_shared_resources(cls, resolvers):
+        """
+        Dispose the engines of the SQL resolvers, that were deleted or whose
+        connection or pool options changed.
+
+        :param resolvers: The existing resolvers as returned by
+            lib.resolver.get_resolver_list
+        """
+        keys = {}
+        for name, resolver in resolvers.items():
+            if resolver.get("type") == cls.getResolverType():
+                keys[name] = cls._get_engine_key(resolver.get("data", {}))
+        release_engines(lambda resolvername, key:
+                        keys.get(resolvername) != key)
+
     @classmethod
     def getResolverClassDescriptor(cls):
         descriptor = {}
@@ -606,7 +864,10 @@ class IdResolver (UserIdResolver):
                                 'Where': 'string',
                                 'Editable': 'int',
                                 'Encoding': 'string',
-                                'conParams': 'string'}
+                                'conParams': 'string',
+                                'poolSize': 'int',
+                                'poolTimeout': 'int',
+                                'poolRecycle': 'int'}
         return {typ: descriptor}
 
     @staticmethod
@@ -683,7 +944,12 @@ class IdResolver (UserIdResolver):
             desc = "Found {0:d} users.".format(num)
         except Exception as exx:
             desc = "failed to retrieve users: {0!s}".format(exx)
-            
+        finally:
+            # The engine of the test is not shared, so its connections are
+            # closed right away.
+            session.close()
+            engine.dispose()
+
         return num, desc
 
     def add_user(self, attributes=None):
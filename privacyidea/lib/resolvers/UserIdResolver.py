@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+# 2016-10-17   Add the resolver name and a hook to release the process wide
+#              resources of changed and deleted resolvers
 # 2015-06-05   Cornelius Kölbel <cornelius@privacyidea.org>
 #              Add interface to edit and add users
 # Dec 01, 2014 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -61,6 +63,9 @@ class UserIdResolver(object):
     name = ""
     id = "baseid"
     updateable = False
+    # The name of the resolver in the configuration. It is set by
+    # lib.resolver.get_resolver_object.
+    resolvername = ""
 
     def close(self):
         """
@@ -68,6 +73,18 @@ class UserIdResolver(object):
         """
         return
 
+    @classmethod
+    def release_shared_resources(cls, resolvers):
+        """
+        Hook to release the process wide resources like connection pools of
+        the resolvers of this class, that were changed or deleted. It is
+        called once in each process, when the resolver revision changed.
+
+        :param resolvers: The existing resolvers as returned by
+            lib.resolver.get_resolver_list
+        """
+        return
+
     @staticmethod
     def getResolverClassType():
         """
@@ -1,6 +1,19 @@
 # -*- coding: utf-8 -*-
 #  privacyIDEA is a fork of LinOTP
 #
+#  2016-10-17 Filter the tokeninfo by the digest of the value
+#  2016-10-17 Read the tokens, that are not in the OTP index, in chunks
+#  2016-10-17 Read only the candidates of the OTP index in get_token_by_otp
+#  2016-10-17 Write the tokeninfo at the end of check_token_list
+#  2016-10-17 Only commit the counters of check_token_list in a unit of
+#             work and send the challenges outside of it
+#  2016-10-16 Do not delete the expired challenges during the
+#             authentication
+#  2016-10-16 Filter tokens by several tokeninfo entries with indexed
+#             subqueries
+#  2016-10-16 Find the token of an OTP value with the OTP index
+#  2016-10-16 Commit the changes of check_token_list once
+#  2016-10-16 Load the tokeninfo of all tokens of get_tokens in bulk
 #  2015-10-14 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Add timelimit to user auth.
 #  2015-08-31 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -52,6 +65,8 @@ import datetime
 import binascii
 import os
 import logging
+from contextlib import contextmanager
+from itertools import chain
 
 from sqlalchemy import (and_, func)
 from privacyidea.lib.error import (TokenAdminError,
@@ -59,11 +74,14 @@ from privacyidea.lib.error import (TokenAdminError,
                                    privacyIDEAError)
 from privacyidea.lib.decorators import (check_user_or_serial,
                                         check_copy_serials)
-from privacyidea.lib.tokenclass import TokenClass
+from privacyidea.lib.tokenclass import (TokenClass, flush_tokeninfo,
+                                        tokeninfo_buffer)
+from privacyidea.lib.otpindex import (filter_otp_candidates,
+                                      filter_not_indexed, iter_token_chunks)
 from privacyidea.lib.utils import generate_password
 from privacyidea.lib.log import log_with
 from privacyidea.models import (Token, Realm, TokenRealm, Challenge,
-                                MachineToken, TokenInfo)
+                                MachineToken, TokenInfo, unit_of_work)
 from privacyidea.lib.config import get_from_config
 from privacyidea.lib.config import (get_token_class, get_token_prefix,
                                     get_token_types,
@@ -232,12 +250,19 @@ def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
 
     if tokeninfo is not None:
         # Filter for tokens with token token.info.<key> and token.info.<value>
-        if len(tokeninfo) != 1:
-            raise privacyIDEAError("I can only create SQL filters from "
-                                   "tokeninfo of length 1.")
-        sql_query = sql_query.filter(TokenInfo.Key == tokeninfo.keys()[0])
-        sql_query = sql_query.filter(TokenInfo.Value == tokeninfo.values()[0])
-        sql_query = sql_query.filter(TokenInfo.token_id == Token.id)
+        # The buffered tokeninfo of this request needs to be in the database
+        flush_tokeninfo()
+        # Each entry is a subquery, that uses the index tiix_3. A correlated
+        # EXISTS would be evaluated for each token by SQLite.
+        # The index contains the digest of the value, so the value itself is
+        # compared, too.
+        for key, value in tokeninfo.items():
+            info_query = TokenInfo.query.with_entities(TokenInfo.token_id)
+            info_query = info_query.filter(and_(
+                TokenInfo.Key == key,
+                TokenInfo.ValueHash == TokenInfo.get_value_hash(value),
+                TokenInfo.Value == value))
+            sql_query = sql_query.filter(Token.id.in_(info_query.subquery()))
 
     return sql_query
 
@@ -246,7 +271,8 @@ def _create_token_query(tokentype=None, realm=None, assigned=None, user=None,
 #@cache.memoize(10)
 def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
                serial=None, active=None, resolver=None, rollout_state=None,
-               count=False, revoked=None, locked=None, tokeninfo=None):
+               count=False, revoked=None, locked=None, tokeninfo=None,
+               load_info=False):
     """
     (was getTokensOfType)
     This function returns a list of token objects of a
@@ -286,8 +312,11 @@ def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
     :param locked: Only search for locked tokens or only for not locked tokens
     :type locked: bool
     :param tokeninfo: Return tokens with the given tokeninfo. The tokeninfo
-        is a key/value dictionary
+        is a key/value dictionary. The tokens need to have all given entries.
     :type tokeninfo: dict
+    :param load_info: If set to True, the tokeninfo of all returned tokens
+        is read with a single query instead of one query per token.
+    :type load_info: bool
 
     :return: A list of tokenclasses (lib.tokenclass)
     :rtype: list
@@ -306,7 +335,10 @@ def get_tokens(tokentype=None, realm=None, assigned=None, user=None,
         ret = sql_query.count()
     else:
         # Return a simple, flat list of tokenobjects
-        for token in sql_query.all():
+        db_tokens = sql_query.all()
+        if load_info:
+            Token.load_info(db_tokens)
+        for token in db_tokens:
             # the token is the database object, but we want an instance of the
             # tokenclass!
             tokenobject = create_tokenclass_object(token)
@@ -377,6 +409,8 @@ def get_tokens_paginate(tokentype=None, realm=None, assigned=None, user=None,
     pagination = sql_query.paginate(page, per_page=psize,
                                     error_out=False)
     tokens = pagination.items
+    # get_as_dict returns the tokeninfo of all tokens of the page
+    Token.load_info(tokens)
     prev = None
     if pagination.has_prev:
         prev = page-1
@@ -700,18 +734,56 @@ def get_multi_otp(serial, count=0, epoch_start=0, epoch_end=0,
 
 
 
+def _get_otp_token_chunks(sql_query, otp, window):
+    """
+    Yield the token objects, that need to be checked for an OTP value, in
+    chunks. The first chunk are the candidates of the OTP index, the
+    following chunks are the tokens, that can not be answered by the index.
+
+    :param sql_query: The query of the tokens, that should be searched
+    :return: generator of lists of token objects
+    """
+    checked = set()
+    db_token_chunks = chain([filter_otp_candidates(sql_query, otp,
+                                                   window).all()],
+                            iter_token_chunks(filter_not_indexed(sql_query,
+                                                                 window)))
+    for db_tokens in db_token_chunks:
+        token_chunk = []
+        for db_token in db_tokens:
+            if db_token.id not in checked:
+                checked.add(db_token.id)
+                tokenobject = create_tokenclass_object(db_token)
+                if isinstance(tokenobject, TokenClass):
+                    token_chunk.append(tokenobject)
+        yield token_chunk
+
+
 @log_with(log)
-def get_token_by_otp(token_list, otp="", window=10):
+def get_token_by_otp(token_list=None, otp="", window=10, tokentype=None,
+                     serial=None, assigned=None):
     """
     search the token in the token_list, that creates the given OTP value.
     The tokenobject_list would be created by get_tokens()
 
+    If no token_list is given, the tokens are read from the database with the
+    given filters. The event based tokens are looked up in the OTP index
+    lib.otpindex. Only the matching tokens and the tokens, that can not be
+    answered by the index, are read in chunks and checked with
+    check_otp_exist.
+
     :param token_list: the list of token objects to be investigated
     :type token_list: list of token objects
     :param otp: the otp value, that needs to be found
     :type otp: basestring
     :param window: the window of search
     :type window: int
+    :param tokentype: Only search the tokens of this type
+    :param serial: Only search the tokens with this serial number, which
+        may contain "*"
+    :param assigned: Only search assigned (True) or not assigned (False)
+        tokens
+    :type assigned: bool
 
     :return: The token, that creates this OTP value
     :rtype: Tokenobject
@@ -719,12 +791,20 @@ def get_token_by_otp(token_list, otp="", window=10):
     result_token = None
     result_list = []
 
-    for token in token_list:
-        log.debug("checking token {0!r}".format(token.get_serial()))
-        r = token.check_otp_exist(otp=otp, window=window)
-        log.debug("result = {0:d}".format(int(r)))
-        if r >= 0:
-            result_list.append(token)
+    if token_list is None:
+        sql_query = _create_token_query(tokentype=tokentype, serial=serial,
+                                        assigned=assigned)
+        token_chunks = _get_otp_token_chunks(sql_query, otp, window)
+    else:
+        token_chunks = [token_list]
+
+    for token_chunk in token_chunks:
+        for token in token_chunk:
+            log.debug("checking token {0!r}".format(token.get_serial()))
+            r = token.check_otp_exist(otp=otp, window=window)
+            log.debug("result = {0:d}".format(int(r)))
+            if r >= 0:
+                result_list.append(token)
 
     if len(result_list) == 1:
         result_token = result_list[0]
@@ -736,27 +816,35 @@ def get_token_by_otp(token_list, otp="", window=10):
 
 
 @log_with(log)
-def get_serial_by_otp(token_list, otp="", window=10):
+def get_serial_by_otp(token_list=None, otp="", window=10, tokentype=None,
+                      serial=None, assigned=None):
     """
     Returns the serial for a given OTP value
     The tokenobject_list would be created by get_tokens()
+    If no token_list is given, the tokens are searched with the OTP index.
+    See get_token_by_otp.
 
     :param token_list: the list of token objects to be investigated
     :type token_list: list of token objects
     :param otp: the otp value, that needs to be found
     :param window: the window of search
     :type window: int
+    :param tokentype: Only search the tokens of this type
+    :param serial: Only search the tokens with this serial number
+    :param assigned: Only search assigned or not assigned tokens
+    :type assigned: bool
 
     :return: the serial for a given OTP value and the user
     :rtype: basestring
     """
-    serial = None
-    token = get_token_by_otp(token_list, otp=otp, window=window)
+    token = get_token_by_otp(token_list, otp=otp, window=window,
+                             tokentype=tokentype, serial=serial,
+                             assigned=assigned)
 
     if token is not None:
-        serial = token.get_serial()
+        return token.get_serial()
 
-    return serial
+    return None
 
 
 @log_with(log)
@@ -960,7 +1048,7 @@ def remove_token(serial=None, user=None):
         TokenRealm.query.filter(TokenRealm.token_id ==
                                 tokenobject.token.id).delete()
 
-        tokenobject.token.delete()
+        tokenobject.delete_token()
 
     return token_count
 
@@ -1730,7 +1818,8 @@ def check_realm_pass(realm, passw, options=None):
     # since an attacker does not know, which token is tested, we restrict to
     # only active tokens. He would not guess that the given OTP value is that
     #  of an inactive token.
-    tokenobject_list = get_tokens(realm=realm, assigned=True, active=True)
+    tokenobject_list = get_tokens(realm=realm, assigned=True, active=True,
+                                  load_info=True)
     if not tokenobject_list:
         res = False
         reply_dict["message"] = "There is no active and assigned token in " \
@@ -1762,7 +1851,7 @@ def check_serial_pass(serial, passw, options=None):
     :rtype: tuple
     """
     reply_dict = {}
-    tokenobject_list = get_tokens(serial=serial)
+    tokenobject_list = get_tokens(serial=serial, load_info=True)
     if not tokenobject_list:
         # The serial does not exist
         res = False
@@ -1798,7 +1887,7 @@ def check_user_pass(user, passw, options=None):
     :return: tuple of result (True, False) and additional dict
     :rtype: tuple
     """
-    tokenobject_list = get_tokens(user=user)
+    tokenobject_list = get_tokens(user=user, load_info=True)
     reply_dict = {}
     if not tokenobject_list:
         # The user has no tokens assigned
@@ -1813,6 +1902,17 @@ def check_user_pass(user, passw, options=None):
     return res, reply_dict
 
 
+@contextmanager
+def _counter_update():
+    """
+    Commit the changes of the counters and the buffered tokeninfo in one
+    short unit of work.
+    """
+    with unit_of_work():
+        yield
+        flush_tokeninfo()
+
+
 @log_with(log)
 def check_token_list(tokenobject_list, passw, user=None, options=None):
     """
@@ -1833,6 +1933,21 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
     :return: tuple of success and optional response
     :rtype: (bool, dict)
     """
+    # The tokeninfo of the tokens is written once at the end of the check.
+    with tokeninfo_buffer():
+        return _check_token_list(tokenobject_list, passw, user=user,
+                                 options=options)
+
+
+def _check_token_list(tokenobject_list, passw, user=None, options=None):
+    """
+    The implementation of check_token_list, which buffers the tokeninfo.
+    """
+    # The OTP counter is protected against reuse by an atomic conditional
+    # update, which is committed at once. The following changes of the
+    # counters of each result are committed in a short unit of work, so that
+    # no row lock is held while challenges are sent or other tokens are
+    # checked.
     res = False
     reply_dict = {}
 
@@ -1918,21 +2033,22 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
         # We need to return success
         message_list = ["matching {0:d} tokens".format(len(valid_token_list))]
         # write serial numbers or something to audit log
-        for token_obj in valid_token_list:
-            token_obj.inc_count_auth()
-            token_obj.inc_count_auth_success()
-            # Check if the max auth is succeeded
-            if token_obj.check_all(message_list):
-                # The token is active and the auth counters are ok.
-                res = True
-                # reset the failcounter
-                try:
-                    token_obj.reset()
-                except Exception:
-                    # In some cases (Registration Token) the token does not
-                    # exist anymore. So this would bail an exception!
-                    log.debug("registration token does not exist anymore and "
-                              "cannot be resetted.")
+        with _counter_update():
+            for token_obj in valid_token_list:
+                token_obj.inc_count_auth()
+                token_obj.inc_count_auth_success()
+                # Check if the max auth is succeeded
+                if token_obj.check_all(message_list):
+                    # The token is active and the auth counters are ok.
+                    res = True
+                    # reset the failcounter
+                    try:
+                        token_obj.reset()
+                    except Exception:
+                        # In some cases (Registration Token) the token does
+                        # not exist anymore. So this would bail an exception!
+                        log.debug("registration token does not exist anymore "
+                                  "and cannot be resetted.")
         if len(valid_token_list) == 1:
             # If only one token was found, we add the serial number and token
             #  type
@@ -1947,13 +2063,13 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
                                                     options=options) >= 0:
                 # OTP matches
                 res = True
-                tokenobject.inc_count_auth()
-                tokenobject.inc_count_auth_success()
+                with _counter_update():
+                    tokenobject.inc_count_auth()
+                    tokenobject.inc_count_auth_success()
+                    # Reset the fail counter of the challenge response token
+                    tokenobject.reset()
                 reply_dict["message"] = "Found matching challenge"
                 reply_dict["serial"] = challenge_response_token_list[0].token.serial
-                tokenobject.challenge_janitor()
-                # Reset the fail counter of the challenge response token
-                tokenobject.reset()
 
     elif challenge_request_token_list:
         # A challenge token was found.
@@ -1981,7 +2097,10 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
         # But there are tokens, with a matching pin.
         # So we increase the failcounter. Return failure.
         for tokenobject in pin_matching_token_list:
-            tokenobject.inc_failcount()
+            with _counter_update():
+                tokenobject.inc_failcount()
+                for token_obj in pin_matching_token_list:
+                    token_obj.inc_count_auth()
             reply_dict["message"] = "wrong otp value"
             if len(pin_matching_token_list) == 1:
                 # If there is only one pin matching token, we look if it was
@@ -1990,8 +2109,6 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
                 _r, pin, otp = token.split_pin_pass(passw)
                 if token.is_previous_otp(otp):
                     reply_dict["message"] += ". previous otp used again"
-            for token_obj in pin_matching_token_list:
-                token_obj.inc_count_auth()
             # write the serial numbers to the audit log
             if len(pin_matching_token_list) == 1:
                 reply_dict["serial"] = pin_matching_token_list[0].token.serial
@@ -2003,9 +2120,10 @@ def check_token_list(tokenobject_list, passw, user=None, options=None):
         # Depending of IncFailCountOnFalsePin, we increase the failcounter.
         reply_dict["message"] = "wrong otp pin"
         if get_inc_fail_count_on_false_pin():
-            for tokenobject in invalid_token_list:
-                tokenobject.inc_failcount()
-                tokenobject.inc_count_auth()
+            with _counter_update():
+                for tokenobject in invalid_token_list:
+                    tokenobject.inc_failcount()
+                    tokenobject.inc_count_auth()
 
     return res, reply_dict
 
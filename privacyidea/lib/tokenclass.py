@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 #  privacyIDEA is a fork of LinOTP
 #
+#  2016-10-17 Return -1 from inc_otp_counter, if the counter was already used
+#  2016-10-17 Only buffer the tokeninfo writes within tokeninfo_buffer
+#  2016-10-16 Delete the expired challenges in the background
+#  2016-10-16 Increase the OTP counter with an atomic conditional update
+#  2016-10-16 Buffer the tokeninfo writes until the end of the request
+#  2016-10-16 Add get_hotp_parameters for the OTP index
 #  2015-12-18 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Add get_setting_type
 #  2015-10-12 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -53,6 +59,8 @@ in the privacyidea.ini file.
 import logging
 import hashlib
 import datetime
+import threading
+from contextlib import contextmanager
 
 from .error import (TokenAdminError,
                     ParameterError)
@@ -66,7 +74,7 @@ from .utils import create_img
 from .user import (User,
                    get_username)
 from ..models import (TokenRealm, Challenge, cleanup_challenges)
-from .challenge import get_challenges
+from .challenge import get_challenges, start_challenge_janitor
 from .crypto import encryptPassword
 from .crypto import decryptPassword
 from .policydecorators import libpolicy, auth_otppin, challenge_response_allowed
@@ -79,12 +87,79 @@ required = False
 log = logging.getLogger(__name__)
 
 
+# The database token objects of the current thread, whose tokeninfo is
+# buffered
+_tokeninfo_buffer = threading.local()
+
+
+@contextmanager
+def tokeninfo_buffer():
+    """
+    Within the context the tokeninfo of the tokens is not written with each
+    change but once at the end of the context. If the tokeninfo can not be
+    written, the exception is raised.
+    Contexts can be nested. Only the outermost writes the tokeninfo.
+
+    Usage::
+
+        with tokeninfo_buffer():
+            token.add_tokeninfo("key1", "value1")
+            token.add_tokeninfo("key2", "value2")
+    """
+    if getattr(_tokeninfo_buffer, "tokens", None) is not None:
+        yield
+        return
+    _tokeninfo_buffer.tokens = set()
+    try:
+        yield
+        flush_tokeninfo()
+    finally:
+        _tokeninfo_buffer.tokens = None
+
+
+def buffer_tokeninfo(db_token):
+    """
+    Remember a database token object, whose tokeninfo is written at the end
+    of the tokeninfo_buffer by flush_tokeninfo.
+    Outside of a tokeninfo_buffer the tokeninfo needs to be written
+    immediately.
+
+    :param db_token: The database token object
+    :return: True, if the tokeninfo of the token is buffered
+    :rtype: bool
+    """
+    tokens = getattr(_tokeninfo_buffer, "tokens", None)
+    if tokens is None:
+        return False
+    tokens.add(db_token)
+    return True
+
+
+def flush_tokeninfo():
+    """
+    Write the buffered tokeninfo of all tokens to the database. This is
+    called at the end of the tokeninfo_buffer and before the tokeninfo is
+    used in an SQL query.
+
+    :return: The number of written tokeninfo entries
+    :rtype: int
+    """
+    written = 0
+    tokens = getattr(_tokeninfo_buffer, "tokens", None)
+    while tokens:
+        db_token = tokens.pop()
+        written += db_token.flush_info()
+    return written
+
+
 class TokenClass(object):
 
     # Class properties
     using_pin = True
     hKeyRequired = False
     mode = ['authenticate', 'challenge']
+    # The OTP values of the token are added to the OTP index lib.otpindex
+    otp_index = False
 
     @log_with(log)
     def __init__(self, db_token):
@@ -251,7 +326,7 @@ class TokenClass(object):
                     orig_key = ".".join(k.split(".")[:-1])
                     info[orig_key] = encryptPassword(info.get(orig_key, ""))
 
-        self.token.set_info(info)
+        self.token.set_info(info, flush=not buffer_tokeninfo(self.token))
 
     @check_token_locked
     def add_tokeninfo(self, key, value, value_type=None):
@@ -267,7 +342,7 @@ class TokenClass(object):
             if value_type == "password":
                 # encrypt the value
                 add_info[key] = encryptPassword(value)
-        self.token.set_info(add_info)
+        self.token.set_info(add_info, flush=not buffer_tokeninfo(self.token))
 
     @check_token_locked
     def check_otp(self, otpval, counter=None, window=None, options=None):
@@ -585,6 +660,30 @@ class TokenClass(object):
         self.token.count = int(otpCount)
         self.token.save()
 
+    @check_token_locked
+    def advance_otp_count(self, otpCount, reset_failcount=False):
+        """
+        Store the counter after a matching OTP value. Other than
+        set_otp_count the counter is only increased. This is done by an
+        atomic conditional update, so that an OTP value can not be used by
+        two concurrent requests.
+
+        :param otpCount: The new OTP counter
+        :type otpCount: int
+        :param reset_failcount: Also reset the failcounter, if the counter
+            was increased
+        :type reset_failcount: bool
+        :return: True, if the counter was increased. False, if the OTP value
+            was already used.
+        :rtype: bool
+        """
+        r = self.token.update_counter(int(otpCount),
+                                      reset_failcount=reset_failcount)
+        if not r:
+            log.warning("The OTP counter {0!s} of token {1!s} was already "
+                        "used.".format(otpCount, self.token.serial))
+        return r
+
     @check_token_locked
     def set_pin(self, pin, encrypt=False):
         """
@@ -975,24 +1074,30 @@ class TokenClass(object):
         :type counter: int
         :param reset: reset the failcounter if set to True
         :type reset: bool
-        :return: the new counter value
+        :return: the new counter value or -1, if the counter was already
+            used by a concurrent request. In this case the OTP value must be
+            rejected.
+        :rtype: int
         """
         resetCounter = False
         if counter:
-            self.token.count = counter + 1
+            new_count = counter + 1
         else:
-            self.token.count += 1
+            new_count = self.token.count + 1
 
         if reset is True:
             if get_from_config("DefaultResetFailCount") == "True":
                 resetCounter = True
 
-        if resetCounter and self.token.active:
-            if self.token.failcount < self.token.maxfail:
-                self.token.failcount = 0
+        reset_failcount = (resetCounter and self.token.active and
+                           self.token.failcount < self.token.maxfail)
 
-        # make DB persistent immediately, to avoud the reusage of the counter
-        self.token.save()
+        # The counter and the failcounter are written by one atomic
+        # conditional update, to avoid the reusage of the counter by a
+        # concurrent request.
+        if not self.advance_otp_count(new_count,
+                                      reset_failcount=reset_failcount):
+            return -1
         return self.token.count
 
     def check_otp_exist(self, otp, window=None):
@@ -1008,6 +1113,18 @@ class TokenClass(object):
         """
         return -1
 
+    def get_hotp_parameters(self):
+        """
+        Return the parameters of the HMAC based OTP values of an event based
+        token. With these parameters the OTP values are added to the OTP
+        index lib.otpindex.
+
+        :return: tuple of the counter, the OTP length and the name of the
+            hashlib or None, if the token does not create HOTP values.
+        :rtype: tuple
+        """
+        return None
+
     def is_previous_otp(self, otp, window=10):
         """
         checks if a given OTP value is a previous OTP value, that lies in the
@@ -1160,9 +1277,9 @@ class TokenClass(object):
                  |                       |
                  V                       V
         create_challenge        check_challenge
-                 |                       |
-                 V                       V
-        challenge_janitor       challenge_janitor
+
+        The expired challenges are deleted by the ChallengeJanitor in the
+        background (see lib.challenge).
 
         :param passw: password, which might be pin or pin+otp
         :type passw: string
@@ -1263,13 +1380,15 @@ class TokenClass(object):
                         # increase the received_count
                         challengeobject.set_otp_status()
 
-        self.challenge_janitor()
+        start_challenge_janitor()
         return otp_counter
 
     @staticmethod
     def challenge_janitor():
         """
         Just clean up all challenges, for which the expiration has expired.
+        This is not called during the authentication. The expired
+        challenges are deleted by the ChallengeJanitor in the background.
 
         :return: None
         """
@@ -1314,7 +1433,7 @@ class TokenClass(object):
                                  session=options.get("session"),
                                  validitytime=validity)
         db_challenge.save()
-        self.challenge_janitor()
+        start_challenge_janitor()
         return True, message, db_challenge.transaction_id, attributes
 
     def get_as_dict(self):
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-16 Check the OTP window with already known OTP values
+#  2016-10-16 Check the OTP window with a reused keyed HMAC state and
+#             integer comparison
+#
 #  privacyIDEA is a fork of LinOTP
 #  May 08, 2014 Cornelius Kölbel
 #  License:  AGPLv3
@@ -47,6 +51,12 @@ pver = float(int(ma) + int(mi) * 0.1)
 log = logging.getLogger(__name__)
 
 
+# The packing of the 64 bit counter and the unpacking of the 31 bit value
+# of the dynamic truncation (RFC 4226, 5.3)
+_COUNTER = struct.Struct(">Q")
+_TRUNCATED = struct.Struct(">I")
+
+
 class HmacOtp(object):
 
     def __init__(self, secObj=None, counter=0, digits=6, hashfunc=sha1):
@@ -54,6 +64,26 @@ class HmacOtp(object):
         self.counter = int(counter)
         self.digits = digits
         self.hashfunc = hashfunc
+        # The keyed HMAC objects, that are copied for each calculation
+        self._hmac_states = {}
+
+    def _hmac_state(self, key=None):
+        """
+        Return the keyed HMAC object for the given key or the key of the
+        secret object. The key is only decrypted and the HMAC is only set up
+        once. Each calculation works on a copy of this object.
+
+        :param key: the binary key or None to use the secret object
+        :return: hmac object without data
+        """
+        state = self._hmac_states.get(key)
+        if state is None:
+            if key is None:
+                state = self.secretObj.hmac_state(self.hashfunc)
+            else:
+                state = hmac.new(key, digestmod=self.hashfunc)
+            self._hmac_states[key] = state
+        return state
 
     def hmac(self,
              counter=None,
@@ -74,28 +104,17 @@ class HmacOtp(object):
         # When using a counter, we can only use 64bit as data_input.
         # When we allow a raw data_input, we could use 160bit or more.
         if not challenge:
-            data_input = struct.pack(">Q", counter)
+            data_input = _COUNTER.pack(counter)
         else:
             data_input = binascii.unhexlify(challenge)
 
-        if key is None:
-            dig = str(self.secretObj.hmac_digest(data_input, self.hashfunc))
-        else:
-            if pver > 2.6:
-                dig = hmac.new(key, data_input, self.hashfunc).digest()
-            else:
-                dig = hmac.new(key, str(data_input), self.hashfunc).digest()
-
-        return dig
+        h = self._hmac_state(key).copy()
+        h.update(data_input)
+        return h.digest()
 
     def truncate(self, digest):
         offset = ord(digest[-1:]) & 0x0f
-
-        binary = (ord(digest[offset + 0]) & 0x7f) << 24
-        binary |= (ord(digest[offset + 1]) & 0xff) << 16
-        binary |= (ord(digest[offset + 2]) & 0xff) << 8
-        binary |= (ord(digest[offset + 3]) & 0xff)
-
+        binary = _TRUNCATED.unpack_from(digest, offset)[0] & 0x7fffffff
         return binary % (10 ** self.digits)
 
     def generate(self,
@@ -121,9 +140,8 @@ class HmacOtp(object):
         else:
             hmac = self.hmac(counter=counter, key=key)
         if do_truncation:
-            otp = str(self.truncate(hmac))
-            """  fill in the leading zeros  """
-            sotp = (self.digits - len(otp)) * "0" + otp
+            # fill in the leading zeros
+            sotp = "{0:0{1:d}d}".format(self.truncate(hmac), self.digits)
         else:
             sotp = binascii.hexlify(hmac)
             
@@ -131,9 +149,53 @@ class HmacOtp(object):
             self.counter = counter + 1
         return sotp
 
+    def find_counter(self, otp, start, end, values=None):
+        """
+        Search the counters from start to end (exclusive) for the given OTP
+        value.
+
+        All HMACs are calculated from copies of one keyed HMAC object and
+        the truncated values are compared as integers.
+
+        :param otp: The OTP value
+        :type otp: basestring
+        :param start: The first counter
+        :param end: The counter after the last counter
+        :param values: The already known truncated OTP values as dictionary
+            {counter: int}. The calculated values are added.
+        :type values: dict
+        :return: the counter of the OTP value or -1
+        :rtype: int
+        """
+        otp = unicode(otp)
+        # An OTP value with a wrong length or other characters than the
+        # digits 0-9 can not match
+        if len(otp) != self.digits or otp.strip(u"0123456789"):
+            return -1
+        target = int(otp)
+        modulo = 10 ** self.digits
+        state = None
+        pack = _COUNTER.pack
+        unpack_from = _TRUNCATED.unpack_from
+        if values is None:
+            values = {}
+        for c in xrange(start, end):
+            value = values.get(c)
+            if value is None:
+                if state is None:
+                    state = self._hmac_state()
+                h = state.copy()
+                h.update(pack(c))
+                digest = h.digest()
+                offset = ord(digest[-1]) & 0x0f
+                value = (unpack_from(digest, offset)[0] & 0x7fffffff) % modulo
+                values[c] = value
+            if value == target:
+                return c
+        return -1
+
     @log_with(log)
-    def checkOtp(self, anOtpVal, window, symetric=False):
-        res = -1
+    def checkOtp(self, anOtpVal, window, symetric=False, values=None):
         start = self.counter
         end = self.counter + window
         if symetric is True:
@@ -143,12 +205,7 @@ class HmacOtp(object):
             end = self.counter + (window)
 
         log.debug("OTP range counter: {0!r} - {1!r}".format(start, end))
-        for c in range(start, end):
-            otpval = self.generate(c)
-            log.debug("calculating counter {0!r}: {1!r} {2!r}".format(c, anOtpVal, otpval))
-
-            if unicode(otpval) == unicode(anOtpVal):
-                res = c
-                break
+        res = self.find_counter(anOtpVal, start, end, values=values)
+        log.debug("OTP value found at counter {0!r}".format(res))
         # return -1 or the counter
         return res
@@ -7,6 +7,7 @@
 #
 #  2015-01-29 Adapt during migration to flask
 #             Cornelius Kölbel <cornelius@privacyidea.org>
+#  2016-10-16 The Daplug OTP values are not indexed
 #
 #
 #
@@ -83,6 +84,7 @@ class DaplugTokenClass(HotpTokenClass):
     """
     daplug token class implementation
     """
+    otp_index = False
 
     @staticmethod
     def get_class_type():
@@ -156,6 +158,12 @@ class DaplugTokenClass(HotpTokenClass):
         res = HotpTokenClass.check_otp(self, otp, counter, window, options)
         return res
 
+    def get_hotp_parameters(self):
+        """
+        The Daplug OTP values are not indexed.
+        """
+        return None
+
     @log_with(log)
     def check_otp_exist(self, otp, window=10):
         """
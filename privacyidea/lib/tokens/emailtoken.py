@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Reject the OTP value, if the counter was used concurrently
 #  2015-12-29 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             Use privacyidea.lib.smtpserver instead of smtplib
 #  2015-10-12 Cornelius Kölbel <cornelius.koelbel@netknights.it>
@@ -226,7 +227,13 @@ class EmailTokenClass(HotpTokenClass):
         if self.is_active() is True:
             counter = self.get_otp_count()
             log.debug("counter={0!r}".format(counter))
-            self.inc_otp_counter(counter, reset=False)
+            if self.inc_otp_counter(counter, reset=False) < 0:
+                # A concurrent request sent the OTP value of this counter
+                return_message = "The OTP value was already sent."
+                log.warning("The OTP counter {0!r} of token {1!r} was used "
+                            "by a concurrent request.".format(
+                                counter, self.token.serial))
+                return success, return_message, transactionid, attributes
             # At this point we must not bail out in case of an
             # Gateway error, since checkPIN is successful. A bail
             # out would cancel the checking of the other tokens
@@ -280,7 +287,7 @@ class EmailTokenClass(HotpTokenClass):
                 subject = self._get_email_text_or_subject(options,
                                                           action=EMAILACTION.EMAILSUBJECT,
                                                           default="Your OTP")
-                self.inc_otp_counter(ret, reset=False)
+                # HotpTokenClass.check_otp already increased the counter
                 success, message = self._compose_email(message=message,
                                                     subject=subject)
                 log.debug("AutoEmail: send new SMS: {0!s}".format(success))
@@ -5,6 +5,10 @@
 #  License: AGPLv3
 #  contact: http://www.privacyidea.org
 #
+#  2016-10-17 Reject the OTP value, if the counter was used concurrently
+#  2016-10-17 Move the OTP index forward, when the counter advances
+#  2016-10-17 Remove the token from the OTP index, when the key changes
+#  2016-10-16 Keep the OTP index current, when the counter changes
 #  2014-10-03 Add getInitDetail
 #             Cornelius Kölbel <cornelius@privacyidea.org>
 #
@@ -38,6 +42,8 @@ from .HMAC import HmacOtp
 from privacyidea.api.lib.utils import getParam
 from privacyidea.lib.config import get_from_config
 from privacyidea.lib.tokenclass import TokenClass
+from privacyidea.lib.otpindex import (remove_from_otp_index,
+                                      advance_otp_index)
 from privacyidea.lib.log import log_with
 from privacyidea.lib.apps import create_google_authenticator_url as cr_google
 from privacyidea.lib.apps import create_oathtoken_url as cr_oath
@@ -64,6 +70,7 @@ class HotpTokenClass(TokenClass):
     """
     hotp token class implementation
     """
+    otp_index = True
 
     @staticmethod
     def get_class_type():
@@ -249,6 +256,22 @@ class HotpTokenClass(TokenClass):
             self.set_otplen(get_from_config("DefaultOtpLen", 6))
 
         TokenClass.update(self, upd_param, reset_failcount)
+        # The OTP key or the algorithm might have changed
+        remove_from_otp_index(self.token.id)
+
+    def set_otp_count(self, otpCount):
+        TokenClass.set_otp_count(self, otpCount)
+        if self.otp_index:
+            # The counter might have been set back
+            remove_from_otp_index(self.token.id)
+
+    @check_token_locked
+    def advance_otp_count(self, otpCount, reset_failcount=False):
+        r = TokenClass.advance_otp_count(self, otpCount,
+                                         reset_failcount=reset_failcount)
+        if r and self.otp_index:
+            advance_otp_index(self)
+        return r
 
     @property
     def hashlib(self):
@@ -256,6 +279,14 @@ class HotpTokenClass(TokenClass):
                      get_from_config("hotp.hashlib", u'sha1')
         return hashlibStr
 
+    def get_hotp_parameters(self):
+        """
+        Return the counter, the OTP length and the hashlib of the token.
+
+        :return: tuple of counter, OTP length and name of the hashlib
+        """
+        return int(self.token.count), int(self.token.otplen), self.hashlib
+
     # challenge interfaces starts here
     @log_with(log)
     @challenge_response_allowed
@@ -314,9 +345,11 @@ class HotpTokenClass(TokenClass):
 
         if -1 == res:
             res = self._autosync(hmac2Otp, anOtpVal)
-        else:
+        if res != -1:
             # on success, we save the counter
-            self.set_otp_count(res + 1)
+            if not self.advance_otp_count(res + 1):
+                # A concurrent request used this OTP value
+                res = -1
             # We could also store it temporarily
             # self.auth_details["matched_otp_counter"] = res
 
@@ -350,7 +383,9 @@ class HotpTokenClass(TokenClass):
         if inc_counter and res >= 0:
             # As usually the counter is increased in lib.token.checkUserPass,
             # we need to do this manually here:
-            self.inc_otp_counter(res)
+            if self.inc_otp_counter(res) < 0:
+                # A concurrent request used this OTP value
+                res = -1
         if res == -1:
             msg = "otp counter {0!r} was not found".format(otp)
         else:
@@ -486,8 +521,12 @@ class HotpTokenClass(TokenClass):
                       "%r != otp2: %r ret: %r" % (nextOtp, otp2, ret))
             return ret
 
+        if self.inc_otp_counter(counter + 1, True) < 0:
+            log.debug("exit. The counter was used by a concurrent request: "
+                      "ret: {0!r}".format(ret))
+            return ret
+
         ret = True
-        self.inc_otp_counter(counter + 1, True)
 
         log.debug("end. resync was successful: ret: {0!r}".format((ret)))
         return ret
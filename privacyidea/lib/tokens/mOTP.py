@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+#
+#  2016-10-16 Calculate the suffix of the hashed data only once per check
+#
 #  privacyIDEA is a fork of LinOTP
 #  May 08, 2014 Cornelius Kölbel
 #  License:  AGPLv3
@@ -106,9 +109,12 @@ class mTimeOtp(object):
             pin = self.secPin.getKey()
 
 
-        for i in range(otime - window, otime + window):
-            otp = unicode(self.calcOtp(i, key, pin))
-            if unicode(anOtpVal) == otp:
+        # The key and the pin are the same for all tested times
+        suffix = "{0!s}{1!s}".format(key, pin)
+        otp_value = unicode(anOtpVal)
+        digits = self.digits
+        for i in xrange(otime - window, otime + window):
+            if md5(str(i) + suffix).hexdigest()[:digits] == otp_value:
                 res = i
                 log.debug("otpvalue {0!r} found at: {1!r}".format(anOtpVal, res))
                 break
@@ -222,6 +222,8 @@ class MotpTokenClass(TokenClass):
 
         if res != -1:
             # on success, we have to save the last attempt
-            self.set_otp_count(res)
+            if not self.advance_otp_count(res):
+                # A concurrent request used this OTP value
+                res = -1
 
         return res
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 #
 #  http://www.privacyidea.org
+#  2016-10-16 Delete the expired challenges in the background
 #  2015-12-16 Initial writeup.
 #             Cornelius Kölbel <cornelius@privacyidea.org>
 #
@@ -31,7 +32,8 @@ from privacyidea.lib.log import log_with
 from privacyidea.lib.error import TokenAdminError
 import logging
 from privacyidea.models import Challenge
-from privacyidea.lib.challenge import get_challenges
+from privacyidea.lib.challenge import (get_challenges,
+                                       start_challenge_janitor)
 import gettext
 from privacyidea.lib.decorators import check_token_locked
 import random
@@ -210,7 +212,7 @@ class QuestionnaireTokenClass(TokenClass):
                                  challenge=message,
                                  validitytime=validity)
         db_challenge.save()
-        self.challenge_janitor()
+        start_challenge_janitor()
         return True, message, db_challenge.transaction_id, attributes
 
     def check_answer(self, given_answer, challenge_object):
@@ -279,7 +281,7 @@ class QuestionnaireTokenClass(TokenClass):
                         # increase the received_count
                         challengeobject.set_otp_status()
 
-        self.challenge_janitor()
+        start_challenge_janitor()
         return otp_counter
 
     @staticmethod
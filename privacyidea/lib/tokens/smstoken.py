@@ -5,6 +5,7 @@
 #  License:  AGPLv3
 #  contact:  http://www.privacyidea.org
 #
+#  2016-10-17   Reject the OTP value, if the counter was used concurrently
 #  2015-05-24   Add more detailed description
 #               Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #  2015-01-30   Adapt for migration to flask
@@ -270,7 +271,13 @@ class SmsTokenClass(HotpTokenClass):
         if self.is_active() is True:
             counter = self.get_otp_count()
             log.debug("counter={0!r}".format(counter))
-            self.inc_otp_counter(counter, reset=False)
+            if self.inc_otp_counter(counter, reset=False) < 0:
+                # A concurrent request sent the OTP value of this counter
+                return_message = "The OTP value was already sent."
+                log.warning("The OTP counter {0!r} of token {1!r} was used "
+                            "by a concurrent request.".format(
+                                counter, self.token.serial))
+                return success, return_message, transactionid, attributes
             # At this point we must not bail out in case of an
             # Gateway error, since checkPIN is successful. A bail
             # out would cancel the checking of the other tokens
@@ -318,7 +325,7 @@ class SmsTokenClass(HotpTokenClass):
         if ret >= 0:
             if self._get_auto_sms(options):
                 message = self._get_sms_text(options)
-                self.inc_otp_counter(ret, reset=False)
+                # HotpTokenClass.check_otp already increased the counter
                 success, message = self._send_sms(message=message)
                 log.debug("AutoSMS: send new SMS: {0!s}".format(success))
                 log.debug("AutoSMS: {0!s}".format(message))
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 #
 #  http://www.privacyidea.org
+#  2016-10-16 Delete the expired challenges in the background
 #  2015-09-01 Initial writeup.
 #             Cornelius Kölbel <cornelius@privacyidea.org>
 #
@@ -86,8 +87,8 @@ from privacyidea.lib.error import ParameterError
 from privacyidea.models import Challenge
 from privacyidea.lib.user import get_user_from_param
 from privacyidea.lib.tokens.ocra import OCRASuite, OCRA
-from privacyidea.lib.challenge import get_challenges
-from privacyidea.models import cleanup_challenges
+from privacyidea.lib.challenge import (get_challenges,
+                                       start_challenge_janitor)
 import gettext
 from privacyidea.lib.policydecorators import challenge_response_allowed
 from privacyidea.lib.decorators import check_token_locked
@@ -338,7 +339,7 @@ class TiqrTokenClass(TokenClass):
                             # Mark the challenge as answered successfully.
                             challenges[0].set_otp_status(True)
 
-            cleanup_challenges()
+            start_challenge_janitor()
 
             return "plain", res
 
@@ -2,6 +2,11 @@
 #
 #  (c) 2015 Cornelius Kölbel - cornelius@privacyidea.org
 #
+#  2016-10-17 Reject the OTP value, if the counter was used concurrently
+#  2016-10-17 Remember the OTP values of the time steps per serial, but not
+#             the sync window
+#  2016-10-16 Remember the OTP values of the checked time steps
+#  2016-10-16 The time based OTP values are not indexed
 #  2015-11-30 Cornelius Kölbel <cornelius.koelbel@netknights.it>
 #             initial write
 #
@@ -40,6 +45,7 @@ from privacyidea.lib.log import log_with
 from privacyidea.lib.tokenclass import TokenClass
 from privacyidea.lib.tokens.hotptoken import HotpTokenClass
 from privacyidea.lib.decorators import check_token_locked
+from privacyidea.lib.utils import LRUCache
 import gettext
 _ = gettext.gettext
 
@@ -53,7 +59,16 @@ keylen = {'sha1': 20,
 
 log = logging.getLogger(__name__)
 
+# The truncated OTP values of the time steps, that were checked in this
+# process. The key is the serial, the value is a tuple of (key revision,
+# OTP length, hashlib) and a dict {counter: value} of the current window.
+TOTP_VALUES_SIZE = 10000
+_totp_values = LRUCache(TOTP_VALUES_SIZE)
+
+
 class TotpTokenClass(HotpTokenClass):
+    # The time based OTP values can not be indexed
+    otp_index = False
 
     # When resyncing we need to do two directly consecutive values.
     resyncDiffLimit = 1
@@ -170,6 +185,47 @@ class TotpTokenClass(HotpTokenClass):
         self.add_tokeninfo("timeShift", timeShift)
         self.add_tokeninfo("timeStep", timeStep)
         self.add_tokeninfo("hashlib", hashlibStr)
+        self._forget_otp_values()
+
+    def set_otpkey(self, otpKey):
+        HotpTokenClass.set_otpkey(self, otpKey)
+        self._forget_otp_values()
+
+    def _forget_otp_values(self):
+        """
+        Remove the remembered OTP values of the time steps of this token.
+        """
+        _totp_values.delete(self.token.serial)
+
+    def _check_time_steps(self, hmac2Otp, anOtpVal, window):
+        """
+        Check the OTP value in the symmetric window of time steps around the
+        counter of hmac2Otp. The OTP values of the time steps are remembered,
+        so that consecutive checks only calculate the new time steps.
+        The remembered values expire, when the time steps are out of the
+        window.
+
+        :param hmac2Otp: the HmacOtp object of this token
+        :param anOtpVal: the OTP value
+        :param window: the number of time steps before and after the counter
+        :return: the counter or -1
+        """
+        token_key = (self.token.key_iv, int(self.token.otplen), self.hashlib)
+        first = max(hmac2Otp.counter - window, 0)
+        last = hmac2Otp.counter + window
+        values = {}
+        entry = _totp_values.get(self.token.serial)
+        if entry is not None and entry[0] == token_key:
+            # Only the time steps of the current window are kept
+            values = dict((c, value) for c, value in entry[1].items()
+                          if first <= c < last)
+        known = len(values)
+        res = hmac2Otp.checkOtp(anOtpVal, window, symetric=True,
+                                values=values)
+        if len(values) > known:
+            ttl = (2 * window + 1) * self.timestep
+            _totp_values.set(self.token.serial, (token_key, values), ttl=ttl)
+        return res
 
     @property
     def timestep(self):
@@ -194,6 +250,13 @@ class TotpTokenClass(HotpTokenClass):
         shift = float(self.get_tokeninfo("timeShift") or 0)
         return shift
 
+    def get_hotp_parameters(self):
+        """
+        The OTP values of the TOTP token depend on the time and can not be
+        indexed.
+        """
+        return None
+
     @log_with(log)
     def check_otp_exist(self, otp, window=None, options=None, symetric=True,
                         inc_counter=True):
@@ -219,7 +282,9 @@ class TotpTokenClass(HotpTokenClass):
         if inc_counter and res >= 0:
             # As usually the counter is increased in lib.token.checkUserPass,
             # we need to do this manually here:
-            self.inc_otp_counter(res)
+            if self.inc_otp_counter(res) < 0:
+                # A concurrent request used this OTP value
+                res = -1
         return res
 
     @staticmethod
@@ -313,9 +378,8 @@ class TotpTokenClass(HotpTokenClass):
                            counter,
                            otplen,
                            self.get_hashlib(self.hashlib))
-        res = hmac2Otp.checkOtp(anOtpVal,
-                                int(window / self.timestep),
-                                symetric=True)
+        res = self._check_time_steps(hmac2Otp, anOtpVal,
+                                     int(window / self.timestep))
 
         if res != -1 and oCount != 0 and res <= oCount:
             log.warning("a previous OTP value was used again! former "
@@ -330,7 +394,9 @@ class TotpTokenClass(HotpTokenClass):
 
         if res != -1:
             # on success, we have to save the last attempt
-            self.set_otp_count(res)
+            if not self.advance_otp_count(res):
+                # A concurrent request used this OTP value
+                return -1
             # We could also store it temporarily
             # self.auth_details["matched_otp_counter"] = res
 
@@ -388,7 +454,8 @@ class TotpTokenClass(HotpTokenClass):
         info = self.get_tokeninfo()
         syncWindow = self.get_sync_window()
 
-        # check if the otpval is valid in the sync scope
+        # check if the otpval is valid in the sync scope. The large sync
+        # window is not remembered.
         res = hmac2Otp.checkOtp(anOtpVal, syncWindow, symetric=True)
         log.debug("found otpval {0!r} in syncwindow ({1!r}): {2!r}".format(anOtpVal, syncWindow, res))
 
@@ -441,6 +508,7 @@ class TotpTokenClass(HotpTokenClass):
         options = options or {}
         otplen = int(self.token.otplen)
         secretHOtp = self.token.get_otpkey()
+        self._forget_otp_values()
 
         log.debug("timestep: {0!r}, syncWindow: {1!r}, timeShift: {2!r}".format(self.timestep, self.timewindow, self.timeshift))
 
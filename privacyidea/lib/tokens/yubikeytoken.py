@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Reject the OTP value, if the counter was used concurrently
+#  2016-10-16 Find the token of a prefix in the indexed table yubikeyprefix
 #  2016-04-04 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Move the API signature static methods to functions.
 #  2016-03-23 Jochen Hein <jochen@jochen.org>
@@ -60,6 +62,7 @@ from privacyidea.lib.utils import modhex_decode
 from privacyidea.lib.utils import checksum
 import binascii
 from privacyidea.lib.decorators import check_token_locked
+from privacyidea.models import Token, YubikeyPrefix
 from privacyidea.api.lib.utils import getParam
 import datetime
 import base64
@@ -128,6 +131,19 @@ class YubikeyTokenClass(TokenClass):
         self.set_type(u"yubikey")
         self.hKeyRequired = True
 
+    def add_tokeninfo(self, key, value, value_type=None):
+        TokenClass.add_tokeninfo(self, key, value, value_type=value_type)
+        if key == "yubikey.prefix":
+            YubikeyPrefix.set_prefix(self.token.id, value)
+
+    def set_tokeninfo(self, info):
+        TokenClass.set_tokeninfo(self, info)
+        YubikeyPrefix.set_prefix(self.token.id, info.get("yubikey.prefix"))
+
+    def del_tokeninfo(self, key=None):
+        TokenClass.del_tokeninfo(self, key=key)
+        if key in [None, "yubikey.prefix"]:
+            YubikeyPrefix.set_prefix(self.token.id)
 
     @staticmethod
     def get_class_type():
@@ -183,13 +199,9 @@ class YubikeyTokenClass(TokenClass):
             window = self.get_otp_count_window()
         counter = self.get_otp_count()
 
+        # check_otp also increases the counter
         res = self.check_otp(otp, counter=counter, window=window, options=None)
 
-        if res >= 0:
-            # As usually the counter is increased in lib.token.checkUserPass, we
-            # need to do this manually here:
-            self.inc_otp_counter(res)
-
         return res
 
     @log_with(log)
@@ -318,7 +330,9 @@ class YubikeyTokenClass(TokenClass):
         if count_int >= self.token.count:
             res = count_int
             # on success we save the used counter
-            self.inc_otp_counter(res)
+            if self.inc_otp_counter(res) < 0:
+                # A concurrent request used this OTP value
+                res = -1
 
         return res
 
@@ -423,6 +437,7 @@ h={h}
 
         from privacyidea.lib.token import get_tokens
         from privacyidea.lib.token import check_token_list
+        from privacyidea.lib.token import create_tokenclass_object
 
         # See if the prefix matches the serial number
         if prefix[:2] != "vv" and prefix[:2] != "cc":
@@ -439,11 +454,15 @@ h={h}
         # Now, we see, if the prefix matches the new version
         if not token_list:
             # If we did not find the token via the serial number, we also
-            # search for the yubikey.prefix in the tokeninfo.
-            token_candidate_list = get_tokens(tokentype='yubikey',
-                                              tokeninfo={"yubikey.prefix":
-                                                             prefix})
-            token_list.extend(token_candidate_list)
+            # search for the yubikey.prefix in the indexed table
+            # yubikeyprefix.
+            db_tokens = Token.query.join(
+                YubikeyPrefix, YubikeyPrefix.token_id == Token.id).filter(
+                YubikeyPrefix.prefix == u"" + prefix,
+                Token.tokentype == u"yubikey").all()
+            Token.load_info(db_tokens)
+            token_list.extend([create_tokenclass_object(db_token)
+                               for db_token in db_tokens])
 
         if not token_list:
             opt['action_detail'] = ("The prefix {0!s} could not be found!".format(
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 #  privacyIDEA is a fork of LinOTP
 #
+#  2016-10-17   Cache the user IDs and the user information
+#  2016-10-16   Search the user in the cached resolvers of the realm in the
+#               order of their priority
 #  2015-11-03   Cornelius Kölbel <cornelius@privacyidea.org>
 #               Add memberfunction "exist"
 #  2015-06-06   Cornelius Kölbel <cornelius@privacyidea.org>
@@ -57,8 +60,11 @@ from .resolver import (get_resolver_object,
 
 from .realm import (get_realms,
                     get_default_realm,
-                    get_realm)
+                    get_realm,
+                    get_ordered_resolvers)
 from .config import get_from_config
+from .usercache import (cached_user_lookup, flush_user_cache, USER_ID,
+                        USER_INFO)
 
 ENCODING = 'utf-8'
 
@@ -172,34 +178,26 @@ class User(object):
             return [self.resolver]
         
         resolvers = []
-        resolver_with_highest_priority = None
-        resolvers_in_realm = self.get_realm_resolvers()
-        highest_priority = 1000
-        for resolvername in resolvers_in_realm.keys():
+        # The resolvers are ordered by their priority, so the first
+        # resolver, that contains the user, has the highest priority.
+        for resolvername in get_ordered_resolvers(self.realm):
             # test, if the user is contained in this resolver
-            y = get_resolver_object(resolvername)
-            if y is None:  # pragma: no cover
+            try:
+                uid = _get_user_id(resolvername, self.login)
+            except UserError:  # pragma: no cover
                 log.info("Resolver {0!r} not found!".format(resolvername))
+                continue
+            if uid not in ["", None]:
+                log.info("user {0!r} found in resolver {1!r}".format(self.login,
+                                                           resolvername))
+                log.info("userid resolved to {0!r} ".format(uid))
+                self.resolver = resolvername
+                resolvers = [self.resolver]
+                break
             else:
-                uid = y.getUserId(self.login)
-                if uid not in ["", None]:
-                    log.info("user {0!r} found in resolver {1!r}".format(self.login,
-                                                               resolvername))
-                    log.info("userid resolved to {0!r} ".format(uid))
-                    priority = resolvers_in_realm.get(resolvername).get(
-                        "priority", 999)
-                    log.debug("priority of the resolver is {0!s}".format(priority))
-                    log.debug("The highest priority is {0!s}".format(highest_priority))
-                    if priority < highest_priority:
-                        highest_priority = priority
-                        resolver_with_highest_priority = resolvername
-                else:
-                    log.debug("user %r not found"
-                              " in resolver %r" % (self.login,
-                                                   resolvername))
-        if resolver_with_highest_priority:
-            self.resolver = resolver_with_highest_priority
-            resolvers = [self.resolver]
+                log.debug("user %r not found"
+                          " in resolver %r" % (self.login,
+                                               resolvername))
         return resolvers
     
     def get_user_identifiers(self):
@@ -219,11 +217,7 @@ class User(object):
             raise UserError("The user can not be found in any resolver in "
                             "this realm!")
         rtype = get_resolver_type(self.resolver)
-        y = get_resolver_object(self.resolver)
-        if y is None:
-            raise UserError("The resolver '{0!s}' does not exist!".format(
-                            self.resolver))
-        uid = y.getUserId(self.login)
+        uid = _get_user_id(self.resolver, self.login)
         return uid, rtype, self.resolver
 
     def exist(self):
@@ -232,6 +226,7 @@ class User(object):
         :return: True or False
         """
         success = True
+        uid = None
         try:
             uid, _rtype, _resolver = self.get_user_identifiers()
         except UserError:
@@ -252,9 +247,25 @@ class User(object):
         :rtype: dict
         """
         (uid, _rtype, _resolver) = self.get_user_identifiers()
-        y = get_resolver_object(self.resolver)
-        userInfo = y.getUserInfo(uid)
-        return userInfo
+        return get_user_info(uid, self.resolver)
+
+    def flush_cache(self):
+        """
+        Remove the cached user ID and the cached user information of this
+        user from the user cache. The other processes drop the cached users
+        of the resolver.
+
+        :return: the number of removed cache entries
+        :rtype: int
+        """
+        try:
+            # The user information is cached with the uid, that might not
+            # be cached anymore.
+            uid = _get_user_id(self.resolver, self.login)
+        except UserError:
+            uid = None
+        return flush_user_cache(self.resolver, login=self.login,
+                                uid=uid or None)
     
     @log_with(log)
     def get_user_phone(self, phone_type='phone'):
@@ -397,8 +408,12 @@ class User(object):
                     uid, _rtype, _rname = self.get_user_identifiers()
                     if y.update_user(uid, attributes):
                         success = True
+                        flush_user_cache(self.resolver, login=self.login,
+                                         uid=uid)
                         # If necessary, update the username
                         if attributes.get("username"):
+                            flush_user_cache(self.resolver,
+                                             login=attributes.get("username"))
                             self.login = attributes.get("username")
                         log.info("Successfully updated user {0!r}.".format(self))
                     else:  # pragma: no cover
@@ -434,6 +449,8 @@ class User(object):
                     uid, _rtype, _rname = self.get_user_identifiers()
                     if y.delete_user(uid):
                         success = True
+                        flush_user_cache(self.resolver, login=self.login,
+                                         uid=uid)
                         log.info("Successfully deleted user {0!r}.".format(self))
                     else:  # pragma: no cover
                         log.info("user {0!r} failed to update.".format(self))
@@ -472,6 +489,8 @@ def create_user(resolvername, attributes):
     """
     y = get_resolver_object(resolvername)
     uid = y.add_user(attributes)
+    # The user might be cached as not existing
+    flush_user_cache(resolvername, login=attributes.get("username"), uid=uid)
     return uid
 
 
@@ -638,11 +657,32 @@ def get_user_info(userid, resolvername):
     """
     userInfo = {}
     if userid:
-        y = get_resolver_object(resolvername)
-        userInfo = y.getUserInfo(userid)
+        userInfo = cached_user_lookup(
+            USER_INFO, resolvername, userid,
+            lambda: get_resolver_object(resolvername).getUserInfo(userid))
+        if userInfo:
+            # The caller must not change the cached information
+            userInfo = dict(userInfo)
     return userInfo
 
 
+def _get_user_id(resolvername, login):
+    """
+    Return the uid of the login name in the resolver. The uid is cached in
+    the user cache.
+
+    :raises UserError: if the resolver does not exist
+    :return: the uid or an empty value, if the user does not exist
+    """
+    def lookup():
+        y = get_resolver_object(resolvername)
+        if y is None:
+            raise UserError("The resolver '{0!s}' does not exist!".format(
+                            resolvername))
+        return y.getUserId(login)
+    return cached_user_lookup(USER_ID, resolvername, login, lookup)
+
+
 @log_with(log)
 def get_username(userid, resolvername):
     """
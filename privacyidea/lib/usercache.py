@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+#  2016-10-17 Cache the user IDs and the user information, that were read
+#             from the resolvers
+#  2016-10-17 Flush the user cache of all processes with flush stamps
+#
+# This code is free software; you can redistribute it and/or
+# modify it under the terms of the GNU AFFERO GENERAL PUBLIC LICENSE
+# License as published by the Free Software Foundation; either
+# version 3 of the License, or any later version.
+#
+# This code is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU AFFERO GENERAL PUBLIC LICENSE for more details.
+#
+# You should have received a copy of the GNU Affero General Public
+# License along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+__doc__ = """
+The user cache keeps the results of the user lookups in the resolvers in the
+memory of the process. The user ID is cached with the key (resolver, login),
+the user information with the key (resolver, uid).
+
+Users, that were found, are kept for PI_USER_CACHE_TTL seconds. Users, that do
+not exist, are kept for PI_USER_CACHE_NEGATIVE_TTL seconds. The cache holds at
+most PI_USER_CACHE_SIZE entries. If it is full, the least recently used entry
+is removed. The cache is disabled by default.
+
+The entries are stored with the resolver revision and the flush stamps of
+the whole cache and of the resolver. If a resolver is changed or the cache
+is flushed by any process, the entries are outdated in all processes.
+
+This module is tested in tests/test_lib_usercache.py
+"""
+
+import logging
+import threading
+from flask import current_app, g, has_app_context, has_request_context
+from privacyidea.lib.config import get_revision, bump_revision
+from privacyidea.lib.resolver import get_request_resolver_revision
+from privacyidea.lib.utils import LRUCache
+from privacyidea.models import Config
+
+log = logging.getLogger(__name__)
+
+USER_CACHE_SIZE = 10000
+# The key in the Config table, that holds the flush stamp of the whole user
+# cache. The flush stamp of a resolver is stored with the key plus the name
+# of the resolver.
+USER_CACHE_FLUSH_KEY = "__usercache_flush__"
+
+# The kinds of the cached entries
+USER_ID = "uid"
+USER_INFO = "info"
+
+_MISSING = object()
+_user_cache = LRUCache(USER_CACHE_SIZE)
+_stats_lock = threading.Lock()
+_stats = {"hits": 0, "negative_hits": 0, "misses": 0}
+
+
+def get_user_cache_settings():
+    """
+    Return the settings of the user cache from the pi.cfg file.
+
+    :return: tuple of the positive TTL, the negative TTL and the size
+    :rtype: tuple
+    """
+    ttl = negative_ttl = 0
+    size = USER_CACHE_SIZE
+    if has_app_context():
+        ttl = float(current_app.config.get("PI_USER_CACHE_TTL", 0))
+        negative_ttl = float(current_app.config.get(
+            "PI_USER_CACHE_NEGATIVE_TTL", 0))
+        size = int(current_app.config.get("PI_USER_CACHE_SIZE",
+                                          USER_CACHE_SIZE))
+    return ttl, negative_ttl, size
+
+
+def _is_enabled(ttl, negative_ttl, size):
+    return size > 0 and bool(ttl or negative_ttl)
+
+
+def _read_revision(key):
+    """
+    Return the revision stamp with the given key. It is read once per request.
+    """
+    if not has_request_context():
+        return get_revision(key)
+    revisions = getattr(g, "user_cache_revisions", None)
+    if revisions is None:
+        revisions = g.user_cache_revisions = {}
+    if key not in revisions:
+        revisions[key] = get_revision(key)
+    return revisions[key]
+
+
+def _get_revision(resolvername):
+    """
+    Return the revision of the cache entries of the resolver. It consists of
+    the resolver revision and the flush stamps of the whole cache and of the
+    resolver.
+    """
+    return (get_request_resolver_revision(),
+            _read_revision(USER_CACHE_FLUSH_KEY),
+            _read_revision(USER_CACHE_FLUSH_KEY + resolvername))
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def cached_user_lookup(kind, resolvername, key, lookup):
+    """
+    Return the cached result of a user lookup. If the result is not cached,
+    the lookup function is called and its result is cached.
+
+    Empty results like "" or {} are cached with the negative TTL.
+    Exceptions of the lookup are not cached.
+
+    :param kind: USER_ID or USER_INFO
+    :param resolvername: The name of the resolver
+    :param key: The login name for USER_ID or the uid for USER_INFO
+    :param lookup: function without arguments, that asks the resolver
+    :return: the result of the lookup
+    """
+    ttl, negative_ttl, size = get_user_cache_settings()
+    if not _is_enabled(ttl, negative_ttl, size):
+        return lookup()
+
+    revision = _get_revision(resolvername)
+    cache_key = (kind, resolvername, key)
+    entry = _user_cache.get(cache_key, _MISSING)
+    if entry is not _MISSING and entry[0] == revision:
+        _count("hits" if entry[1] else "negative_hits")
+        return entry[1]
+
+    _count("misses")
+    value = lookup()
+    ttl = ttl if value else negative_ttl
+    if ttl:
+        _user_cache.maxsize = size
+        _user_cache.set(cache_key, (revision, value), ttl)
+    return value
+
+
+def flush_user_cache(resolvername=None, login=None, uid=None,
+                     all_processes=True):
+    """
+    Remove entries from the user cache.
+
+    Without parameters the whole cache is flushed. With a resolver name all
+    entries of this resolver are removed. With a login name or a uid only
+    the entries of this user are removed. If the uid is not given, the
+    information of the cached uid of the login name is removed.
+
+    The other processes notice the flush by the flush stamp in the database
+    and drop all entries of the resolver or the whole cache. If the cache is
+    disabled, no flush stamp is written.
+
+    :param resolvername: The name of the resolver
+    :param login: The login name of the user
+    :param uid: The uid of the user in the resolver
+    :param all_processes: If set to False, only the cache of this process is
+        flushed.
+    :return: the number of removed entries of this process
+    :rtype: int
+    """
+    if all_processes and _is_enabled(*get_user_cache_settings()):
+        bump_revision(USER_CACHE_FLUSH_KEY + (resolvername or ""),
+                      u"user cache flush")
+    if has_request_context():
+        g.user_cache_revisions = None
+    if resolvername is None:
+        removed = len(_user_cache)
+        _user_cache.clear()
+        return removed
+
+    if login is None and uid is None:
+        return _user_cache.invalidate(lambda key: key[1] == resolvername)
+
+    keys = []
+    if login is not None:
+        keys.append((USER_ID, resolvername, login))
+        entry = _user_cache.get(keys[0], _MISSING)
+        if entry is not _MISSING and entry[1]:
+            keys.append((USER_INFO, resolvername, entry[1]))
+    if uid is not None:
+        keys.append((USER_INFO, resolvername, uid))
+    return _user_cache.invalidate(lambda key: key in keys)
+
+
+def delete_flush_stamp(resolvername):
+    """
+    Remove the flush stamp of a deleted resolver from the Config table.
+    The deletion is committed by the caller.
+
+    :param resolvername: The name of the resolver
+    """
+    Config.query.filter_by(Key=USER_CACHE_FLUSH_KEY + resolvername).delete()
+    if has_request_context():
+        g.user_cache_revisions = None
+
+
+def get_user_cache_stats():
+    """
+    Return the settings and the statistics of the user cache of this process.
+    Negative hits are the hits of users, that do not exist.
+
+    :return: dict with the keys "ttl", "negative_ttl", "size", "entries",
+        "hits", "negative_hits" and "misses"
+    :rtype: dict
+    """
+    ttl, negative_ttl, size = get_user_cache_settings()
+    with _stats_lock:
+        stats = dict(_stats)
+    stats.update({"ttl": ttl,
+                  "negative_ttl": negative_ttl,
+                  "size": size,
+                  "entries": len(_user_cache)})
+    return stats
+
+
+def reset_user_cache_stats():
+    """
+    Set the hit and miss counters of the user cache to zero.
+    """
+    with _stats_lock:
+        for name in _stats:
+            _stats[name] = 0
@@ -9,6 +9,9 @@ from privacyidea.lib.crypto import urandom, geturandom
 import string
 import re
 from datetime import timedelta
+from collections import OrderedDict
+import threading
+import time
 ENCODING = "utf-8"
 
 
@@ -262,3 +265,81 @@ def parse_timelimit(limit):
         td = timedelta(hours=time)
 
     return count, td
+
+
+class LRUCache(object):
+    """
+    A thread safe dictionary with a maximum number of entries. If the cache
+    is full, the least recently used entry is removed. Entries can have a
+    time to live in seconds, after which they are not returned anymore.
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        """
+        :param maxsize: The maximum number of entries
+        :type maxsize: int
+        :param ttl: The default time to live of the entries in seconds or
+            None, if the entries do not expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the value of the key, if it exists and is not expired.
+        The entry becomes the most recently used entry.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return default
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Store the value of the key. If no ttl is given, the default time to
+        live of the cache is used.
+        """
+        ttl = ttl or self.ttl
+        expires = None
+        if ttl:
+            expires = time.time() + ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """
+        Remove the entry of the key.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, match):
+        """
+        Remove all entries, whose key matches.
+
+        :param match: function, that is called with the key and returns True
+            for the entries, that should be removed
+        :return: the number of removed entries
+        """
+        with self._lock:
+            keys = [k for k in self._entries if match(k)]
+            for key in keys:
+                del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
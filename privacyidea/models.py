@@ -1,5 +1,15 @@
 # -*- coding: utf-8 -*-
 #
+#  2016-10-17 Index the digest of the tokeninfo value instead of the value
+#  2016-10-17 Add table otpindex with the digests of the next OTP values
+#  2016-10-17 Let all save and delete methods respect the unit of work
+#  2016-10-16 Add indexes on the serial and the expiration of challenges
+#  2016-10-16 Add the index tiix_3 to filter tokens by tokeninfo
+#  2016-10-16 Add table yubikeyprefix for the lookup of Yubikeys by prefix
+#  2016-10-16 Add a unit of work, that commits the saved objects once, and
+#             an atomic conditional update of the OTP counter
+#  2016-10-16 Cache the tokeninfo of a token object, load it in bulk and
+#             buffer the writes
 #  2016-02-19 Cornelius Kölbel <cornelius@privacyidea.org>
 #             Add radiusserver table
 #  2015-08-27 Cornelius Kölbel <cornelius@privacyidea.org>
@@ -24,7 +34,10 @@
 # License along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 import binascii
+import hashlib
 import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from datetime import timedelta
 from json import loads, dumps
@@ -37,7 +50,9 @@ from .lib.crypto import (encrypt,
                          SecretObj,
                          get_rand_digit_str)
 
-from sqlalchemy import and_
+from sqlalchemy import and_, inspect
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.exc import ObjectDeletedError
 from .lib.log import log_with
 log = logging.getLogger(__name__)
 
@@ -45,6 +60,55 @@ implicit_returning = True
 
 db = SQLAlchemy()
 
+# The depth of the nested units of work of the current thread
+_unit_of_work = threading.local()
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Within a unit of work the save methods of the models do not commit the
+    session. All changes are committed once at the end of the unit of work.
+    If an exception is raised, the changes are rolled back.
+    Units of work can be nested. Only the outermost commits the session.
+
+    Usage::
+
+        with unit_of_work():
+            token.save()
+            challenge.save()
+    """
+    depth = getattr(_unit_of_work, "depth", 0)
+    _unit_of_work.depth = depth + 1
+    try:
+        yield
+        if depth == 0:
+            db.session.commit()
+    except Exception:
+        if depth == 0:
+            db.session.rollback()
+        raise
+    finally:
+        _unit_of_work.depth = depth
+
+
+def in_unit_of_work():
+    """
+    :return: True, if the current thread is within a unit of work
+    """
+    return getattr(_unit_of_work, "depth", 0) > 0
+
+
+def commit_session():
+    """
+    Commit the session. Within a unit of work the changes are only flushed
+    to the database and committed at the end of the unit of work.
+    """
+    if in_unit_of_work():
+        db.session.flush()
+    else:
+        db.session.commit()
+
 
 class MethodsMixin(object):
     """
@@ -53,14 +117,25 @@ class MethodsMixin(object):
     """
     
     def save(self):
-        db.session.add(self)
-        db.session.commit()
+        if not in_unit_of_work():
+            db.session.add(self)
+            db.session.commit()
+        else:
+            state = inspect(self)
+            if state.deleted:
+                # Saving a deleted object would fail at the end of the unit
+                # of work
+                raise ObjectDeletedError(state)
+            db.session.add(self)
+            if self.id is None:
+                # A new object needs its id
+                db.session.flush()
         return self.id
     
     def delete(self):
         ret = self.id
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -167,7 +242,7 @@ class Token(MethodsMixin, db.Model):
             tr = TokenRealm(realm_id=realm_id, token_id=token_id)
             if tr:
                 db.session.add(tr)
-                db.session.commit()
+                commit_session()
             
     @log_with(log)
     def delete(self):
@@ -175,14 +250,22 @@ class Token(MethodsMixin, db.Model):
         # is deleted via  key relation
         # so we delete it explicit
         ret = self.id
+        self._pending_info = {}
+        self._info_cache = None
         db.session.query(TokenRealm)\
                   .filter(TokenRealm.token_id == self.id)\
                   .delete()
         db.session.query(TokenInfo)\
                   .filter(TokenInfo.token_id == self.id)\
                   .delete()
+        db.session.query(YubikeyPrefix)\
+                  .filter(YubikeyPrefix.token_id == self.id)\
+                  .delete()
+        db.session.query(OTPIndex)\
+                  .filter(OTPIndex.token_id == self.id)\
+                  .delete()
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
     @staticmethod
@@ -234,7 +317,7 @@ class Token(MethodsMixin, db.Model):
             Tr = TokenRealm(token_id=self.id,
                             realmname=realm)
             db.session.add(Tr)
-        db.session.commit()
+        commit_session()
         
     def get_realms(self):
         """
@@ -459,7 +542,25 @@ class Token(MethodsMixin, db.Model):
         res = "<{0!r} {1!r}>".format(self.__class__, ldict)
         return res
 
-    def set_info(self, info):
+    # The tokeninfo of this token object as returned by get_info. It is
+    # read from the database with the first call of get_info or loaded for
+    # many tokens at once by load_info.
+    _info_cache = None
+    # The tokeninfo entries, that were set, but not written to the database.
+    _pending_info = {}
+
+    @staticmethod
+    def _info_value(value):
+        """
+        Return the value as it would be read back from the Value column.
+        """
+        if value is None or isinstance(value, basestring):
+            return value
+        if isinstance(value, bool):
+            value = int(value)
+        return unicode(value)
+
+    def set_info(self, info, flush=True):
         """
         Set the additional token info for this token
 
@@ -469,6 +570,9 @@ class Token(MethodsMixin, db.Model):
 
         :param info: The key-values to set for this token
         :type info: dict
+        :param flush: If set to False, the entries are not written to the
+            database, yet. They are written by calling flush_info.
+        :type flush: bool
         """
         if not self.id:
             # If there is no ID to reference the token, we need to save the
@@ -478,10 +582,47 @@ class Token(MethodsMixin, db.Model):
         for k, v in info.items():
             if k.endswith(".type"):
                 types[".".join(k.split(".")[:-1])] = v
+        pending = dict(self._pending_info)
         for k, v in info.items():
             if not k.endswith(".type"):
-                TokenInfo(self.id, k, v,
-                          Type=types.get(k)).save()
+                pending[k] = (v, types.get(k))
+                if self._info_cache is not None:
+                    self._info_cache[k] = self._info_value(v)
+                    if types.get(k):
+                        self._info_cache[k + ".type"] = types.get(k)
+                    else:
+                        self._info_cache.pop(k + ".type", None)
+        self._pending_info = pending
+        if flush:
+            self.flush_info()
+
+    def flush_info(self):
+        """
+        Write the pending tokeninfo entries of this token to the database.
+        All entries are written with a single commit.
+
+        :return: The number of written entries
+        :rtype: int
+        """
+        pending = self._pending_info
+        if not pending:
+            return 0
+        self._pending_info = {}
+        existing = {}
+        for ti in TokenInfo.query.filter(TokenInfo.token_id == self.id,
+                                         TokenInfo.Key.in_(pending.keys())):
+            existing[ti.Key] = ti
+        for k, (v, typ) in pending.items():
+            ti = existing.get(k)
+            if ti is None:
+                db.session.add(TokenInfo(self.id, k, v, Type=typ))
+            else:
+                ti.Value = v
+                ti.ValueHash = TokenInfo.get_value_hash(v)
+                ti.Type = typ
+                ti.Description = None
+        commit_session()
+        return len(pending)
 
     def del_info(self, key=None):
         """
@@ -493,24 +634,93 @@ class Token(MethodsMixin, db.Model):
         """
         if key:
             tokeninfos = TokenInfo.query.filter_by(token_id=self.id, Key=key)
+            if key in self._pending_info:
+                self._pending_info = dict(self._pending_info)
+                del self._pending_info[key]
+            if self._info_cache is not None:
+                self._info_cache.pop(key, None)
+                self._info_cache.pop(key + ".type", None)
         else:
             tokeninfos = TokenInfo.query.filter_by(token_id=self.id)
+            self._pending_info = {}
+            if self._info_cache is not None:
+                self._info_cache = {}
         for ti in tokeninfos:
             ti.delete()
-        pass
 
     def get_info(self):
         """
 
         :return: The token info as dictionary
         """
-        ret = {}
-        tokeninfos = TokenInfo.query.filter_by(token_id=self.id)
-        for ti in tokeninfos:
-            if ti.Type:
-                ret[ti.Key + ".type"] = ti.Type
-            ret[ti.Key] = ti.Value
-        return ret
+        if self._info_cache is None:
+            if not self.id:
+                return {}
+            Token.load_info([self])
+        return dict(self._info_cache)
+
+    @staticmethod
+    def load_info(tokens, chunk_size=500):
+        """
+        Read the tokeninfo of all given token objects from the database.
+        The tokeninfo is read with one query per chunk_size tokens, so that
+        later calls of get_info do not need to query the database.
+
+        :param tokens: list of database token objects
+        :param chunk_size: the maximum number of token ids in one query
+        """
+        tokens = [token for token in tokens if token.id]
+        for i in range(0, len(tokens), chunk_size):
+            chunk = dict((token.id, token) for token in tokens[i:i+chunk_size])
+            infos = dict((token_id, {}) for token_id in chunk)
+            for token_id, key, value, typ in db.session.query(
+                    TokenInfo.token_id, TokenInfo.Key, TokenInfo.Value,
+                    TokenInfo.Type).filter(
+                    TokenInfo.token_id.in_(chunk.keys())):
+                if typ:
+                    infos[token_id][key + ".type"] = typ
+                infos[token_id][key] = value
+            for token_id, token in chunk.items():
+                # pending entries are not yet in the database
+                for k, (v, typ) in token._pending_info.items():
+                    infos[token_id][k] = Token._info_value(v)
+                    if typ:
+                        infos[token_id][k + ".type"] = typ
+                    else:
+                        infos[token_id].pop(k + ".type", None)
+                token._info_cache = infos[token_id]
+
+    def update_counter(self, count, reset_failcount=False):
+        """
+        Set the OTP counter to the new value with an atomic conditional
+        update. The counter is only written, if it is smaller than the new
+        value. So two concurrent requests can not both use the same OTP
+        value, even if the transaction is not committed, yet.
+
+        :param count: The new OTP counter
+        :type count: int
+        :param reset_failcount: Also set the failcounter to 0 with the same
+            update
+        :type reset_failcount: bool
+        :return: True, if the counter was increased
+        :rtype: bool
+        """
+        values = {"count": count}
+        if reset_failcount:
+            values["failcount"] = 0
+        # changes of the token object need to be in the database
+        db.session.flush()
+        r = Token.query.filter(Token.id == self.id,
+                               Token.count < count)\
+            .update(values, synchronize_session=False)
+        if r:
+            for key, value in values.items():
+                set_committed_value(self, key, value)
+        else:
+            # The counter in the database is newer
+            db.session.expire(self, ["count"])
+        commit_session()
+        return r > 0
 
     def update_type(self, typ):
         """
@@ -559,6 +769,9 @@ class TokenInfo(MethodsMixin, db.Model):
     Key = db.Column(db.Unicode(255),
                     nullable=False)
     Value = db.Column(db.UnicodeText(), default=u'')
+    # The unbounded column Value can not be indexed, so the index tiix_3
+    # contains the digest of the value.
+    ValueHash = db.Column(db.Unicode(64))
     Type = db.Column(db.Unicode(100), default=u'')
     Description = db.Column(db.Unicode(2000), default=u'')
     token_id = db.Column(db.Integer(),
@@ -568,7 +781,8 @@ class TokenInfo(MethodsMixin, db.Model):
                             backref='info_list')
     __table_args__ = (db.UniqueConstraint('token_id',
                                           'Key',
-                                          name='tiix_2'), {})
+                                          name='tiix_2'),
+                      db.Index('tiix_3', 'Key', 'ValueHash', 'token_id'), {})
 
     def __init__(self, token_id, Key, Value,
                  Type= None,
@@ -579,30 +793,104 @@ class TokenInfo(MethodsMixin, db.Model):
         self.token_id = token_id
         self.Key = Key
         self.Value = Value
+        self.ValueHash = self.get_value_hash(Value)
         self.Type = Type
         self.Description = Description
 
+    @staticmethod
+    def get_value_hash(value):
+        """
+        Return the digest of a tokeninfo value for the column ValueHash.
+
+        :param value: The value of the tokeninfo
+        :return: The hex digest or None
+        :rtype: unicode
+        """
+        value = Token._info_value(value)
+        if value is None:
+            return None
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        return unicode(hashlib.sha256(value).hexdigest())
+
     def save(self):
         ti = TokenInfo.query.filter_by(token_id=self.token_id,
                                            Key=self.Key).first()
         if ti is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
             TokenInfo.query.filter_by(token_id=self.token_id,
                                            Key=self.Key
                                            ).update({'Value': self.Value,
+                                                     'ValueHash':
+                                                         self.ValueHash,
                                                      'Descrip'
                                                      'tion': self.Description,
                                                      'Type': self.Type})
             ret = ti.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
+class YubikeyPrefix(MethodsMixin, db.Model):
+    """
+    The table "yubikeyprefix" maps the prefix of a Yubikey in AES mode to
+    the token. It contains the tokeninfo "yubikey.prefix" in an indexed
+    column, so that the token of a Yubikey OTP value can be found without
+    searching the tokeninfo.
+    """
+    __tablename__ = 'yubikeyprefix'
+    id = db.Column(db.Integer, primary_key=True)
+    prefix = db.Column(db.Unicode(255), nullable=False, index=True)
+    token_id = db.Column(db.Integer(), db.ForeignKey('token.id'),
+                         nullable=False, unique=True)
+
+    def __init__(self, token_id, prefix):
+        self.token_id = token_id
+        self.prefix = prefix
+
+    @staticmethod
+    def set_prefix(token_id, prefix=None):
+        """
+        Set the prefix of the token. If the prefix is empty, the entry of
+        the token is removed.
+
+        :param token_id: The id of the token
+        :param prefix: The prefix of the Yubikey
+        """
+        YubikeyPrefix.query.filter_by(token_id=token_id).delete()
+        if prefix:
+            db.session.add(YubikeyPrefix(token_id, u"" + prefix))
+        commit_session()
+
+
+class OTPIndex(db.Model):
+    """
+    The table "otpindex" contains the keyed digests of the OTP values of the
+    next counters of the event based tokens. It is filled by the job
+    "pi-manage otpindex update", so that the token of an OTP value can be
+    found with an indexed query. The OTP values are not stored.
+    """
+    __tablename__ = 'otpindex'
+    __table_args__ = (db.UniqueConstraint('token_id',
+                                          'counter',
+                                          name='otix_2'), {})
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.Unicode(64), nullable=False, index=True)
+    token_id = db.Column(db.Integer(), db.ForeignKey('token.id'),
+                         nullable=False)
+    counter = db.Column(db.Integer(), nullable=False)
+
+    def __init__(self, token_id, counter, digest):
+        self.token_id = token_id
+        self.counter = counter
+        self.digest = digest
+
+
 class Admin(db.Model):
     """
     The administrators for managing the system.
@@ -630,7 +918,7 @@ class Admin(db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.username
         else:
             # update
@@ -642,12 +930,12 @@ class Admin(db.Model):
             Admin.query.filter_by(username=self.username)\
                 .update(update_dict)
             ret = c.username
-        db.session.commit()
+        commit_session()
         return ret
 
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
 
 
 class Config(db.Model):
@@ -677,13 +965,13 @@ class Config(db.Model):
     
     def save(self):
         db.session.add(self)
-        db.session.commit()
+        commit_session()
         return self.Key
     
     def delete(self):
         ret = self.Key
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -716,7 +1004,7 @@ class Realm(MethodsMixin, db.Model):
                   .delete()
         # delete the token
         db.session.delete(self)
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -748,7 +1036,7 @@ class CAConnector(MethodsMixin, db.Model):
         db.session.query(CAConnectorConfig)\
                   .filter(CAConnectorConfig.caconnector_id == ret)\
                   .delete()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -799,7 +1087,7 @@ class CAConnectorConfig(db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -810,7 +1098,7 @@ class CAConnectorConfig(db.Model):
                                                      'Descrip'
                                                      'tion': self.Description})
             ret = c.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -841,7 +1129,7 @@ class Resolver(MethodsMixin, db.Model):
         db.session.query(ResolverConfig)\
                   .filter(ResolverConfig.resolver_id == ret)\
                   .delete()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -892,7 +1180,7 @@ class ResolverConfig(db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -903,7 +1191,7 @@ class ResolverConfig(db.Model):
                                                      'Descrip'
                                                      'tion': self.Description})
             ret = c.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1000,7 +1288,7 @@ class TokenRealm(MethodsMixin, db.Model):
         if tr is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
 
         ret = self.id
         return ret
@@ -1057,9 +1345,9 @@ class Challenge(MethodsMixin, db.Model):
     challenge = db.Column(db.Unicode(512), default=u'')
     session = db.Column(db.Unicode(512), default=u'')
     # The token serial number
-    serial = db.Column(db.Unicode(40), default=u'')
+    serial = db.Column(db.Unicode(40), default=u'', index=True)
     timestamp = db.Column(db.DateTime, default=datetime.now())
-    expiration = db.Column(db.DateTime)
+    expiration = db.Column(db.DateTime, index=True)
     received_count = db.Column(db.Integer(), default=0)
     otp_valid = db.Column(db.Boolean, default=False)
 
@@ -1178,11 +1466,12 @@ def cleanup_challenges():
     """
     Delete all challenges, that have expired.
 
-    :return: None
+    :return: The number of deleted challenges
     """
     c_now = datetime.now()
-    Challenge.query.filter(Challenge.expiration < c_now).delete()
-    db.session.commit()
+    deleted = Challenge.query.filter(Challenge.expiration < c_now).delete()
+    commit_session()
+    return deleted
 
 # -----------------------------------------------------------------------------
 #
@@ -1288,7 +1577,7 @@ class Policy(db.Model):
         if p is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             update_param = {}
@@ -1315,7 +1604,7 @@ class Policy(db.Model):
             Policy.query.filter_by(name=self.name,
                                    ).update(update_param)
             ret = p.id
-        db.session.commit()
+        commit_session()
         return ret
 
 # ------------------------------------------------------------------
@@ -1405,7 +1694,7 @@ class MachineUser(db.Model):
     @log_with(log)
     def store(self):
         db.session.add(self)
-        db.session.commit()
+        commit_session()
         return True
     
     def to_json(self):
@@ -1465,7 +1754,7 @@ class MachineTokenOptions(db.Model):
             MachineTokenOptions.query.filter_by(
                 machinetoken_id=self.machinetoken_id,
                 mt_key=self.mt_key).update({'mt_value': self.mt_value})
-        db.session.commit()
+        commit_session()
 
 
 """
@@ -1490,7 +1779,7 @@ class MachineUserOptions(db.Model):
         self.mu_key = key
         self.mu_value = value
         db.session.add(self)
-        db.session.commit()
+        commit_session()
 
 """
 
@@ -1524,7 +1813,7 @@ class MachineResolver(MethodsMixin, db.Model):
         db.session.query(MachineResolverConfig)\
                   .filter(MachineResolverConfig.resolver_id == ret)\
                   .delete()
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1568,7 +1857,7 @@ class MachineResolverConfig(db.Model):
         if c is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -1578,7 +1867,7 @@ class MachineResolverConfig(db.Model):
                          'Type': self.Type,
                          'Description': self.Description})
             ret = c.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1672,7 +1961,7 @@ class RADIUSServer(MethodsMixin, db.Model):
         if radius is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -1688,7 +1977,7 @@ class RADIUSServer(MethodsMixin, db.Model):
             RADIUSServer.query.filter(RADIUSServer.identifier ==
                                       self.identifier).update(values)
             ret = radius.id
-        db.session.commit()
+        commit_session()
         return ret
 
 
@@ -1720,7 +2009,7 @@ class SMTPServer(MethodsMixin, db.Model):
         if smtp is None:
             # create a new one
             db.session.add(self)
-            db.session.commit()
+            commit_session()
             ret = self.id
         else:
             # update
@@ -1740,5 +2029,5 @@ class SMTPServer(MethodsMixin, db.Model):
             SMTPServer.query.filter(SMTPServer.identifier ==
                                     self.identifier).update(values)
             ret = smtp.id
-        db.session.commit()
+        commit_session()
         return ret
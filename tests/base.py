@@ -1,3 +1,4 @@
+import os
 import unittest
 import json
 from privacyidea.app import create_app
@@ -10,6 +11,11 @@ from privacyidea.lib.auth import create_db_admin
 
 PWFILE = "tests/testdata/passwords"
 
+# The benchmarks only log their timings. They are run, if the environment
+# variable PI_BENCHMARK is set.
+benchmark = unittest.skipUnless(os.environ.get("PI_BENCHMARK"),
+                                "set PI_BENCHMARK to run the benchmarks")
+
 
 class FakeFlaskG(object):
     policy_object = None
@@ -114,12 +114,17 @@ class Connection(object):
         def __init__(self, connection):
             self.standard = self.Standard(connection)
 
-    def __init__(self, directory=None):
+    def __init__(self, directory=None, user=None, password=None,
+                 authentication=None):
         if directory is None:
                 directory = []
         import copy
         self.directory = copy.deepcopy(directory)
+        self.user = user
+        self.password = password
+        self.authentication = authentication
         self.bound = False
+        self.closed = False
         self.extend = self.Extend(self)
 
     def set_directory(self, directory):
@@ -130,6 +135,18 @@ class Connection(object):
         return
 
     def bind(self):
+        # check the password. A connection can be bound again with another
+        # user and password.
+        correct_password = False
+        # Anonymous bind
+        if self.authentication == ldap3.ANONYMOUS and self.user == "":
+            correct_password = True
+        for entry in self.directory:
+            if entry.get("dn") == self.user:
+                pw = entry.get("attributes").get("userPassword")
+                if pw == self.password:
+                    correct_password = True
+        self.bound = correct_password
         return self.bound
 
     def search(self, search_base=None, search_scope=None,
@@ -207,6 +224,8 @@ class Connection(object):
         return True
 
     def unbind(self):
+        self.bound = False
+        self.closed = True
         return True
 
 
@@ -259,18 +278,8 @@ class Ldap3Mock(object):
         and object
             response
         """
-        # check the password
-        correct_password = False
-        # Anonymous bind
-        if authentication == ldap3.ANONYMOUS and user == "":
-            correct_password = True
-        for entry in self.directory:
-            if entry.get("dn") == user:
-                pw = entry.get("attributes").get("userPassword")
-                if pw == password:
-                    correct_password = True
-        self.con_obj = Connection(self.directory)
-        self.con_obj.bound = correct_password
+        self.con_obj = Connection(self.directory, user, password,
+                                  authentication)
         return self.con_obj
 
     def start(self):
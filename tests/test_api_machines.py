@@ -59,6 +59,8 @@ class APIMachinesTestCase(MyTestCase):
             self.assertTrue("id" in result["value"][0].keys())
             self.assertTrue("ip" in result["value"][0].keys())
             self.assertTrue("resolver_name" in result["value"][0].keys())
+            detail = json.loads(res.data).get("detail")
+            self.assertEqual(detail.get("incomplete_resolvers"), [])
 
     def test_01_get_machine_list_any(self):
         with self.app.test_request_context('/machine/?any=192',
@@ -283,6 +283,16 @@ class APIConfigTestCase(MyTestCase):
             self.assertTrue("resolver1" in result["value"], result)
             self.assertTrue("filename" in result["value"]["resolver1"]["data"])
 
+        # Get the statistics of the SQL connection pools
+        with self.app.test_request_context('/resolver/stats/sqlpools',
+                                           method='GET',
+                                           headers={'Authorization': self.at}):
+            res = self.app.full_dispatch_request()
+            self.assertTrue(res.status_code == 200, res)
+            result = json.loads(res.data).get("result")
+            self.assertTrue(result["status"] is True, result)
+            self.assertTrue(isinstance(result["value"], list), result)
+
         # Get a non existing resolver
         with self.app.test_request_context('/resolver/unknown',
                                            method='GET',
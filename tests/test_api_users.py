@@ -2,6 +2,8 @@ from .base import MyTestCase
 import json
 from privacyidea.lib.resolver import (save_resolver)
 from privacyidea.lib.realm import (set_realm)
+from privacyidea.lib.user import User
+from privacyidea.lib.usercache import flush_user_cache, reset_user_cache_stats
 from urllib import urlencode
 
 PWFILE = "tests/testdata/passwd"
@@ -209,3 +211,52 @@ class APIUsersTestCase(MyTestCase):
             self.assertTrue(res.status_code == 200, res)
             result = json.loads(res.data).get("result")
             self.assertTrue(result.get("value"))
+
+    def test_03_user_cache(self):
+        self.app.config["PI_USER_CACHE_TTL"] = 300
+        flush_user_cache()
+        reset_user_cache_stats()
+        try:
+            # The user "cornelius" of the realm realm1 is cached
+            self.assertTrue(User("cornelius", "realm1").exist())
+            self.assertTrue(User("cornelius", "realm1").exist())
+
+            with self.app.test_request_context('/user/cache',
+                                               method='GET',
+                                               headers={'Authorization':
+                                                            self.at}):
+                res = self.app.full_dispatch_request()
+                self.assertTrue(res.status_code == 200, res)
+                value = json.loads(res.data).get("result").get("value")
+                self.assertEqual(value.get("ttl"), 300)
+                self.assertEqual(value.get("entries"), 1)
+                self.assertTrue(value.get("hits") >= 1, value)
+
+            # flush the user
+            with self.app.test_request_context('/user/cache',
+                                               method='DELETE',
+                                               query_string=urlencode(
+                                                   {"user": "cornelius",
+                                                    "resolver": "r1"}),
+                                               headers={'Authorization':
+                                                            self.at}):
+                res = self.app.full_dispatch_request()
+                self.assertTrue(res.status_code == 200, res)
+                value = json.loads(res.data).get("result").get("value")
+                self.assertEqual(value, 1)
+
+            # flush the resolver
+            self.assertTrue(User("cornelius", "realm1").exist())
+            with self.app.test_request_context('/user/cache',
+                                               method='DELETE',
+                                               query_string=urlencode(
+                                                   {"resolver": "r1"}),
+                                               headers={'Authorization':
+                                                            self.at}):
+                res = self.app.full_dispatch_request()
+                self.assertTrue(res.status_code == 200, res)
+                value = json.loads(res.data).get("result").get("value")
+                self.assertEqual(value, 1)
+        finally:
+            self.app.config.pop("PI_USER_CACHE_TTL", None)
+            flush_user_cache()
@@ -3,21 +3,27 @@ This test file tests the applications definitions standalone
 lib/applications/*
 """
 
-from .base import MyTestCase
+from .base import MyTestCase, benchmark
 from privacyidea.lib.applications import MachineApplicationBase
 from privacyidea.lib.applications.ssh import (MachineApplication as
                                               SSHApplication)
 from privacyidea.lib.applications.luks import (MachineApplication as
                                                LUKSApplication)
 from privacyidea.lib.applications.offline import (MachineApplication as
-                                                  OfflineApplication)
+                                                  OfflineApplication,
+                                                  hash_otps,
+                                                  stop_hash_processes)
+from privacyidea.lib.applications import offline
 from privacyidea.lib.applications import (get_auth_item,
                                           is_application_allow_bulk_call,
                                           get_application_types)
 from privacyidea.lib.token import init_token, get_tokens
 from privacyidea.lib.user import User
 import passlib.hash
+import logging
+import timeit
 
+log = logging.getLogger(__name__)
 
 SSHKEY = "ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAACAQDO1rx377" \
          "cmSSs/89j/0u5aEiXa7bYArHn7zFNCBaVnDUiK9JDNkpWB" \
@@ -130,6 +136,109 @@ class OfflineApplicationTestCase(MyTestCase):
                                                                "s")
         self.assertEqual(auth_item, {})
 
+    def test_04_retry_auth_item(self):
+        serial = "OATH2"
+        init_token({"serial": serial, "type": "hotp", "otpkey": OTPKEY})
+        options = {"count": 10, "rounds": 10}
+        auth_item = OfflineApplication.get_authentication_item(
+            "hotp", serial, options=options)
+        self.assertTrue(passlib.hash.pbkdf2_sha512.verify(
+            "755224", auth_item.get("response").get(0)))
+        # The retry of the client gets the same salted hashes
+        retry = OfflineApplication.get_authentication_item(
+            "hotp", serial, options=options)
+        self.assertEqual(retry.get("response"), auth_item.get("response"))
+        self.assertEqual(get_tokens(serial=serial)[0].token.count, 11)
+
+        # After the token was used, new hashes are calculated
+        get_tokens(serial=serial)[0].inc_otp_counter()
+        auth_item2 = OfflineApplication.get_authentication_item(
+            "hotp", serial, options=options)
+        self.assertNotEqual(auth_item2.get("response").get(0),
+                            auth_item.get("response").get(0))
+
+        # The cache can be disabled
+        self.app.config["PI_OFFLINE_HASH_CACHE_TTL"] = 0
+        serial = "OATH3"
+        init_token({"serial": serial, "type": "hotp", "otpkey": OTPKEY})
+        auth_item = OfflineApplication.get_authentication_item(
+            "hotp", serial, options=options)
+        retry = OfflineApplication.get_authentication_item(
+            "hotp", serial, options=options)
+        self.assertNotEqual(retry.get("response").get(0),
+                            auth_item.get("response").get(0))
+        self.app.config.pop("PI_OFFLINE_HASH_CACHE_TTL")
+
+    def test_05_hash_processes(self):
+        # The hashes are calculated by the process pool
+        pools = []
+
+        class FakePool(object):
+            def map(self, func, args):
+                return [func(arg) for arg in args]
+
+        def get_process_pool(processes):
+            pools.append(processes)
+            return FakePool()
+
+        _get_process_pool = offline._get_process_pool
+        offline._get_process_pool = get_process_pool
+        self.app.config["PI_OFFLINE_HASH_PROCESSES"] = 2
+        try:
+            hashes = hash_otps({0: "755224", 1: "287082"}, rounds=10)
+            self.assertTrue(passlib.hash.pbkdf2_sha512.verify("755224",
+                                                              hashes[0]))
+            self.assertTrue(passlib.hash.pbkdf2_sha512.verify("287082",
+                                                              hashes[1]))
+            self.assertEqual(pools, [2])
+            # Without processes the hashes are calculated in the request
+            self.app.config["PI_OFFLINE_HASH_PROCESSES"] = 0
+            hash_otps({0: "755224", 1: "287082"}, rounds=10)
+            self.assertEqual(pools, [2])
+        finally:
+            offline._get_process_pool = _get_process_pool
+            self.app.config.pop("PI_OFFLINE_HASH_PROCESSES")
+
+    def test_06_non_ascii_pin(self):
+        serial = "OATH4"
+        init_token({"serial": serial, "type": "hotp", "otpkey": OTPKEY,
+                    "pin": u"p\xe4ss"})
+        options = {"count": 5, "rounds": 10}
+        auth_item = OfflineApplication.get_authentication_item(
+            "hotp", serial, challenge=u"p\xe4ss755224", options=options)
+        self.assertTrue(passlib.hash.pbkdf2_sha512.verify(
+            u"p\xe4ss755224", auth_item.get("response").get(0)))
+        # The retry gets the identical batch
+        retry = OfflineApplication.get_authentication_item(
+            "hotp", serial, challenge=u"p\xe4ss755224", options=options)
+        self.assertEqual(retry.get("response"), auth_item.get("response"))
+
+    @benchmark
+    def test_99_benchmark_auth_item(self):
+        # Fewer rounds than the default keep this test short
+        rounds = 1000
+        for count in [100, 500]:
+            latency = {}
+            for processes in [0, 2]:
+                self.app.config["PI_OFFLINE_HASH_PROCESSES"] = processes
+                serial = "BENCH{0:d}{1:d}".format(count, processes)
+                init_token({"serial": serial, "type": "hotp",
+                            "otpkey": OTPKEY})
+
+                def auth_item():
+                    return OfflineApplication.get_authentication_item(
+                        "hotp", serial,
+                        options={"count": count, "rounds": rounds})
+
+                latency[processes] = timeit.timeit(auth_item, number=1)
+            # The retry is served from the cache
+            retry = timeit.timeit(auth_item, number=1)
+            self.app.config.pop("PI_OFFLINE_HASH_PROCESSES")
+            stop_hash_processes()
+            log.info("count {0:d}: seconds per auth item: inline {1:.3f}, "
+                     "2 processes {2:.3f}, retry {3:.3f}".format(
+                         count, latency[0], latency[2], retry))
+
 
 class BaseApplicationTestCase(MyTestCase):
 
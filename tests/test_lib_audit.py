@@ -6,7 +6,13 @@ This tests the files
 
 from .base import MyTestCase
 from privacyidea.lib.audit import getAudit, search
+from privacyidea.lib.auditmodules.sqlaudit import (AuditWriter, LogEntry,
+                                                   get_engine)
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
 import datetime
+import os
+import tempfile
 import time
 
 PUBLIC = "tests/testdata/public.pem"
@@ -186,3 +192,112 @@ class AuditTestCase(MyTestCase):
         self.assertEqual(series.values[0], 2)
         self.assertEqual(series.values[1], 1)
 
+
+    def test_06_shared_engine(self):
+        from privacyidea.lib.auditmodules.sqlaudit import get_pool_options
+        # A second audit object uses the same engine and sign object
+        audit2 = getAudit(self.config)
+        self.assertTrue(audit2.engine is self.Audit.engine)
+        self.assertTrue(audit2.sign_object is self.Audit.sign_object)
+        # but has its own audit data
+        self.Audit.log({"action": "action1"})
+        self.assertEqual(audit2.audit_data, {})
+
+        # The pool options are read from the config
+        self.assertEqual(get_pool_options(self.config), {})
+        options = get_pool_options({"PI_AUDIT_POOL_SIZE": "20",
+                                    "PI_AUDIT_POOL_OVERFLOW": 5,
+                                    "PI_AUDIT_POOL_RECYCLE": 3600})
+        self.assertEqual(options, {"pool_size": 20,
+                                   "max_overflow": 5,
+                                   "pool_recycle": 3600})
+        # Other pool options result in a new engine
+        config = self.config.copy()
+        config["PI_AUDIT_POOL_RECYCLE"] = 600
+        audit3 = getAudit(config)
+        self.assertFalse(audit3.engine is self.Audit.engine)
+
+    def test_07_async_writer(self):
+        # An in-memory SQLite database is not shared between threads
+        fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        config = self.config.copy()
+        config["PI_AUDIT_SQL_URI"] = "sqlite:///{0!s}".format(dbfile)
+        config["PI_AUDIT_ASYNC"] = True
+        config["PI_AUDIT_ASYNC_BATCH_SIZE"] = 3
+        config["PI_AUDIT_ASYNC_INTERVAL"] = 0.1
+        try:
+            audit = getAudit(config)
+            self.assertTrue(audit.writer is not None)
+            for i in range(5):
+                audit.log({"action": "async", "serial": "s{0!s}".format(i)})
+                audit.finalize_log()
+            audit.writer.flush()
+            audit_log = audit.search({"action": "async"})
+            self.assertEqual(audit_log.total, 5)
+            for entry in audit_log.auditdata:
+                self.assertEqual(entry.get("sig_check"), "OK")
+
+            # stop the writer
+            audit.writer.stop()
+            self.assertFalse(audit.writer.thread.is_alive())
+            # A stopped writer does not accept entries, so the entry is
+            # written synchronously
+            self.assertFalse(audit.writer.put("entry"))
+            audit.log({"action": "sync"})
+            audit.finalize_log()
+            audit_log = audit.search({"action": "sync"})
+            self.assertEqual(audit_log.total, 1)
+            self.assertEqual(audit_log.auditdata[0].get("sig_check"), "OK")
+        finally:
+            os.remove(dbfile)
+
+    def test_08_async_writer_batch(self):
+        fd, dbfile = tempfile.mkstemp(suffix=".sqlite")
+        os.close(fd)
+        config = self.config.copy()
+        config["PI_AUDIT_SQL_URI"] = "sqlite:///{0!s}".format(dbfile)
+        try:
+            audit = getAudit(config)
+            writer = AuditWriter(get_engine(config["PI_AUDIT_SQL_URI"])[1],
+                                 audit.sign_object, interval=0.01)
+            statements = []
+
+            def count_statements(conn, cursor, statement, parameters,
+                                 context, executemany):
+                statements.append((statement.split()[0], executemany))
+            event.listen(audit.engine, "before_cursor_execute",
+                         count_statements)
+            # The batch is inserted and signed with one executemany each
+            writer.write([LogEntry(action="batch", serial="s{0!s}".format(i))
+                          for i in range(5)])
+            self.assertEqual(statements.count(("INSERT", True)), 1)
+            self.assertEqual(statements.count(("UPDATE", True)), 1)
+            self.assertFalse(("INSERT", False) in statements)
+            event.remove(audit.engine, "before_cursor_execute",
+                         count_statements)
+            audit_log = audit.search({"action": "batch"})
+            self.assertEqual(audit_log.total, 5)
+            for entry in audit_log.auditdata:
+                self.assertEqual(entry.get("sig_check"), "OK")
+
+            # A failing batch is retried and then written entry by entry
+            write_rows = writer._write_rows
+            calls = []
+
+            def fail_batch(rows):
+                calls.append(len(rows))
+                if len(rows) > 1 or rows[0]["serial"] == "bad":
+                    raise OperationalError("INSERT", {}, "database is locked")
+                write_rows(rows)
+            writer._write_rows = fail_batch
+            writer.write([LogEntry(action="retry", serial="s1"),
+                          LogEntry(action="retry", serial="bad"),
+                          LogEntry(action="retry", serial="s3")])
+            self.assertEqual(calls, [3, 3, 3, 1, 1, 1])
+            audit_log = audit.search({"action": "retry"})
+            self.assertEqual(audit_log.total, 2)
+            self.assertEqual(set(e.get("serial") for e in audit_log.auditdata),
+                             set(["s1", "s3"]))
+        finally:
+            os.remove(dbfile)
@@ -5,10 +5,14 @@ This tests the token functions on an interface level
 """
 from .base import MyTestCase
 from privacyidea.lib.error import (TokenAdminError, ParameterError)
-from privacyidea.lib.challenge import get_challenges
+from privacyidea.lib.challenge import (get_challenges,
+                                       start_challenge_janitor,
+                                       stop_challenge_janitor)
+from privacyidea.models import Challenge, db
 from privacyidea.lib.policy import (set_policy, delete_policy, SCOPE,
                                     ACTION)
 from privacyidea.lib.token import init_token
+import time
 
 
 class ChallengeTestCase(MyTestCase):
@@ -42,4 +46,36 @@ class ChallengeTestCase(MyTestCase):
 
         delete_policy("chalresp")
 
+    def test_02_expired_challenges(self):
+        Challenge("CHAL3", transaction_id="expired", validitytime=-1).save()
+        Challenge("CHAL3", transaction_id="valid", validitytime=120).save()
+        # The expired challenge is in the database, but it is not returned
+        self.assertEqual(Challenge.query.filter_by(serial="CHAL3").count(), 2)
+        chals = get_challenges(serial="CHAL3")
+        self.assertEqual([c.transaction_id for c in chals], ["valid"])
+        self.assertEqual(get_challenges(transaction_id="expired"), [])
 
+    def test_03_challenge_janitor(self):
+        # The janitor is disabled in the tests
+        self.assertEqual(start_challenge_janitor(), None)
+        self.app.config["PI_CHALLENGE_CLEANUP_INTERVAL"] = 0.1
+        try:
+            janitor = start_challenge_janitor()
+            self.assertTrue(janitor.thread.is_alive())
+            # The running janitor is not started again
+            self.assertEqual(start_challenge_janitor(), janitor)
+            for _i in range(50):
+                if Challenge.query.filter_by(
+                        transaction_id="expired").count() == 0:
+                    break
+                db.session.rollback()
+                time.sleep(0.1)
+            # The expired challenge was deleted in the background
+            self.assertEqual(Challenge.query.filter_by(
+                transaction_id="expired").count(), 0)
+            self.assertEqual(Challenge.query.filter_by(
+                transaction_id="valid").count(), 1)
+        finally:
+            stop_challenge_janitor()
+            self.app.config["PI_CHALLENGE_CLEANUP_INTERVAL"] = 0
+        self.assertFalse(janitor.thread.is_alive())
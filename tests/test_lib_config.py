@@ -18,8 +18,15 @@ from privacyidea.lib.config import (get_resolver_list,
                                     get_token_class_dict,
                                     get_token_types,
                                     get_token_classes, get_token_prefix,
-                                    get_machine_resolver_class_dict
+                                    get_machine_resolver_class_dict,
+                                    get_token_class, register_class,
+                                    reset_class_registry, bump_revision,
+                                    CONFIG_REVISION_KEY
                                     )
+from privacyidea.lib import config
+from privacyidea.models import Config, db
+from sqlalchemy import event
+from privacyidea.lib.error import ConfigAdminError
 from privacyidea.lib.resolvers.PasswdIdResolver import IdResolver as PWResolver
 from privacyidea.lib.tokens.hotptoken import HotpTokenClass
 from privacyidea.lib.tokens.totptoken import TotpTokenClass
@@ -228,3 +235,89 @@ class ConfigTestCase(MyTestCase):
         self.assertTrue("secretInfo1" not in a)
         a = get_from_config("secretInfo1", role="public")
         self.assertEqual(a, None)
+
+    def test_07_class_registry(self):
+        # The class dictionaries are only built once
+        self.assertTrue(get_token_class_dict() is get_token_class_dict())
+        self.assertTrue(get_resolver_class_dict() is
+                        get_resolver_class_dict())
+        self.assertEqual(get_token_class("HOTP"), HotpTokenClass)
+        self.assertEqual(get_token_class("totp"), TotpTokenClass)
+        self.assertEqual(get_token_class("unknown"), None)
+
+        # A plugin replaces the HOTP token class
+        class PluginHotpTokenClass(HotpTokenClass):
+            pass
+
+        get_token_types()
+        r = register_class(PluginHotpTokenClass)
+        self.assertEqual(r, "hotp")
+        self.assertEqual(get_token_class("hotp"), PluginHotpTokenClass)
+        self.assertTrue(PluginHotpTokenClass in get_token_classes())
+        self.assertFalse(HotpTokenClass in get_token_classes())
+        self.assertFalse("pi_token_types" in current_app.config)
+
+        # A resolver plugin
+        class PluginResolver(PWResolver):
+            @staticmethod
+            def getResolverClassType():
+                return "pluginresolver"
+
+        register_class(PluginResolver)
+        self.assertTrue("pluginresolver" in get_resolver_types())
+
+        self.assertRaises(ConfigAdminError, register_class, object)
+
+        # Rebuild the registry from the modules
+        reset_class_registry()
+        self.assertEqual(get_token_class("hotp"), HotpTokenClass)
+        self.assertFalse("pluginresolver" in get_resolver_types())
+
+    def test_08_config_snapshot(self):
+        set_privacyidea_config("snapKey", "value1")
+        set_privacyidea_config("snapPassword", "secret", typ="password")
+        queries = []
+
+        def count_query(*args):
+            queries.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            # The config is read once and the revision is checked
+            self.assertEqual(get_from_config("snapKey"), "value1")
+            self.assertEqual(len(queries), 2)
+            # Outside of a request only the revision is checked
+            self.assertEqual(get_from_config("snapKey"), "value1")
+            self.assertEqual(get_from_config("unknown", "default"), "default")
+            self.assertEqual(len(queries), 4)
+            # During a request the revision is checked only once
+            with self.app.test_request_context('/'):
+                del queries[:]
+                for _i in range(5):
+                    get_from_config("snapKey")
+                    get_from_config("PrependPin")
+                self.assertEqual(len(queries), 1)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_query)
+
+        # The password is decrypted with the first access
+        snapshot = config._config_cache["snapshot"]
+        self.assertFalse("snapPassword" in snapshot._decrypted)
+        self.assertEqual(get_from_config("snapPassword"), "secret")
+        self.assertEqual(snapshot._decrypted.get("snapPassword"), "secret")
+        self.assertEqual(get_from_config().get("snapPassword"), "secret")
+
+        # Another process changes the config and bumps the revision
+        Config.query.filter_by(Key="snapKey").update({"Value": "value2"})
+        with self.app.test_request_context('/'):
+            self.assertEqual(get_from_config("snapKey"), "value1")
+            bump_revision(CONFIG_REVISION_KEY)
+            # The revision was already checked in this request
+            self.assertEqual(get_from_config("snapKey"), "value1")
+        self.assertEqual(get_from_config("snapKey"), "value2")
+        self.assertFalse(config._config_cache["snapshot"] is snapshot)
+
+        # The deletion invalidates the snapshot
+        delete_privacyidea_config("snapKey")
+        self.assertEqual(get_from_config("snapKey"), None)
+        delete_privacyidea_config("snapPassword")
@@ -3,16 +3,30 @@
 This test file tests the lib.crypto and lib.security.default
 """
 
-from .base import MyTestCase
+from .base import MyTestCase, benchmark
 from privacyidea.lib.crypto import (encryptPin, encryptPassword, decryptPin,
                                     decryptPassword, urandom,
                                     get_rand_digit_str, geturandom,
                                     get_alphanum_str,
-                                    hash_with_pepper, verify_with_pepper)
+                                    hash_with_pepper, verify_with_pepper,
+                                    Sign, get_rsa_key)
 from privacyidea.lib.security.default import (SecurityModule,
                                               DefaultSecurityModule)
 
 from flask import current_app
+from Crypto.PublicKey import RSA
+from Crypto.Hash import SHA256
+import logging
+import os
+import shutil
+import tempfile
+import time
+import timeit
+
+log = logging.getLogger(__name__)
+
+PRIVATE = "tests/testdata/private.pem"
+PUBLIC = "tests/testdata/public.pem"
 
 
 class SecurityModuleTestCase(MyTestCase):
@@ -201,3 +215,78 @@ class RandomTestCase(MyTestCase):
 
         r = verify_with_pepper(h, "super Password")
         self.assertEqual(r, False)
+
+
+class SignTestCase(MyTestCase):
+    """
+    Test the Sign class and its key cache
+    """
+
+    def test_00_sign_verify(self):
+        sign_object = Sign(PRIVATE, PUBLIC)
+        signature = sign_object.sign("Hallo")
+        self.assertTrue(sign_object.verify("Hallo", signature))
+        self.assertFalse(sign_object.verify("Hallo!", signature))
+        # The key is imported only once
+        self.assertTrue(get_rsa_key(PRIVATE)[1] is get_rsa_key(PRIVATE)[1])
+        self.assertRaises(IOError, Sign, "tests/testdata/unknown.pem", PUBLIC)
+
+    def test_01_reload_changed_key(self):
+        tmpdir = tempfile.mkdtemp()
+        private = os.path.join(tmpdir, "private.pem")
+        shutil.copy(PRIVATE, private)
+        try:
+            sign_object = Sign(private, PUBLIC)
+            key1 = get_rsa_key(private)[1]
+            signature = sign_object.sign("Hallo")
+            self.assertTrue(sign_object.verify("Hallo", signature))
+            # replace the private key by a new key
+            f = open(private, "w")
+            f.write(RSA.generate(1024).exportKey())
+            f.close()
+            os.utime(private, (time.time() + 10, time.time() + 10))
+            signature = sign_object.sign("Hallo")
+            self.assertFalse(get_rsa_key(private)[1] is key1)
+            self.assertFalse(sign_object.verify("Hallo", signature))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_02_reuse_key(self):
+        # New Sign objects and signatures do not import the keys again
+        Sign(PRIVATE, PUBLIC).sign("Hallo")
+        imports = []
+        importKey = RSA.importKey
+
+        def count_import(pem):
+            imports.append(pem)
+            return importKey(pem)
+
+        RSA.importKey = count_import
+        try:
+            for _i in range(3):
+                sign_object = Sign(PRIVATE, PUBLIC)
+                signature = sign_object.sign("Hallo")
+                self.assertTrue(sign_object.verify("Hallo", signature))
+        finally:
+            RSA.importKey = importKey
+        self.assertEqual(imports, [])
+
+    @benchmark
+    def test_99_benchmark_signatures(self):
+        # Signatures per second with the key imported with each signature,
+        # like before, and with the cached key.
+        number = 50
+        sign_object = Sign(PRIVATE, PUBLIC)
+
+        def import_and_sign():
+            pem = open(PRIVATE).read()
+            key = RSA.importKey(pem)
+            key.sign(SHA256.new("Hallo").digest(), 1)
+
+        def cached_sign():
+            sign_object.sign("Hallo")
+
+        before = number / timeit.timeit(import_and_sign, number=number)
+        after = number / timeit.timeit(cached_sign, number=number)
+        log.info("signatures per second: before {0:.0f}, "
+                 "after {1:.0f}".format(before, after))
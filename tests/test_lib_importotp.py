@@ -472,6 +472,9 @@ class ImportOTPTestCase(MyTestCase):
         tokens = parseYubicoCSV(YUBIKEYCSV)
         self.assertTrue(len(tokens) == 7, len(tokens))
         self.assertTrue("UBAM00508326_1" in tokens, tokens)
+        # The public ID is the prefix of the Yubikey
+        self.assertEqual(tokens["UBAM00508326_1"].get("yubikey.prefix"),
+                         tokens["UBAM00508326_1"].get("description"))
 
     def test_03_import_pskc(self):
         tokens = parsePSKCdata(XML_PSKC)
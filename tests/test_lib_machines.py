@@ -10,13 +10,18 @@ lib.machines.hosts
 HOSTSFILE = "tests/testdata/hosts"
 from .base import MyTestCase
 from privacyidea.lib.machines import BaseMachineResolver
-from privacyidea.lib.machines.hosts import HostsMachineResolver
+from privacyidea.lib.machines.hosts import (HostsMachineResolver,
+                                            get_hosts_index)
 from privacyidea.lib.machines.base import Machine, MachineResolverError
 import netaddr
 from privacyidea.lib.machineresolver import (get_resolver_list, save_resolver,
                                      delete_resolver, get_resolver_config,
-                                     get_resolver_object, pretestresolver)
-from privacyidea.lib.machine import get_machines
+                                     get_resolver_object, pretestresolver,
+                                     MACHINE_RESOLVER_REVISION_KEY)
+from privacyidea.lib.config import bump_revision
+from privacyidea.lib.machine import (get_machines, search_machines,
+                                     _get_thread_pool)
+import threading
 
 
 class MachineObjectTestCase(MyTestCase):
@@ -127,10 +132,99 @@ class MachineResolverTestCase(MyTestCase):
             # check if each machines is in resolver "testresolver"
             self.assertEqual(machine.resolver_name, "testresolver")
 
+    def test_07_resolver_objects_and_timeout(self):
+        import time
+        # The resolver objects are kept until a resolver is changed
+        reso_obj = get_resolver_object("testresolver")
+        self.assertTrue(get_resolver_object("testresolver") is reso_obj)
+        closed = []
+        reso_obj.close = lambda: closed.append(reso_obj)
+        save_resolver({"name": "testresolver",
+                       "type": "hosts",
+                       "filename": HOSTSFILE})
+        self.assertFalse(get_resolver_object("testresolver") is reso_obj)
+        # The replaced object was closed
+        self.assertEqual(closed, [reso_obj])
+        reso_obj = get_resolver_object("testresolver")
+        # During a request the revision is read only once
+        with self.app.test_request_context('/'):
+            self.assertTrue(get_resolver_object("testresolver") is reso_obj)
+            bump_revision(MACHINE_RESOLVER_REVISION_KEY)
+            self.assertTrue(get_resolver_object("testresolver") is reso_obj)
+        self.assertFalse(get_resolver_object("testresolver") is reso_obj)
+        reso_obj = get_resolver_object("testresolver")
+
+        # A slow resolver is missing in the result
+        get_machines_orig = reso_obj.get_machines
+
+        def slow_get_machines(**kwargs):
+            time.sleep(0.5)
+            return get_machines_orig(**kwargs)
+
+        reso_obj.get_machines = slow_get_machines
+        self.app.config["PI_MACHINE_RESOLVER_TIMEOUT"] = 0.1
+        try:
+            machines, incomplete = search_machines(hostname="n")
+            self.assertEqual(machines, [])
+            self.assertEqual(incomplete, ["testresolver"])
+            self.app.config["PI_MACHINE_RESOLVER_TIMEOUT"] = 5
+            machines, incomplete = search_machines(hostname="n")
+            self.assertEqual(len(machines), 3)
+            self.assertEqual(incomplete, [])
+        finally:
+            self.app.config.pop("PI_MACHINE_RESOLVER_TIMEOUT", None)
+
+        # A resolver is not queried, if all threads wait for hanging calls
+        answer = threading.Event()
+        calls = []
+
+        def hanging_get_machines(**kwargs):
+            calls.append(kwargs)
+            answer.wait(5)
+            return get_machines_orig(**kwargs)
+
+        reso_obj.get_machines = hanging_get_machines
+        self.app.config["PI_MACHINE_RESOLVER_TIMEOUT"] = 0.1
+        try:
+            _pool, free_threads = _get_thread_pool()
+            hanging = 0
+            while free_threads.acquire(False):
+                free_threads.release()
+                self.assertEqual(search_machines(), ([], ["testresolver"]))
+                hanging += 1
+            self.assertEqual(len(calls), hanging)
+            # The pool is full, so the resolver is not called again
+            self.assertEqual(search_machines(), ([], ["testresolver"]))
+            self.assertEqual(len(calls), hanging)
+            # The threads are free again, after the resolver answered
+            answer.set()
+            for _i in range(hanging):
+                free_threads.acquire()
+            for _i in range(hanging):
+                free_threads.release()
+            self.app.config["PI_MACHINE_RESOLVER_TIMEOUT"] = 5
+            machines, incomplete = search_machines(hostname="n")
+            self.assertEqual(len(machines), 3)
+            self.assertEqual(incomplete, [])
+            self.assertEqual(len(calls), hanging + 1)
+        finally:
+            answer.set()
+            self.app.config.pop("PI_MACHINE_RESOLVER_TIMEOUT", None)
+
+        # A failing resolver is missing in the result
+        def failing_get_machines(**kwargs):
+            raise Exception("not available")
+
+        reso_obj.get_machines = failing_get_machines
+        self.assertEqual(search_machines(), ([], ["testresolver"]))
+        self.assertEqual(get_machines(), [])
+        reso_obj.get_machines = get_machines_orig
+
     def test_99_delete_resolver(self):
         delete_resolver("testresolver")
         l = get_resolver_list(filter_resolver_name="testresolver")
         self.assertTrue("testresolver" not in l.keys(), l.keys())
+        self.assertEqual(get_resolver_object("testresolver"), None)
 
 
 class BaseMachineTestCase(MyTestCase):
@@ -226,3 +320,45 @@ class HostsMachineTestCase(MyTestCase):
         self.assertRaises(MachineResolverError,
                           self.mreso.load_config,
                           {"name": "nothing"})
+
+    def test_06_hosts_index(self):
+        import os
+        import tempfile
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, "# comment\n"
+                     "10.0.0.1\tweb1 www\n"
+                     "10.0.0.2\tweb2\n"
+                     "10.0.0.3\tdb1\n")
+        os.close(fd)
+        try:
+            mreso = HostsMachineResolver("indexed",
+                                         config={"filename": filename})
+            index = get_hosts_index(filename)
+            self.assertTrue(index is get_hosts_index(filename))
+            self.assertEqual(index.hostname_substrings.find("web"), {0, 1})
+            self.assertEqual(index.hostname_substrings.find("ww"), {0})
+            self.assertEqual(index.ip_substrings.find("0.0.3"), {2})
+            self.assertEqual(index.id_substrings.find("a"), set())
+            self.assertEqual(index.id_substrings.find("1\n10"), set())
+
+            machines = mreso.get_machines(any="web")
+            self.assertEqual([m.id for m in machines],
+                             ["10.0.0.1", "10.0.0.2"])
+            machines = mreso.get_machines(hostname="web", substring=True,
+                                          ip="10.0.0.2")
+            self.assertEqual([m.id for m in machines], ["10.0.0.2"])
+            machines = mreso.get_machines(machine_id="10.0.0", substring=True)
+            self.assertEqual(len(machines), 3)
+            self.assertEqual(mreso.get_machine_id(hostname="www"), "10.0.0.1")
+            self.assertEqual(mreso.get_machine_id(
+                hostname="www", ip=netaddr.IPAddress("10.0.0.2")), None)
+            self.assertEqual(mreso.get_machine_id(), "10.0.0.1")
+
+            # A changed file is parsed again
+            with open(filename, "a") as f:
+                f.write("10.0.0.4\tdb2\n")
+            self.assertEqual(mreso.get_machine_id(hostname="db2"),
+                             "10.0.0.4")
+            self.assertFalse(index is get_hosts_index(filename))
+        finally:
+            os.remove(filename)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+This file tests the OTP index lib.otpindex
+"""
+from .base import MyTestCase
+from privacyidea.lib.otpindex import (update_otp_index, clear_otp_index,
+                                      filter_otp_candidates,
+                                      filter_not_indexed, get_otp_digest,
+                                      iter_token_chunks)
+from privacyidea.lib.token import (init_token, get_tokens, remove_token,
+                                   get_serial_by_otp)
+from privacyidea.lib.tokens.hotptoken import HotpTokenClass
+from privacyidea.lib.tokens.totptoken import TotpTokenClass
+from privacyidea.models import Token, OTPIndex
+
+OTPKEY = "3132333435363738393031323334353637383930"
+OTPKEY2 = "3132333435363738393031323334353637383931"
+# RFC 4226, Appendix D
+OTPS = ["755224", "287082", "359152", "969429", "338314",
+        "254676", "287922", "162583", "399871", "520489"]
+
+
+class OTPIndexTestCase(MyTestCase):
+
+    @staticmethod
+    def _serials(db_tokens):
+        return sorted(db_token.serial for db_token in db_tokens)
+
+    def test_01_update_index(self):
+        clear_otp_index()
+        init_token({"serial": "IDX0001", "type": "hotp", "otpkey": OTPKEY})
+        init_token({"serial": "IDX0002", "type": "hotp", "otpkey": OTPKEY2})
+        init_token({"serial": "IDX0003", "type": "totp", "otpkey": OTPKEY})
+
+        # Only the event based tokens are indexed
+        self.assertEqual(update_otp_index(window=10), 2)
+        token_id = get_tokens(serial="IDX0001")[0].token.id
+        entries = OTPIndex.query.filter_by(token_id=token_id).all()
+        self.assertEqual(sorted(e.counter for e in entries), range(10))
+        # The index contains the keyed digests and not the OTP values
+        entry = OTPIndex.query.filter_by(token_id=token_id, counter=3).one()
+        self.assertEqual(entry.digest, get_otp_digest(OTPS[3]))
+        self.assertNotEqual(entry.digest, OTPS[3])
+        self.assertEqual(OTPIndex.query.filter_by(digest=OTPS[3]).count(), 0)
+        # Nothing needs to be calculated again
+        self.assertEqual(update_otp_index(window=10), 0)
+
+        # The candidates are found with the digest
+        query = Token.query.filter(Token.serial.like("IDX%"))
+        self.assertEqual(
+            self._serials(filter_otp_candidates(query, OTPS[3]).all()),
+            ["IDX0001"])
+        # outside of the window
+        self.assertEqual(filter_otp_candidates(query, OTPS[3], 3).all(), [])
+        # unknown or invalid OTP values
+        for otp in ["123456", "", "abc"]:
+            self.assertEqual(filter_otp_candidates(query, otp).all(), [])
+
+        # The TOTP token can not be answered by the index
+        self.assertEqual(self._serials(filter_not_indexed(query).all()),
+                         ["IDX0003"])
+        # The index does not contain a larger window
+        self.assertEqual(self._serials(filter_not_indexed(query, 11).all()),
+                         ["IDX0001", "IDX0002", "IDX0003"])
+
+    def test_02_get_serial_by_otp(self):
+        checked = []
+
+        def check_otp_exist(check_otp_exist_orig):
+            def wrapper(tokenobject, otp, **kwargs):
+                checked.append(tokenobject.token.serial)
+                return check_otp_exist_orig(tokenobject, otp, **kwargs)
+            return wrapper
+
+        hotp_check = HotpTokenClass.check_otp_exist
+        totp_check = TotpTokenClass.check_otp_exist
+        HotpTokenClass.check_otp_exist = check_otp_exist(hotp_check)
+        TotpTokenClass.check_otp_exist = check_otp_exist(totp_check)
+        try:
+            # Only the candidate and the token, that is not indexed, are
+            # checked
+            serial = get_serial_by_otp(otp=OTPS[3], serial="IDX*")
+            self.assertEqual(serial, "IDX0001")
+            self.assertEqual(sorted(checked), ["IDX0001", "IDX0003"])
+            tokenobject = get_tokens(serial="IDX0001")[0]
+            self.assertEqual(tokenobject.token.count, 4)
+            # The index was moved forward with the counter
+            self.assertEqual(sorted(e.counter for e in OTPIndex.query.filter_by(
+                token_id=tokenobject.token.id)), range(4, 14))
+            self.assertEqual(OTPIndex.query.filter_by(
+                token_id=tokenobject.token.id, counter=9).one().digest,
+                get_otp_digest(OTPS[9]))
+
+            # The OTP value was used
+            serial = get_serial_by_otp(otp=OTPS[3], serial="IDX*")
+            self.assertEqual(serial, None)
+            # The filters are applied
+            del checked[:]
+            serial = get_serial_by_otp(otp=OTPS[4], tokentype="totp")
+            self.assertEqual(serial, None)
+            self.assertEqual(checked, ["IDX0003"])
+
+            # A new OTP key removes the token from the index, so that its
+            # OTP values are calculated
+            tokenobject.update({"otpkey": OTPKEY2})
+            tokenobject.set_otp_count(0)
+            self.assertEqual(
+                OTPIndex.query.filter_by(token_id=tokenobject.token.id).count(),
+                0)
+            del checked[:]
+            serial = get_serial_by_otp(otp=OTPS[0], serial="IDX*")
+            self.assertEqual(serial, None)
+            self.assertEqual(sorted(checked), ["IDX0001", "IDX0003"])
+        finally:
+            HotpTokenClass.check_otp_exist = hotp_check
+            TotpTokenClass.check_otp_exist = totp_check
+
+        # The deleted token is removed from the index
+        token_id = get_tokens(serial="IDX0002")[0].token.id
+        remove_token("IDX0002")
+        self.assertEqual(OTPIndex.query.filter_by(token_id=token_id).count(),
+                         0)
+        remove_token("IDX0001")
+        remove_token("IDX0003")
+
+    def test_03_update_in_chunks(self):
+        clear_otp_index()
+        serials = []
+        for i in range(5):
+            serial = "IDXC{0:d}".format(i)
+            init_token({"serial": serial, "type": "hotp",
+                        "otpkey": OTPKEY, "otplen": 6})
+            serials.append(serial)
+        self.assertEqual(update_otp_index(window=5, chunk_size=2), 5)
+        self.assertEqual(OTPIndex.query.count(), 25)
+        self.assertEqual(self._serials(filter_otp_candidates(
+            Token.query, OTPS[1], window=5).all()), serials)
+
+        # The used counters are removed and the next counters are added
+        tokenobject = get_tokens(serial="IDXC0")[0]
+        tokenobject.set_otp_count(2)
+        self.assertEqual(update_otp_index(window=5, chunk_size=2), 1)
+        self.assertEqual(sorted(e.counter for e in OTPIndex.query.filter_by(
+            token_id=tokenobject.token.id)), range(2, 7))
+        self.assertEqual(OTPIndex.query.count(), 25)
+        for serial in serials:
+            remove_token(serial)
+        self.assertEqual(OTPIndex.query.count(), 0)
+
+    def test_04_advance_index(self):
+        clear_otp_index()
+        tokenobject = init_token({"serial": "IDXA", "type": "hotp",
+                                  "otpkey": OTPKEY})
+        self.assertEqual(update_otp_index(window=5), 1)
+        token_id = tokenobject.token.id
+
+        # The index keeps its size, when the counter advances
+        self.assertTrue(tokenobject.advance_otp_count(2))
+        self.assertEqual(sorted(e.counter for e in OTPIndex.query.filter_by(
+            token_id=token_id)), range(2, 7))
+        self.assertEqual(update_otp_index(window=5), 0)
+        # The counter jumps over the index
+        self.assertTrue(tokenobject.advance_otp_count(20))
+        self.assertEqual(sorted(e.counter for e in OTPIndex.query.filter_by(
+            token_id=token_id)), range(20, 25))
+        # A used counter does not change the index
+        self.assertFalse(tokenobject.advance_otp_count(20))
+        self.assertEqual(OTPIndex.query.filter_by(token_id=token_id).count(),
+                         5)
+        # The counter is set back
+        tokenobject.set_otp_count(0)
+        self.assertEqual(OTPIndex.query.filter_by(token_id=token_id).count(),
+                         0)
+        # A token, that is not indexed, is left to the job
+        self.assertTrue(tokenobject.advance_otp_count(1))
+        self.assertEqual(OTPIndex.query.filter_by(token_id=token_id).count(),
+                         0)
+        remove_token("IDXA")
+
+    def test_05_token_chunks(self):
+        for i in range(5):
+            init_token({"serial": "IDXT{0:d}".format(i), "type": "totp",
+                        "otpkey": OTPKEY})
+        query = Token.query.filter(Token.serial.like("IDXT%"))
+        chunks = list(iter_token_chunks(query, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(self._serials(sum(chunks, [])),
+                         ["IDXT{0:d}".format(i) for i in range(5)])
+        for i in range(5):
+            remove_token("IDXT{0:d}".format(i))
@@ -3,13 +3,20 @@ This test file tests the lib.policy.py
 
 The lib.policy.py only depends on the database model.
 """
-from .base import MyTestCase
+from .base import MyTestCase, benchmark
+import logging
+import random
+import timeit
 
 from privacyidea.lib.policy import (set_policy, delete_policy,
                                     import_policies, export_policies,
                                     get_static_policy_definitions,
                                     PolicyClass, SCOPE, enable_policy,
-                                    PolicyError)
+                                    PolicyError, PolicyMatcher,
+                                    filter_policies)
+from privacyidea.models import Policy
+
+log = logging.getLogger(__name__)
 
 
 def _check_policy_name(polname, policies):
@@ -24,6 +31,51 @@ def _check_policy_name(polname, policies):
     return contained
 
 
+def _synthetic_policies():
+    """
+    Return a synthetic set of 2000 policies and 202 queries.
+    """
+    rnd = random.Random(2000)
+    scopes = [SCOPE.AUTHZ, SCOPE.AUTH, SCOPE.ADMIN, SCOPE.USER]
+    actions = ["otppin=userstore", "tokentype=hotp totp", "passthru",
+               "enroll, disable", "lastauth=1d", "*, -delete"]
+    realms = ["", "*", "realm1", "realm2, realm3", "*, !realm4"]
+    users = ["", "*", "cornelius", "*, -admin", "selfservice, root"]
+    clients = ["", "10.0.0.0/8", "10.0.0.0/8, -10.0.0.1",
+               "192.168.{0!s}.0/24", "172.16.0.{0!s}"]
+    policies = []
+    for i in range(2000):
+        policies.append(Policy("pol{0!s}".format(i),
+                               active=rnd.choice([True, True, False]),
+                               scope=rnd.choice(scopes),
+                               action=rnd.choice(actions),
+                               realm=rnd.choice(realms),
+                               adminrealm=rnd.choice(realms),
+                               resolver=rnd.choice(["", "reso1"]),
+                               user=rnd.choice(users),
+                               client=rnd.choice(clients).format(
+                                   rnd.randint(0, 255))).get())
+
+    queries = []
+    for i in range(200):
+        queries.append({"scope": rnd.choice(scopes),
+                        "action": rnd.choice(["otppin", "tokentype",
+                                              "passthru", "enroll",
+                                              "delete", "lastauth"]),
+                        "active": rnd.choice([True, None]),
+                        "realm": rnd.choice(["realm1", "realm3",
+                                             "realm4", None]),
+                        "adminrealm": rnd.choice(["realm2", None]),
+                        "user": rnd.choice(["cornelius", "admin", "root",
+                                            None]),
+                        "client": rnd.choice(["10.0.0.1", "10.1.2.3",
+                                              "192.168.17.12",
+                                              "172.16.0.5", None])})
+    queries.append({"name": "pol17"})
+    queries.append({})
+    return policies, queries
+
+
 class PolicyTestCase(MyTestCase):
     """
     Test the policies on a database level
@@ -464,3 +516,118 @@ class PolicyTestCase(MyTestCase):
         rights = P.ui_get_rights(SCOPE.USER, "realm2", "user")
         # there was still another policy...
         self.assertEqual(rights, ["enable", "disable"])
+
+    def test_18_policy_cache(self):
+        from privacyidea.lib.policy import (get_policy_revision,
+                                            invalidate_policy_cache)
+        rev1 = get_policy_revision()
+        set_policy(name="cachepol", scope=SCOPE.AUTHZ, action="tokentype=hotp")
+        rev2 = get_policy_revision()
+        self.assertTrue(rev2 > rev1)
+        P = PolicyClass()
+        self.assertTrue(_check_policy_name("cachepol", P.get_policies()))
+
+        # A policy written directly to the database does not change the
+        # revision, so the cached policies are used.
+        Policy("hiddenpol", scope=SCOPE.AUTHZ, action="tokentype=totp").save()
+        P = PolicyClass()
+        self.assertFalse(_check_policy_name("hiddenpol", P.get_policies()))
+        invalidate_policy_cache()
+        P = PolicyClass()
+        self.assertTrue(_check_policy_name("hiddenpol", P.get_policies()))
+
+        # enabling and deleting policies also bumps the revision
+        enable_policy("cachepol", False)
+        rev3 = get_policy_revision()
+        self.assertTrue(rev3 > rev2)
+        P = PolicyClass()
+        self.assertEqual(P.get_policies(name="cachepol")[0].get("active"),
+                         False)
+        delete_policy("cachepol")
+        delete_policy("hiddenpol")
+        self.assertTrue(get_policy_revision() > rev3)
+        P = PolicyClass()
+        self.assertFalse(_check_policy_name("cachepol", P.get_policies()))
+
+    def test_19_policy_matcher(self):
+        policies, queries = _synthetic_policies()
+        matcher = PolicyMatcher(policies)
+
+        # The matcher returns the same policies in the same order
+        for query in queries:
+            self.assertEqual(matcher.get_policies(**query),
+                             filter_policies(policies, **query), query)
+
+        # A name is looked up in the name index
+        self.assertEqual(matcher.exact["name"].get("pol17"), set([17]))
+        # The value index is only asked for the candidates of the scope
+        calls = []
+        match = matcher.values["action"].match
+
+        def count_match(candidates, value):
+            calls.append(len(candidates))
+            return match(candidates, value)
+
+        matcher.values["action"].match = count_match
+        pols = matcher.get_policies(scope=SCOPE.AUTHZ, action="otppin")
+        self.assertEqual(pols, filter_policies(policies, scope=SCOPE.AUTHZ,
+                                               action="otppin"))
+        self.assertEqual(calls, [len(matcher.exact["scope"][SCOPE.AUTHZ])])
+        self.assertTrue(calls[0] < len(policies))
+        # Without filter values no index is asked
+        self.assertEqual(len(matcher.get_policies()), len(policies))
+        self.assertEqual(len(calls), 1)
+
+    def test_20_memoized_lookups(self):
+        set_policy(name="memopol", scope=SCOPE.AUTHZ,
+                   action="memoaction=hotp totp", realm="memorealm1")
+        set_policy(name="memopol2", scope=SCOPE.AUTHZ,
+                   action="memoaction=spass", realm="memorealm2")
+        P = PolicyClass()
+        self.assertEqual(P.get_memo_stats(), {"hits": 0, "misses": 0})
+        tt = P.get_action_values("memoaction", scope=SCOPE.AUTHZ,
+                                 realm="memorealm1")
+        self.assertEqual(set(tt), set(["hotp", "totp"]))
+        self.assertEqual(P.get_memo_stats(), {"hits": 0, "misses": 1})
+        tt2 = P.get_action_values("memoaction", scope=SCOPE.AUTHZ,
+                                  realm="memorealm1")
+        self.assertEqual(tt2, tt)
+        self.assertEqual(P.get_memo_stats(), {"hits": 1, "misses": 1})
+        # The unique check is done for memoized values, too
+        self.assertRaises(PolicyError, P.get_action_values, "memoaction",
+                          scope=SCOPE.AUTHZ, realm="memorealm1", unique=True)
+        self.assertEqual(P.get_memo_stats(), {"hits": 2, "misses": 1})
+        # other arguments are a new lookup
+        tt = P.get_action_values("memoaction", scope=SCOPE.AUTHZ,
+                                 realm="memorealm2")
+        self.assertEqual(tt, ["spass"])
+        self.assertEqual(P.get_memo_stats(), {"hits": 2, "misses": 2})
+
+        # Changing the returned list does not change the memo
+        pols = P.get_policies(name="memopol")
+        pols.append("something")
+        self.assertEqual(len(P.get_policies(name="memopol")), 1)
+        # the adminrealm is ignored outside of the admin scope
+        P.get_policies(name="memopol", scope=SCOPE.AUTHZ, adminrealm="x")
+        P.get_policies(name="memopol", scope=SCOPE.AUTHZ, adminrealm="y")
+        self.assertEqual(P.get_memo_stats(), {"hits": 4, "misses": 4})
+        delete_policy("memopol")
+        delete_policy("memopol2")
+
+    @benchmark
+    def test_99_benchmark_policy_matcher(self):
+        policies, queries = _synthetic_policies()
+        matcher = PolicyMatcher(policies)
+
+        def linear():
+            for query in queries:
+                filter_policies(policies, **query)
+
+        def indexed():
+            for query in queries:
+                matcher.get_policies(**query)
+
+        linear_time = min(timeit.repeat(linear, number=1, repeat=3))
+        indexed_time = min(timeit.repeat(indexed, number=1, repeat=3))
+        log.info("{0!s} lookups in 2000 policies: linear {1!s}s, indexed "
+                 "{2!s}s".format(len(queries), linear_time, indexed_time))
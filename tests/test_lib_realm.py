@@ -11,10 +11,16 @@ from privacyidea.lib.resolver import (save_resolver,
 
 from privacyidea.lib.realm import (set_realm,
                                    get_realms,
+                                   get_realm,
                                    get_default_realm,
                                    realm_is_defined,
                                    set_default_realm,
-                                   delete_realm)
+                                   delete_realm,
+                                   get_ordered_resolvers,
+                                   REALM_REVISION_KEY)
+from privacyidea.lib.config import bump_revision
+from privacyidea.models import Realm, db
+from sqlalchemy import event
 
 
 class ResolverTestCase(MyTestCase):
@@ -82,6 +88,50 @@ class ResolverTestCase(MyTestCase):
         realm = get_default_realm()
         self.assertTrue(realm is None, realm)
 
+    def test_04_realm_cache(self):
+        set_default_realm(self.realm1)
+        queries = []
+
+        def count_query(*args):
+            queries.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            with self.app.test_request_context('/'):
+                get_realms()
+                del queries[:]
+                # During a request the realms are read from the cache
+                for _i in range(3):
+                    self.assertEqual(get_default_realm(), self.realm1)
+                    self.assertTrue(realm_is_defined(self.realm1))
+                    self.assertEqual(get_ordered_resolvers(self.realm1),
+                                     [self.resolvername1])
+                self.assertEqual(queries, [])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_query)
+
+        # The realm is returned as a copy
+        get_realms(self.realm1)[self.realm1]["resolver"].append({})
+        self.assertEqual(len(get_realm(self.realm1).get("resolver")), 1)
+
+        # The realms are read again, if another process changed them
+        Realm.query.filter_by(name=self.realm1).update({"default": False})
+        db.session.commit()
+        self.assertEqual(get_default_realm(), self.realm1)
+        bump_revision(REALM_REVISION_KEY)
+        self.assertEqual(get_default_realm(), None)
+        set_default_realm(self.realm1)
+        self.assertEqual(get_default_realm(), self.realm1)
+
+        # priorities
+        set_realm("realm3", [self.resolvername1, self.resolvername2],
+                  priority={self.resolvername2: 1})
+        self.assertEqual(get_ordered_resolvers("realm3"),
+                         [self.resolvername2, self.resolvername1])
+        self.assertEqual(get_ordered_resolvers("unknown"), [])
+        delete_realm("realm3")
+        self.assertFalse(realm_is_defined("realm3"))
+
     def test_10_delete_realm(self):
         delete_realm(self.realm1)
         delete_realm("realm2")
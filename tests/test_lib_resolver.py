@@ -9,20 +9,31 @@ lib.resolvers.ldapresolver
 The lib.resolver.py only depends on the database model.
 """
 PWFILE = "tests/testdata/passwords"
+import threading
 from .base import MyTestCase
 import ldap3mock
 import responses
 from privacyidea.lib.resolvers.LDAPIdResolver import IdResolver as LDAPResolver
+from privacyidea.lib.resolvers.LDAPIdResolver import clear_connection_pools
+from ldap3.core.exceptions import LDAPCommunicationError
 from privacyidea.lib.resolvers.SQLIdResolver import IdResolver as SQLResolver
 from privacyidea.lib.resolvers.SCIMIdResolver import IdResolver as SCIMResolver
-from privacyidea.lib.resolvers.SQLIdResolver import PasswordHash
+from privacyidea.lib.resolvers.SQLIdResolver import (PasswordHash,
+                                                     get_engine_stats,
+                                                     clear_engines)
 from privacyidea.lib.resolvers.UserIdResolver import UserIdResolver
+from privacyidea.lib.resolvers.PasswdIdResolver import IdResolver as \
+    PasswdResolver
+from privacyidea.lib.resolvers.PasswdIdResolver import get_passwd_index
 
 from privacyidea.lib.resolver import (save_resolver,
                                       delete_resolver,
                                       get_resolver_config,
                                       get_resolver_list,
-                                      get_resolver_object, pretestresolver)
+                                      get_resolver_object, pretestresolver,
+                                      get_resolver_revision,
+                                      RESOLVER_REVISION_KEY)
+from privacyidea.lib.config import bump_revision
 from privacyidea.models import ResolverConfig
 
 LDAPDirectory = [{"dn": "cn=alice,ou=example,o=test",
@@ -189,6 +200,11 @@ class SQLResolverTestCase(MyTestCase):
         result = y.testconnection(self.parameters)
         self.assertEqual(result[0], 6)
         self.assertTrue('Found 6 users.' in result[1])
+        # The test of a new resolver does not register an engine
+        clear_engines()
+        success, desc = pretestresolver("sqlresolver", self.parameters)
+        self.assertEqual(success, 6)
+        self.assertEqual(get_engine_stats(), [])
 
     def test_05_add_user_update_delete(self):
         y = SQLResolver()
@@ -215,6 +231,77 @@ class SQLResolverTestCase(MyTestCase):
         uid = y.getUserId("achmed")
         self.assertFalse(uid)
 
+    def test_06_shared_engine(self):
+        clear_engines()
+        self.assertEqual(get_engine_stats(), [])
+        y1 = SQLResolver()
+        y1.resolvername = "sql1"
+        y1.loadConfig(self.parameters)
+        y2 = SQLResolver()
+        y2.resolvername = "sql1"
+        y2.loadConfig(self.parameters)
+        # Both objects of the resolver use the same engine, session and table
+        self.assertTrue(y1.engine is y2.engine)
+        self.assertTrue(y1.session is y2.session)
+        self.assertTrue(y1.TABLE is y2.TABLE)
+        self.assertEqual(y1.getUserId("cornelius"), 3)
+        self.assertEqual(y2.getUsername(3), "cornelius")
+        y1.close()
+
+        # Another resolver with the same connection shares the engine
+        y3 = SQLResolver()
+        y3.resolvername = "sql2"
+        y3.loadConfig(self.parameters)
+        self.assertTrue(y3.engine is y1.engine)
+        self.assertEqual(y3.getUserId("cornelius"), 3)
+        y3.close()
+
+        stats = get_engine_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0].get("resolvers"), ["sql1", "sql2"])
+        self.assertTrue(stats[0].get("url").startswith("sqlite://"))
+        self.assertTrue(stats[0].get("checkouts") >= 1)
+        self.assertEqual(stats[0].get("invalidated"), 0)
+
+        # An object without a resolver name does not register its engine
+        y5 = SQLResolver()
+        y5.loadConfig(self.parameters)
+        self.assertFalse(y5.engine is y1.engine)
+        self.assertEqual(y5.getUserId("cornelius"), 3)
+        y5.close()
+        self.assertEqual(len(get_engine_stats()), 1)
+
+        # The sessions are used by each thread separately
+        sessions = []
+        t = threading.Thread(target=lambda: sessions.append(y1.session()))
+        t.start()
+        t.join()
+        self.assertFalse(sessions[0] is y1.session())
+
+        # Changed pool options replace the engine of the resolver
+        parameters = dict(self.parameters)
+        parameters["poolRecycle"] = 60
+        y4 = SQLResolver()
+        y4.resolvername = "sql1"
+        y4.loadConfig(parameters)
+        self.assertFalse(y4.engine is y1.engine)
+        self.assertEqual(y4.engine.pool._recycle, 60)
+        self.assertEqual(y4.getUserId("cornelius"), 3)
+        y4.close()
+        # The old engine is still used by the other resolver
+        self.assertEqual(sorted([s.get("resolvers") for s in
+                                 get_engine_stats()]), [["sql1"], ["sql2"]])
+
+        # The engines of changed and deleted resolvers are disposed
+        SQLResolver.release_shared_resources(
+            {"sql1": {"type": "sqlresolver", "data": parameters},
+             "sql2": {"type": "sqlresolver", "data": self.parameters}})
+        self.assertEqual(len(get_engine_stats()), 2)
+        SQLResolver.release_shared_resources(
+            {"sql1": {"type": "sqlresolver", "data": self.parameters}})
+        self.assertEqual(get_engine_stats(), [])
+        clear_engines()
+
     def test_99_testconnection_fail(self):
         y = SQLResolver()
         self.parameters['Database'] = "does_not_exist"
@@ -925,6 +1012,121 @@ class LDAPResolverTestCase(MyTestCase):
         self.assertEqual(len(res), 1)
         self.assertEqual(res[0].get("username"), "alice")
 
+    @ldap3mock.activate
+    def test_14_connection_pool(self):
+        ldap3mock.setLDAPDirectory(LDAPDirectory)
+        clear_connection_pools()
+        config = {'LDAPURI': 'ldap://localhost',
+                  'LDAPBASE': 'o=test',
+                  'BINDDN': 'cn=manager,ou=example,o=test',
+                  'BINDPW': 'ldaptest',
+                  'LOGINNAMEATTRIBUTE': 'cn',
+                  'LDAPSEARCHFILTER': '(cn=*)',
+                  'LDAPFILTER': '(&(cn=%s))',
+                  'USERINFO': '{ "username": "cn",'
+                              '"email" : "mail", '
+                              '"surname" : "sn", '
+                              '"givenname" : "givenName" }',
+                  'UIDTYPE': 'DN'}
+        y = LDAPResolver()
+        y.resolvername = "ldap1"
+        y.loadConfig(config)
+        search_pool = y._get_pool("search")
+        bind_pool = y._get_pool("bind")
+
+        # All resolver objects of the process share one connection
+        self.assertEqual(y.getUserId("bob"), "cn=bob,ou=example,o=test")
+        self.assertEqual(len(y.getUserList({"username": "*"})), 3)
+        y2 = LDAPResolver()
+        y2.resolvername = "ldap1"
+        y2.loadConfig(config)
+        self.assertEqual(y2.getUserId("alice"), "cn=alice,ou=example,o=test")
+        self.assertEqual(search_pool.created, 1)
+        self.assertEqual(search_pool.reused, 2)
+
+        # The user binds rebind one connection
+        self.assertTrue(y.checkPass("cn=bob,ou=example,o=test", u"bobpwééé"))
+        self.assertFalse(y.checkPass("cn=bob,ou=example,o=test", "alicepw"))
+        self.assertTrue(y.checkPass("cn=alice,ou=example,o=test", "alicepw"))
+        self.assertFalse(y.checkPass("cn=alice,ou=example,o=test", ""))
+        self.assertEqual(bind_pool.created, 1)
+        self.assertEqual(bind_pool.reused, 3)
+        # The password is not kept in the pool
+        self.assertEqual(bind_pool._idle[0][1].password, None)
+
+        # A connection, that was closed, is replaced
+        search_pool._idle[0][1].unbind()
+        self.assertEqual(y.getUserId("bob"), "cn=bob,ou=example,o=test")
+        self.assertEqual(search_pool.created, 2)
+        self.assertEqual(search_pool.discarded, 1)
+
+        # The search is repeated, if the connection fails
+        def broken_search(**kwargs):
+            raise LDAPCommunicationError("connection closed by server")
+        search_pool._idle[0][1].search = broken_search
+        self.assertEqual(y.getUserId("bob"), "cn=bob,ou=example,o=test")
+        self.assertEqual(search_pool.created, 3)
+        self.assertEqual(search_pool.discarded, 2)
+
+        # Connections are recycled after the maximum age
+        config["POOLMAXAGE"] = "0"
+        y.loadConfig(config)
+        y.getUserId("bob")
+        self.assertEqual(search_pool.created, 4)
+        self.assertEqual(len(search_pool._idle), 0)
+
+        # The search connections need the correct service password
+        config["BINDPW"] = "wrong"
+        y.loadConfig(config)
+        self.assertRaises(Exception, y.getUserId, "bob")
+        # The pool of the old password was closed
+        self.assertTrue(search_pool.closed)
+        self.assertNotEqual(y._get_pool("search"), search_pool)
+        clear_connection_pools()
+
+    @ldap3mock.activate
+    def test_15_release_connection_pools(self):
+        ldap3mock.setLDAPDirectory(LDAPDirectory)
+        clear_connection_pools()
+        config = {'LDAPURI': 'ldap://localhost',
+                  'LDAPBASE': 'o=test',
+                  'BINDDN': 'cn=manager,ou=example,o=test',
+                  'BINDPW': 'ldaptest',
+                  'LOGINNAMEATTRIBUTE': 'cn',
+                  'LDAPSEARCHFILTER': '(cn=*)',
+                  'LDAPFILTER': '(&(cn=%s))',
+                  'USERINFO': '{ "username": "cn",'
+                              '"email" : "mail", '
+                              '"surname" : "sn", '
+                              '"givenname" : "givenName" }',
+                  'UIDTYPE': 'DN'}
+        pools = {}
+        for name in ["ldap1", "ldap2"]:
+            y = LDAPResolver()
+            y.resolvername = name
+            y.loadConfig(config)
+            self.assertEqual(y.getUserId("bob"), "cn=bob,ou=example,o=test")
+            pools[name] = y._get_pool("search")
+            self.assertEqual(len(pools[name]._idle), 1)
+
+        # The pools of unchanged resolvers are kept
+        resolvers = {"ldap1": {"type": "ldapresolver", "data": config},
+                     "ldap2": {"type": "ldapresolver", "data": config}}
+        LDAPResolver.release_shared_resources(resolvers)
+        self.assertFalse(pools["ldap1"].closed)
+        self.assertFalse(pools["ldap2"].closed)
+
+        # ldap1 was changed and ldap2 was deleted
+        changed = config.copy()
+        changed["LDAPURI"] = "ldap://otherhost"
+        LDAPResolver.release_shared_resources(
+            {"ldap1": {"type": "ldapresolver", "data": changed}})
+        self.assertTrue(pools["ldap1"].closed)
+        self.assertTrue(pools["ldap2"].closed)
+        self.assertEqual(len(pools["ldap1"]._idle), 0)
+        self.assertEqual(len(pools["ldap2"]._idle), 0)
+        clear_connection_pools()
+
 
 class BaseResolverTestCase(MyTestCase):
 
@@ -1048,6 +1250,60 @@ class ResolverTestCase(MyTestCase):
         reso_obj = get_resolver_object("unknown")
         self.assertTrue(reso_obj is None, reso_obj)
 
+    def test_06_resolver_object_pool(self):
+        reso_obj = get_resolver_object(self.resolvername1)
+        # The loaded resolver object is reused
+        self.assertTrue(get_resolver_object(self.resolvername1) is reso_obj)
+        self.assertEqual(reso_obj.fileName, "/etc/passwd")
+
+        # Updating the resolver bumps the revision and drops the pool
+        revision = get_resolver_revision()
+        save_resolver({"resolver": self.resolvername1,
+                       "type": "passwdresolver",
+                       "fileName": PWFILE})
+        self.assertTrue(get_resolver_revision() > revision)
+        new_obj = get_resolver_object(self.resolvername1)
+        self.assertFalse(new_obj is reso_obj)
+        self.assertEqual(new_obj.fileName, PWFILE)
+        self.assertTrue(get_resolver_object(self.resolvername1) is new_obj)
+
+        # A revision written by another process also drops the pool
+        bump_revision(RESOLVER_REVISION_KEY)
+        self.assertFalse(get_resolver_object(self.resolvername1) is new_obj)
+
+        # The pool is kept per thread
+        other_objects = []
+
+        def load_resolver():
+            with self.app.app_context():
+                other_objects.append(get_resolver_object(self.resolvername1))
+
+        t = threading.Thread(target=load_resolver)
+        t.start()
+        t.join()
+        self.assertEqual(len(other_objects), 1)
+        self.assertFalse(other_objects[0] is
+                         get_resolver_object(self.resolvername1))
+
+        # During a request the revision is read only once
+        with self.app.test_request_context('/'):
+            reso_obj = get_resolver_object(self.resolvername1)
+            bump_revision(RESOLVER_REVISION_KEY)
+            self.assertTrue(get_resolver_object(self.resolvername1) is
+                            reso_obj)
+            # The request notices its own changes
+            save_resolver({"resolver": self.resolvername1,
+                           "type": "passwdresolver",
+                           "fileName": PWFILE})
+            self.assertFalse(get_resolver_object(self.resolvername1) is
+                             reso_obj)
+        with self.app.test_request_context('/'):
+            self.assertFalse(get_resolver_object(self.resolvername1) is
+                             reso_obj)
+        save_resolver({"resolver": self.resolvername1,
+                       "type": "passwdresolver",
+                       "fileName": "/etc/passwd"})
+
     def test_10_delete_resolver(self):
         # get the list of the resolvers
         reso_list = get_resolver_list()
@@ -1164,6 +1420,55 @@ class ResolverTestCase(MyTestCase):
         self.assertTrue(y._stringMatch("HalloDuda", "*Du*"))
         self.assertTrue(y._stringMatch("Duda", "Duda"))
 
+    def test_12_passwd_index(self):
+        import os
+        import tempfile
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, "alice:x:1000:1000:Alice Cooper,,1,2,alice@example.com::\n"
+                     "alfred:x:1001:1001:Alfred Neumann::\n"
+                     "bob:x:1002:1002:Bob Marley,,3,4,bob@example.com::\n")
+        os.close(fd)
+        try:
+            y1 = PasswdResolver().loadConfig({"fileName": filename})
+            y2 = PasswdResolver().loadConfig({"fileName": filename})
+            # The parsed file is shared
+            self.assertTrue(y1.index is y2.index)
+            info = y1.getUserInfo("1000")
+            self.assertEqual(info.get("surname"), "Cooper")
+            self.assertEqual(info.get("mobile"), "1")
+            self.assertEqual(info.get("phone"), "2")
+            self.assertEqual(info.get("email"), "alice@example.com")
+
+            # The indexes narrow the wildcard searches
+            self.assertEqual(y1.index.find("username", "AL*"),
+                             {"1000", "1001"})
+            self.assertEqual(y1.index.find("username", "*ice"), {"1000"})
+            self.assertEqual(y1.index.find("username", "bob"), {"1002"})
+            self.assertEqual(y1.index.find("username", "*o*"), None)
+            users = y1.getUserList({"username": "al*"})
+            self.assertEqual(sorted(u.get("username") for u in users),
+                             ["alfred", "alice"])
+            users = y1.getUserList({"username": "*e",
+                                    "description": "*cooper*"})
+            self.assertEqual([u.get("username") for u in users], ["alice"])
+            users = y1.getUserList({"email": "*marley*",
+                                    "userid": ">1000"})
+            self.assertEqual([u.get("username") for u in users], ["bob"])
+            self.assertEqual(y1.getUserList({"username": "*o*"})[0].get(
+                "username"), "bob")
+            self.assertEqual(y1.getUserList({"username": "al"}), [])
+
+            # A changed file is parsed again after the request
+            with open(filename, "a") as f:
+                f.write("carol:x:1003:1003:Carol::\n")
+            self.assertEqual(y1.getUserId("carol"), "")
+            y1.close()
+            self.assertEqual(y1.getUserId("carol"), "1003")
+            self.assertTrue(y1.index is get_passwd_index(filename))
+            self.assertFalse(y1.index is y2.index)
+        finally:
+            os.remove(filename)
+
     @ldap3mock.activate
     def test_13_update_resolver(self):
         ldap3mock.setLDAPDirectory(LDAPDirectory)
@@ -14,15 +14,27 @@ getToken....
 """
 PWFILE = "tests/testdata/passwords"
 OTPKEY = "3132333435363738393031323334353637383930"
+# The number of tokeninfo entries in the database of the benchmark
+TOKENINFO_ROWS = 1000000
 
-from .base import MyTestCase
+from .base import MyTestCase, benchmark
 from privacyidea.lib.user import (User)
 from privacyidea.lib.tokenclass import TokenClass
 from privacyidea.lib.tokens.totptoken import TotpTokenClass
-from privacyidea.models import (Token, Challenge, TokenRealm)
+from privacyidea.lib.tokenclass import flush_tokeninfo, tokeninfo_buffer
+from privacyidea.models import (Token, Challenge, TokenRealm, TokenInfo, db,
+                                in_unit_of_work)
+from sqlalchemy import event, create_engine
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.exc import OperationalError
 from privacyidea.lib.config import (set_privacyidea_config, get_token_types)
 import datetime
-from privacyidea.lib.token import (create_tokenclass_object,
+import logging
+import os
+import tempfile
+import timeit
+from privacyidea.lib.token import (_create_token_query,
+                                   create_tokenclass_object,
                                    get_tokens,
                                    get_token_type, check_serial,
                                    get_num_tokens_in_realm,
@@ -56,6 +68,8 @@ from privacyidea.lib.token import (create_tokenclass_object,
 from privacyidea.lib.error import (TokenAdminError, ParameterError,
                                    privacyIDEAError)
 
+log = logging.getLogger(__name__)
+
 
 class TokenTestCase(MyTestCase):
     """
@@ -161,10 +175,22 @@ class TokenTestCase(MyTestCase):
                          "vv123456")
         remove_token("yk1")
 
-        # Tokeninfo with more than one entry is not supported
-        self.assertRaises(privacyIDEAError, get_tokens,
-                          tokeninfo={"key1": "value1",
-                                     "key2": "value2"})
+        # The tokens need to have all entries of the tokeninfo
+        init_token({"serial": "TI1", "type": "hotp", "otpkey": self.otpkey})
+        init_token({"serial": "TI2", "type": "hotp", "otpkey": self.otpkey})
+        add_tokeninfo("TI1", "key1", "value1")
+        add_tokeninfo("TI1", "key2", "value2")
+        add_tokeninfo("TI2", "key1", "value1")
+        add_tokeninfo("TI2", "key2", "other")
+        tokenobject_list = get_tokens(tokeninfo={"key1": "value1",
+                                                 "key2": "value2"})
+        self.assertEqual([t.token.serial for t in tokenobject_list], ["TI1"])
+        self.assertEqual(get_tokens(tokeninfo={"key1": "value1"},
+                                    count=True), 2)
+        self.assertEqual(get_tokens(tokeninfo={"key1": "value2",
+                                               "key2": "value1"}), [])
+        remove_token("TI1")
+        remove_token("TI2")
 
     def test_03_get_token_type(self):
         ttype = get_token_type("hotptoken")
@@ -1063,6 +1089,243 @@ class TokenTestCase(MyTestCase):
         self.assertEqual(r[0], False)
         self.assertEqual(r[1].get('message'), "wrong otp value")
 
+    def test_48_load_tokeninfo(self):
+        serials = ["INFO{0!s}".format(i) for i in range(5)]
+        for serial in serials:
+            token = init_token({"serial": serial,
+                                "type": "hotp",
+                                "otpkey": self.otpkey})
+            token.add_tokeninfo("key1", "value1")
+            token.add_tokeninfo("key2", 2)
+
+        queries = []
+
+        def count_query(*args):
+            queries.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", count_query)
+        try:
+            db.session.expunge_all()
+            tokens = get_tokens(serial="INFO*", load_info=True)
+            self.assertEqual(len(tokens), 5)
+            del queries[:]
+            for token in tokens:
+                self.assertEqual(token.get_tokeninfo("key1"), "value1")
+                self.assertEqual(token.get_tokeninfo("key2"), "2")
+            # The tokeninfo of all tokens was read by get_tokens
+            self.assertEqual(queries, [])
+
+            # Within the tokeninfo buffer the tokeninfo is written at the end
+            with tokeninfo_buffer():
+                tokens[0].add_tokeninfo("key1", "new value")
+                tokens[0].add_tokeninfo("key3", "value3")
+                self.assertEqual(tokens[0].get_tokeninfo("key1"),
+                                 "new value")
+                self.assertEqual(TokenInfo.query.filter_by(
+                    token_id=tokens[0].token.id, Key="key3").count(), 0)
+            self.assertEqual(TokenInfo.query.filter_by(
+                token_id=tokens[0].token.id, Key="key3").count(), 1)
+            # Nothing is left to write
+            self.assertEqual(flush_tokeninfo(), 0)
+
+            # A failing write is raised to the caller
+            def failing_flush_info():
+                raise OperationalError("UPDATE tokeninfo", {},
+                                       "database is locked")
+
+            tokens[1].token.flush_info = failing_flush_info
+            with self.assertRaises(OperationalError):
+                with tokeninfo_buffer():
+                    tokens[1].add_tokeninfo("key3", "value3")
+            del tokens[1].token.flush_info
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_query)
+
+        db.session.expunge_all()
+        token = get_tokens(serial=serials[0])[0]
+        self.assertEqual(token.get_tokeninfo("key1"), "new value")
+        self.assertEqual(token.get_tokeninfo("key3"), "value3")
+        for serial in serials:
+            remove_token(serial)
+
+    def test_49_check_token_list_unit_of_work(self):
+        token = init_token({"serial": "UOW1",
+                            "type": "hotp",
+                            "otpkey": self.otpkey,
+                            "pin": "uow"})
+        commits = []
+
+        def count_commit(*args):
+            commits.append(args)
+
+        event.listen(db.engine, "commit", count_commit)
+        try:
+            # 755224 is the OTP value of counter 0
+            r, reply = check_serial_pass("UOW1", "uow755224")
+            self.assertTrue(r)
+            # The OTP counter was committed at once, the auth counters and
+            # the failcounter were committed together
+            self.assertEqual(len(commits), 2)
+        finally:
+            event.remove(db.engine, "commit", count_commit)
+        self.assertEqual(token.token.count, 1)
+
+        # The challenge is created outside of a unit of work
+        in_uow = []
+
+        def create_challenge(options=None):
+            in_uow.append(in_unit_of_work())
+            return True, "challenge sent", "123456", {}
+
+        token.is_challenge_request = lambda passw, user=None, options=None: \
+            True
+        token.create_challenge = create_challenge
+        r, reply = check_token_list([token], "uow")
+        self.assertFalse(r)
+        self.assertEqual(reply.get("transaction_id"), "123456")
+        self.assertEqual(in_uow, [False])
+        del token.is_challenge_request
+        del token.create_challenge
+
+        # A concurrent request already increased the counter in the
+        # database. The OTP value of counter 1 must not be accepted.
+        Token.query.filter_by(serial="UOW1").update({"count": 2})
+        db.session.commit()
+        # This request still has the old counter
+        set_committed_value(token.token, "count", 1)
+        self.assertFalse(token.advance_otp_count(2))
+        self.assertEqual(token.token.count, 2)
+        self.assertTrue(token.advance_otp_count(3))
+        self.assertEqual(Token.query.filter_by(serial="UOW1").first().count,
+                         3)
+        # inc_otp_counter reports the used counter
+        set_committed_value(token.token, "count", 2)
+        self.assertEqual(token.inc_otp_counter(), -1)
+        self.assertEqual(token.token.count, 3)
+        # check_otp_exist rejects the OTP value of counter 2
+        set_committed_value(token.token, "count", 1)
+        self.assertEqual(token.check_otp_exist("359152"), -1)
+        self.assertEqual(token.inc_otp_counter(), 4)
+
+        # 287082 is the OTP value of counter 1
+        r, reply = check_serial_pass("UOW1", "uow287082")
+        self.assertFalse(r)
+        remove_token("UOW1")
+
+    @staticmethod
+    def _create_tokeninfo_database(engine, tokens):
+        # Create <tokens> tokens with the tokeninfo entries key0 to key9
+        # in the given database
+        Token.__table__.create(engine)
+        TokenInfo.__table__.create(engine)
+        engine.execute(Token.__table__.insert(),
+                       [{"id": i, "serial": u"BENCH{0:d}".format(i),
+                         "tokentype": u"hotp"} for i in range(tokens)])
+        for key in range(10):
+            engine.execute(TokenInfo.__table__.insert(),
+                           [{"token_id": i,
+                             "Key": u"key{0:d}".format(key),
+                             "Value": u"value{0:d}".format(i % 1000),
+                             "ValueHash": TokenInfo.get_value_hash(
+                                 u"value{0:d}".format(i % 1000))}
+                            for i in range(tokens)])
+
+    def test_50_tokeninfo_filter(self):
+        # The tokeninfo entries are filtered with one subquery per entry
+        # instead of a cross join of token and tokeninfo.
+        dbfile = tempfile.mktemp(suffix=".sqlite")
+        engine = create_engine("sqlite:///" + dbfile)
+        try:
+            self._create_tokeninfo_database(engine, 3000)
+            statement = _create_token_query(
+                tokeninfo={u"key7": u"value123",
+                           u"key2": u"value123"}).statement
+            self.assertEqual(str(statement).count("IN (SELECT"), 2)
+            self.assertFalse("FROM token, tokeninfo" in str(statement))
+            rows = engine.execute(statement).fetchall()
+            self.assertEqual(set(row.serial for row in rows),
+                             set([u"BENCH123", u"BENCH1123", u"BENCH2123"]))
+            statement = _create_token_query(
+                tokeninfo={u"key7": u"value123",
+                           u"key2": u"value124"}).statement
+            self.assertEqual(engine.execute(statement).fetchall(), [])
+        finally:
+            engine.dispose()
+            os.remove(dbfile)
+
+        # Long values like certificates are not contained in the index
+        tokenobject = init_token({"serial": "LONGINFO", "type": "hotp",
+                                  "otpkey": OTPKEY})
+        certificate = u"-----BEGIN CERTIFICATE-----" + u"A" * 5000
+        tokenobject.add_tokeninfo("certificate", certificate)
+        ti = TokenInfo.query.filter_by(token_id=tokenobject.token.id,
+                                       Key=u"certificate").one()
+        self.assertEqual(ti.ValueHash, TokenInfo.get_value_hash(certificate))
+        tokens = get_tokens(tokeninfo={"certificate": certificate})
+        self.assertEqual([t.token.serial for t in tokens], [u"LONGINFO"])
+        self.assertEqual(
+            get_tokens(tokeninfo={"certificate": certificate[:-1]}), [])
+        # The digest is updated with the value
+        tokenobject.add_tokeninfo("certificate", u"short")
+        tokens = get_tokens(tokeninfo={"certificate": u"short"})
+        self.assertEqual([t.token.serial for t in tokens], [u"LONGINFO"])
+        remove_token("LONGINFO")
+
+        dbfile = tempfile.mktemp(suffix=".sqlite")
+        engine = create_engine("sqlite:///" + dbfile)
+        try:
+            self._create_tokeninfo_database(engine, 300)
+            # The subquery uses the index tiix_3
+            statement = _create_token_query(
+                tokeninfo={u"key7": u"value123"}).statement
+            compiled = statement.compile(engine)
+            plan = engine.execute(
+                "EXPLAIN QUERY PLAN " + str(compiled),
+                [compiled.params[key] for key in compiled.positiontup]
+            ).fetchall()
+            self.assertTrue("tiix_3 (Key=? AND ValueHash=?)" in
+                            str(plan), plan)
+        finally:
+            engine.dispose()
+            os.remove(dbfile)
+
+    @benchmark
+    def test_99_benchmark_tokeninfo_filter(self):
+        # Tokens per second found by their tokeninfo in a SQLite database
+        # with TOKENINFO_ROWS tokeninfo entries, with the cross join of
+        # token and tokeninfo without the index tiix_3, like before, and
+        # with the subqueries and the index.
+        tokens = TOKENINFO_ROWS // 10
+        dbfile = tempfile.mktemp(suffix=".sqlite")
+        engine = create_engine("sqlite:///" + dbfile)
+        try:
+            self._create_tokeninfo_database(engine, tokens)
+            new_statement = _create_token_query(
+                tokeninfo={u"key7": u"value123"}).statement
+            old_statement = Token.query.filter(
+                TokenInfo.Key == u"key7").filter(
+                TokenInfo.Value == u"value123").filter(
+                TokenInfo.token_id == Token.id).statement
+
+            def find_tokens(statement):
+                return engine.execute(statement).fetchall()
+
+            tiix_3 = [i for i in TokenInfo.__table__.indexes
+                      if i.name == "tiix_3"][0]
+            tiix_3.drop(engine)
+            before = 1 / timeit.timeit(lambda: find_tokens(old_statement),
+                                       number=1)
+            tiix_3.create(engine)
+            number = 10
+            after = number / timeit.timeit(lambda: find_tokens(new_statement),
+                                           number=number)
+            log.info("{0:d} tokeninfo rows: queries per second: before "
+                     "{1:.1f}, after {2:.1f}".format(TOKENINFO_ROWS, before,
+                                                     after))
+        finally:
+            engine.dispose()
+            os.remove(dbfile)
+
 
 class TokenFailCounterTestCase(MyTestCase):
     """
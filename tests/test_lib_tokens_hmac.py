@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+This file tests the HMAC-based OTP calculation lib.tokens.HMAC
+"""
+from .base import MyTestCase, benchmark
+from privacyidea.lib.tokens.HMAC import HmacOtp
+from privacyidea.models import Token
+from hashlib import sha1, sha256
+import binascii
+import logging
+import struct
+import timeit
+
+log = logging.getLogger(__name__)
+
+OTPKEY = "3132333435363738393031323334353637383930"
+# RFC 4226, Appendix D
+RFC4226_OTPS = ["755224", "287082", "359152", "969429", "338314",
+                "254676", "287922", "162583", "399871", "520489"]
+
+
+class HmacOtpTestCase(MyTestCase):
+
+    def _get_secret_object(self, serial="HMAC0001"):
+        db_token = Token(serial, tokentype="hotp")
+        db_token.set_otpkey(OTPKEY)
+        return db_token.get_otpkey()
+
+    def test_01_generate(self):
+        hmac_otp = HmacOtp(self._get_secret_object())
+        otps = [hmac_otp.generate(counter=c) for c in range(10)]
+        self.assertEqual(otps, RFC4226_OTPS)
+        # The counter is incremented
+        self.assertEqual(hmac_otp.counter, 10)
+
+        # The same values with the key passed directly
+        hmac_otp = HmacOtp()
+        otp = hmac_otp.generate(counter=1,
+                                key=binascii.unhexlify(OTPKEY))
+        self.assertEqual(otp, "287082")
+
+        # 8 digits are filled with leading zeros
+        hmac_otp = HmacOtp(self._get_secret_object(), digits=8)
+        self.assertEqual(hmac_otp.generate(counter=0), "84755224")
+
+        # sha256 and no truncation
+        hmac_otp = HmacOtp(self._get_secret_object(), hashfunc=sha256)
+        digest = hmac_otp.generate(counter=0, do_truncation=False)
+        self.assertEqual(len(digest), 64)
+
+    def test_02_check_otp(self):
+        hmac_otp = HmacOtp(self._get_secret_object(), counter=0)
+        self.assertEqual(hmac_otp.checkOtp("755224", 10), 0)
+        self.assertEqual(hmac_otp.checkOtp("520489", 10), 9)
+        self.assertEqual(hmac_otp.checkOtp(u"520489", 10), 9)
+        # outside of the window
+        self.assertEqual(hmac_otp.checkOtp("520489", 9), -1)
+        # counter in the middle of a symmetric window
+        hmac_otp = HmacOtp(self._get_secret_object(), counter=5)
+        self.assertEqual(hmac_otp.checkOtp("969429", 2, symetric=True), 3)
+        self.assertEqual(hmac_otp.checkOtp("287082", 2, symetric=True), -1)
+
+        # Values, that can not be an OTP value, are not calculated at all
+        hmac_otp = HmacOtp(self._get_secret_object(), counter=0)
+        for otp in ["", "75522", "7552240", "75522a", " 55224", "-55224",
+                    "75522\n", u"７55224"]:
+            self.assertEqual(hmac_otp.checkOtp(otp, 10), -1, otp)
+
+    def test_03_reuse_keyed_hmac(self):
+        # The key is set up once per HmacOtp object, the HMACs are
+        # calculated from copies of the keyed HMAC state.
+        secret_object = self._get_secret_object()
+        calls = []
+        hmac_state = secret_object.hmac_state
+        hmac_digest = secret_object.hmac_digest
+
+        def count_state(hash_algo):
+            calls.append("state")
+            return hmac_state(hash_algo)
+
+        def count_digest(data_input, hash_algo):
+            calls.append("digest")
+            return hmac_digest(data_input, hash_algo)
+
+        secret_object.hmac_state = count_state
+        secret_object.hmac_digest = count_digest
+        hmac_otp = HmacOtp(secret_object)
+        values = {}
+        self.assertEqual(hmac_otp.find_counter("520489", 0, 1000, values), 9)
+        self.assertEqual(hmac_otp.find_counter("111111", 0, 1000, values), -1)
+        self.assertEqual(len(values), 1000)
+        self.assertEqual(calls, ["state"])
+        # The known values are not calculated again
+        hmac_otp = HmacOtp(secret_object)
+        self.assertEqual(hmac_otp.find_counter("254676", 0, 1000, values), 5)
+        self.assertEqual(calls, ["state"])
+
+    @benchmark
+    def test_99_benchmark_window(self):
+        # Checks per second of an OTP value at the end of the window with
+        # the HMAC set up, truncated and formatted for each counter, like
+        # before, and with the copied keyed HMAC state and integer
+        # comparison.
+        secret_object = self._get_secret_object()
+
+        def generate_otp(counter):
+            digest = secret_object.hmac_digest(struct.pack(">Q", counter),
+                                               sha1)
+            offset = ord(digest[-1:]) & 0x0f
+            binary = (ord(digest[offset + 0]) & 0x7f) << 24
+            binary |= (ord(digest[offset + 1]) & 0xff) << 16
+            binary |= (ord(digest[offset + 2]) & 0xff) << 8
+            binary |= (ord(digest[offset + 3]) & 0xff)
+            otp = str(binary % 10 ** 6)
+            return (6 - len(otp)) * "0" + otp
+
+        for window in [10, 100, 1000]:
+            otp = HmacOtp(secret_object).generate(counter=window - 1)
+            number = max(3, 3000 // window)
+
+            def generate_check():
+                for c in range(0, window):
+                    otpval = generate_otp(c)
+                    log.debug("calculated OTP value {0!r}".format(otpval))
+                    if unicode(otpval) == unicode(otp):
+                        return c
+                return -1
+
+            def window_check():
+                return HmacOtp(secret_object).find_counter(otp, 0, window)
+
+            self.assertEqual(generate_check(), window - 1)
+            self.assertEqual(window_check(), window - 1)
+            before = number / timeit.timeit(generate_check, number=number)
+            after = number / timeit.timeit(window_check, number=number)
+            log.info("window {0:d}: checks per second: before {1:.0f}, "
+                     "after {2:.0f}".format(window, before, after))
@@ -11,6 +11,7 @@ from privacyidea.lib.realm import (set_realm)
 from privacyidea.lib.user import (User)
 from privacyidea.lib.tokenclass import DATE_FORMAT
 from privacyidea.lib.tokens.totptoken import TotpTokenClass
+from privacyidea.lib.tokens import totptoken
 from privacyidea.models import (Token,
                                  Config,
                                  Challenge)
@@ -710,3 +711,51 @@ class TOTPTokenTestCase(MyTestCase):
         self.assertEqual(r, "public")
         r = TotpTokenClass.get_setting_type("totp.blabla")
         self.assertEqual(r, "")
+
+    def test_27_remember_time_steps(self):
+        serial = "TOTPMEMO"
+        db_token = Token(serial, tokentype="totp")
+        db_token.save()
+        token = TotpTokenClass(db_token)
+        token.update({"otpkey": self.otpkey, "timeStep": 30,
+                      "timeWindow": 180})
+        token.save()
+
+        def remembered():
+            entry = totptoken._totp_values.get(serial)
+            return sorted(entry[1]) if entry else []
+
+        # a wrong OTP value calculates the window of 2 * 6 time steps
+        counter = 47251645
+        r = token.check_otp("111111", options={"initTime": counter * 30})
+        self.assertEqual(r, -1)
+        self.assertEqual(remembered(), range(counter - 6, counter + 6))
+        # the next time step only adds one new value and drops the value,
+        # that is out of the window
+        r = token.check_otp("111111",
+                            options={"initTime": (counter + 1) * 30})
+        self.assertEqual(r, -1)
+        self.assertEqual(remembered(), range(counter - 5, counter + 7))
+        # the remembered values are used to find the correct OTP value
+        # 47251647 -> 722053
+        r = token.check_otp("722053", options={"initTime": counter * 30})
+        self.assertEqual(r, 47251647)
+
+        # the values are forgotten on resync and on a new OTP key
+        token.check_otp("111111", options={"initTime": counter * 30})
+        self.assertTrue(remembered())
+        token.resync("111111", "222222", options={"initTime": counter * 30})
+        self.assertEqual(remembered(), [])
+        token.check_otp("111111", options={"initTime": counter * 30})
+        self.assertTrue(remembered())
+        token.set_otpkey(self.otpkey)
+        self.assertEqual(remembered(), [])
+
+        # the sync window of the autosync is not remembered
+        set_privacyidea_config("AutoResync", True)
+        token.set_sync_window(1000)
+        r = token.check_otp("111111", options={"initTime": counter * 30})
+        self.assertEqual(r, -1)
+        self.assertEqual(remembered(), range(counter - 6, counter + 6))
+        set_privacyidea_config("AutoResync", False)
+        token.delete_token()
@@ -9,7 +9,8 @@ from privacyidea.lib.tokens.yubikeytoken import (YubikeyTokenClass,
                                                  yubico_api_signature,
                                                  yubico_check_api_signature)
 from privacyidea.lib.token import init_token
-from privacyidea.models import (Token)
+from privacyidea.models import (Token, YubikeyPrefix, db)
+from sqlalchemy import event
 from flask import Request, g
 from werkzeug.test import EnvironBuilder
 from privacyidea.lib.config import set_privacyidea_config
@@ -199,6 +200,55 @@ class YubikeyTokenTestCase(MyTestCase):
         self.assertTrue("status=OK" in result, result)
         self.assertTrue("nonce={0!s}".format(nonce) in result, result)
 
+    def test_11_prefix_table(self):
+        fixed = "ebedeeefegeheiej"
+        # A prefix, that is not derived from the serial number
+        prefix = "vvcccccccccccccc"
+        otps = ["lekvlrlkrcluvctenlnnjfknrhgtjned",
+                "ktudedbktcnbuntrhdueikggtrugckij",
+                "jvjncbnffdrvjcvrbgdfufjgndfetieu"]
+        db_token = Token.query.filter_by(serial="UBAM12345678_1").first()
+        token = YubikeyTokenClass(db_token)
+        # The prefix of the enrollment is stored in the table
+        prefixes = YubikeyPrefix.query.filter_by(token_id=db_token.id).all()
+        self.assertEqual([p.prefix for p in prefixes], [fixed])
+
+        # The table follows the changes of the tokeninfo
+        token.add_tokeninfo("yubikey.prefix", prefix)
+        self.assertEqual(YubikeyPrefix.query.filter_by(
+            token_id=db_token.id).first().prefix, prefix)
+
+        queries = []
+
+        def log_query(*args):
+            queries.append(args[2])
+
+        event.listen(db.engine, "before_cursor_execute", log_query)
+        try:
+            r, opt = YubikeyTokenClass.check_yubikey_pass(prefix + otps[0])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", log_query)
+        self.assertTrue(r, opt)
+        # The token was found in the table yubikeyprefix and the tokeninfo
+        # was not searched for the prefix
+        self.assertEqual(len([q for q in queries if "yubikeyprefix" in q]), 1)
+        self.assertEqual([q for q in queries if "yubikey.prefix" in q], [])
+
+        token.del_tokeninfo("yubikey.prefix")
+        self.assertEqual(YubikeyPrefix.query.filter_by(
+            token_id=db_token.id).count(), 0)
+        r, opt = YubikeyTokenClass.check_yubikey_pass(prefix + otps[1])
+        self.assertFalse(r)
+        token.set_tokeninfo({"yubikey.prefix": prefix})
+        r, opt = YubikeyTokenClass.check_yubikey_pass(prefix + otps[1])
+        self.assertTrue(r, opt)
+
+        # The entry is deleted with the token
+        token_id = db_token.id
+        token.delete_token()
+        self.assertEqual(YubikeyPrefix.query.filter_by(
+            token_id=token_id).count(), 0)
+
     def test_98_wrong_tokenid(self):
         db_token = Token.query.filter(Token.serial == self.serial1).first()
         token = YubikeyTokenClass(db_token)
@@ -8,7 +8,8 @@ PWFILE2 = "tests/testdata/passwords"
 
 from .base import MyTestCase
 from privacyidea.lib.resolver import (save_resolver)
-from privacyidea.lib.realm import (set_realm)
+from privacyidea.lib.realm import (set_realm, get_ordered_resolvers)
+from privacyidea.lib import user as user_module
 from privacyidea.lib.user import (User, create_user,
                                   get_username,
                                   get_user_info,
@@ -254,6 +255,24 @@ class UserTestCase(MyTestCase):
 
         user = get_user_from_param({"user": "cornelius", "realm": "double"})
         self.assertEqual(user.resolver, "double3")
+        self.assertEqual(get_ordered_resolvers("double"),
+                         ["double3", "double2", "double1"])
+
+        # Only the resolver with the highest priority is asked for the user
+        asked = []
+        get_resolver_object = user_module.get_resolver_object
+
+        def get_asked_resolver(resolvername):
+            asked.append(resolvername)
+            return get_resolver_object(resolvername)
+
+        user_module.get_resolver_object = get_asked_resolver
+        try:
+            user = User("cornelius", realm="double")
+        finally:
+            user_module.get_resolver_object = get_resolver_object
+        self.assertEqual(user.resolver, "double3")
+        self.assertEqual(asked, ["double3"])
 
     def test_13_update_user(self):
         realm = "sqlrealm"
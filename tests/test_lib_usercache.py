@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+This file tests the user cache lib.usercache
+"""
+import time
+from .base import MyTestCase
+from privacyidea.lib.resolver import (get_resolver_object, save_resolver,
+                                     delete_resolver)
+from privacyidea.lib.user import User, get_user_info
+from privacyidea.lib.config import bump_revision, get_revision
+from privacyidea.lib.usercache import (flush_user_cache,
+                                       get_user_cache_stats,
+                                       reset_user_cache_stats,
+                                       cached_user_lookup, USER_ID,
+                                       USER_CACHE_FLUSH_KEY)
+
+PWFILE = "tests/testdata/passwords"
+
+
+class UserCacheTestCase(MyTestCase):
+
+    def setUp(self):
+        self.app.config["PI_USER_CACHE_TTL"] = 300
+        self.app.config["PI_USER_CACHE_NEGATIVE_TTL"] = 30
+        flush_user_cache()
+        reset_user_cache_stats()
+
+    def tearDown(self):
+        self.app.config.pop("PI_USER_CACHE_TTL", None)
+        self.app.config.pop("PI_USER_CACHE_NEGATIVE_TTL", None)
+        self.app.config.pop("PI_USER_CACHE_SIZE", None)
+        flush_user_cache()
+
+    def _count_lookups(self, resolvername):
+        # Count the calls of the loaded resolver object
+        calls = []
+        y = get_resolver_object(resolvername)
+        getUserId = y.getUserId
+        getUserInfo = y.getUserInfo
+
+        def count_user_id(login):
+            calls.append(("uid", login))
+            return getUserId(login)
+
+        def count_user_info(uid):
+            calls.append(("info", uid))
+            return getUserInfo(uid)
+
+        y.getUserId = count_user_id
+        y.getUserInfo = count_user_info
+        return calls
+
+    def test_01_cache_user(self):
+        self.setUp_user_realms()
+        calls = self._count_lookups(self.resolvername1)
+
+        user = User("cornelius", self.realm1)
+        self.assertEqual(user.resolver, self.resolvername1)
+        self.assertTrue(user.exist())
+        uid, _rtype, _resolver = user.get_user_identifiers()
+        self.assertEqual(uid, "1000")
+        info = user.info
+        self.assertEqual(info.get("username"), "cornelius")
+        self.assertEqual(user.info, info)
+        self.assertEqual(get_user_info("1000", self.resolvername1), info)
+        # The resolver was asked once for the uid and once for the info
+        self.assertEqual(calls, [("uid", "cornelius"), ("info", "1000")])
+        # The cached information can not be changed by the caller
+        info["username"] = "changed"
+        self.assertEqual(user.info.get("username"), "cornelius")
+
+        # not existing users are cached, too
+        self.assertFalse(User("unknown", self.realm1).exist())
+        self.assertFalse(User("unknown", self.realm1).exist())
+        self.assertEqual(calls.count(("uid", "unknown")), 1)
+
+        stats = get_user_cache_stats()
+        self.assertEqual(stats.get("misses"), 3)
+        self.assertEqual(stats.get("negative_hits"), 3)
+        self.assertEqual(stats.get("entries"), 3)
+        self.assertEqual(stats.get("ttl"), 300)
+        self.assertEqual(stats.get("negative_ttl"), 30)
+
+        # flush the user
+        self.assertEqual(User("cornelius", self.realm1).flush_cache(), 2)
+        self.assertTrue(User("cornelius", self.realm1).exist())
+        self.assertEqual(calls.count(("uid", "cornelius")), 2)
+        # flush the resolver
+        self.assertEqual(flush_user_cache(self.resolvername1), 2)
+        self.assertEqual(get_user_cache_stats().get("entries"), 0)
+
+        # A change of the resolver drops the cache
+        User("cornelius", self.realm1).exist()
+        save_resolver({"resolver": self.resolvername1,
+                       "type": "passwdresolver",
+                       "fileName": PWFILE})
+        self.assertEqual(get_user_cache_stats().get("entries"), 0)
+
+    def test_02_ttl_and_size(self):
+        calls = []
+
+        def lookup(value):
+            def f():
+                calls.append(value)
+                return value
+            return f
+
+        self.app.config["PI_USER_CACHE_TTL"] = 0.2
+        self.app.config["PI_USER_CACHE_NEGATIVE_TTL"] = 0
+        self.assertEqual(cached_user_lookup(USER_ID, "r", "a", lookup("1")),
+                         "1")
+        self.assertEqual(cached_user_lookup(USER_ID, "r", "a", lookup("2")),
+                         "1")
+        # negative results are not cached without negative TTL
+        cached_user_lookup(USER_ID, "r", "b", lookup(""))
+        cached_user_lookup(USER_ID, "r", "b", lookup(""))
+        self.assertEqual(calls, ["1", "", ""])
+        time.sleep(0.3)
+        self.assertEqual(cached_user_lookup(USER_ID, "r", "a", lookup("2")),
+                         "2")
+
+        # The least recently used entry is removed
+        self.app.config["PI_USER_CACHE_TTL"] = 300
+        self.app.config["PI_USER_CACHE_SIZE"] = 2
+        flush_user_cache()
+        for login in ["a", "b", "a", "c"]:
+            cached_user_lookup(USER_ID, "r", login, lookup(login))
+        calls[:] = []
+        for login in ["a", "c", "b"]:
+            cached_user_lookup(USER_ID, "r", login, lookup(login))
+        self.assertEqual(calls, ["b"])
+        self.assertEqual(get_user_cache_stats().get("entries"), 2)
+
+        # The cache is disabled
+        self.app.config["PI_USER_CACHE_TTL"] = 0
+        self.assertEqual(cached_user_lookup(USER_ID, "r", "a", lookup("3")),
+                         "3")
+
+    def test_03_flush_of_other_process(self):
+        calls = []
+
+        def lookup(value):
+            def f():
+                calls.append(value)
+                return value
+            return f
+
+        cached_user_lookup(USER_ID, "r1", "a", lookup("1"))
+        cached_user_lookup(USER_ID, "r2", "a", lookup("2"))
+        self.assertEqual(calls, ["1", "2"])
+        # Another process flushes the users of resolver r1
+        bump_revision(USER_CACHE_FLUSH_KEY + "r1")
+        self.assertEqual(cached_user_lookup(USER_ID, "r1", "a", lookup("3")),
+                         "3")
+        self.assertEqual(cached_user_lookup(USER_ID, "r2", "a", lookup("4")),
+                         "2")
+        # Another process flushes the whole cache
+        bump_revision(USER_CACHE_FLUSH_KEY)
+        self.assertEqual(cached_user_lookup(USER_ID, "r1", "a", lookup("5")),
+                         "5")
+        self.assertEqual(cached_user_lookup(USER_ID, "r2", "a", lookup("6")),
+                         "6")
+        self.assertEqual(calls, ["1", "2", "3", "5", "6"])
+
+        # A flush of this process is recorded for the other processes
+        stamp = get_revision(USER_CACHE_FLUSH_KEY + "r2")
+        flush_user_cache("r2", login="a")
+        self.assertTrue(get_revision(USER_CACHE_FLUSH_KEY + "r2") > stamp)
+        stamp = get_revision(USER_CACHE_FLUSH_KEY)
+        flush_user_cache(all_processes=False)
+        self.assertEqual(get_revision(USER_CACHE_FLUSH_KEY), stamp)
+
+    def test_04_flush_stamps(self):
+        # A disabled cache does not write a flush stamp
+        self.app.config["PI_USER_CACHE_TTL"] = 0
+        self.app.config["PI_USER_CACHE_NEGATIVE_TTL"] = 0
+        stamp = get_revision(USER_CACHE_FLUSH_KEY)
+        flush_user_cache()
+        self.assertEqual(get_revision(USER_CACHE_FLUSH_KEY), stamp)
+        self.app.config["PI_USER_CACHE_TTL"] = 300
+        self.app.config["PI_USER_CACHE_SIZE"] = 0
+        flush_user_cache()
+        self.assertEqual(get_revision(USER_CACHE_FLUSH_KEY), stamp)
+        self.app.config.pop("PI_USER_CACHE_SIZE")
+
+        # The flush stamp is removed with the resolver
+        save_resolver({"resolver": "stampresolver",
+                       "type": "passwdresolver",
+                       "fileName": PWFILE})
+        flush_user_cache("stampresolver")
+        self.assertTrue(get_revision(USER_CACHE_FLUSH_KEY + "stampresolver"))
+        delete_resolver("stampresolver")
+        self.assertEqual(
+            get_revision(USER_CACHE_FLUSH_KEY + "stampresolver"), 0)
@@ -3,8 +3,10 @@ This tests the file lib.utils
 """
 from .base import MyTestCase
 
-from privacyidea.lib.utils import (parse_timelimit, parse_timedelta)
+from privacyidea.lib.utils import (parse_timelimit, parse_timedelta,
+                                   LRUCache)
 from datetime import timedelta
+import time
 
 
 class UtilsTestCase(MyTestCase):
@@ -48,3 +50,33 @@ class UtilsTestCase(MyTestCase):
 
         # A non number raises an Exception
         self.assertRaises(Exception, parse_timedelta, "sevenm")
+
+    def test_03_lru_cache(self):
+        cache = LRUCache(maxsize=3)
+        for i in range(3):
+            cache.set(i, "value{0!s}".format(i))
+        self.assertEqual(len(cache), 3)
+        # 0 becomes the most recently used entry and 1 is removed
+        self.assertEqual(cache.get(0), "value0")
+        cache.set(3, "value3")
+        self.assertEqual(cache.get(1), None)
+        self.assertEqual(cache.get(1, "default"), "default")
+        self.assertEqual(cache.get(0), "value0")
+        self.assertEqual(len(cache), 3)
+
+        # expired entries are not returned
+        cache.set(4, "value4", ttl=1)
+        self.assertEqual(cache.get(4), "value4")
+        cache._entries[4] = ("value4", time.time() - 1)
+        self.assertEqual(cache.get(4), None)
+
+        cache.delete(0)
+        self.assertEqual(cache.get(0), None)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.invalidate(lambda key: key in ["a", 3])
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(cache.get(3), None)
+        self.assertEqual(cache.get("b"), 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)